@@ -0,0 +1,248 @@
+import json
+import logging
+import datetime
+import urllib.parse
+from collections import defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+
+import requests
+
+import schemas
+import uploader
+from metrics import METRICS
+from sharding import get_shard
+from flowcontrol import AimdController, Overloaded, OVERLOAD_STATUSES, pump
+from statestore import STAGE_UPLOAD, STATUS_DONE, STATUS_FAILED
+from transform import file_summaries, read_frame
+
+# Подзапросов $count в одном $batch: размер подбирает регулятор (секция "audit" в config.json)
+BATCH_DEFAULTS = {"initial_batch": 50, "min_batch": 5, "max_batch": 200, "batch_step": 10,
+                  "initial_concurrency": 2, "max_concurrency": 8}
+# Ряд FROST: (сущность, ID, колонка CSV или "rows" для MultiDatastream)
+Unit = Tuple[str, str, str]
+
+
+def _day_after(day: str) -> str:
+    return (datetime.date.fromisoformat(day) + datetime.timedelta(days=1)).isoformat()
+
+
+def _observations_url(unit: Unit, start: str, end: str, query: str) -> str:
+    """Относительный URL наблюдений ряда с phenomenonTime в [start, end) UTC."""
+    window = f"phenomenonTime ge {start}T00:00:00Z and phenomenonTime lt {end}T00:00:00Z"
+    return f"{unit[0]}({unit[1]})/Observations?$filter={urllib.parse.quote(window)}&{query}"
+
+
+# --- Локальные счетчики ---
+
+def local_counts(catalog, schema, sensor_id, days: Set[str]) -> Dict[str, Dict[str, int]]:
+    """{день: счетчики файла} по архиву; счетчики берутся из сводок каталога, читаются только измененные файлы."""
+    entries = [e for e in catalog.files(schema.name, sensor_id, start=min(days), end=max(days)) if e["day"] in days]
+    return {e["day"]: summary["counts"] for e, summary in file_summaries(catalog, schema, entries)}
+
+
+# --- Счетчики на сервере ---
+
+class BatchCounter:
+    """Считает $count наблюдений по множеству окон через $batch, не скачивая сами наблюдения."""
+
+    def __init__(self, base_url: str, settings: Optional[Dict] = None):
+        self.base_url = base_url
+        self.flow = AimdController(**{**BATCH_DEFAULTS, **(settings or {})})
+
+    def _send(self, chunk, results) -> int:
+        body = {"requests": [{"id": str(i), "method": "get", "url": url} for i, (_, url) in enumerate(chunk)]}
+        METRICS.inc("frost_posts_total", endpoint="$batch")
+        try:
+            with METRICS.http_timer("frost", "batch_count"):
+                resp = requests.post(f"{self.base_url}/$batch", headers=uploader.HEADERS, json=body,
+                                     timeout=self.flow.timeout)
+        except requests.exceptions.Timeout:
+            raise Overloaded("timeout")
+        except requests.exceptions.ConnectionError:
+            raise Overloaded("connection")
+        if resp.status_code in OVERLOAD_STATUSES:
+            raise Overloaded(f"http_{resp.status_code}", uploader._retry_after(resp))
+        if resp.status_code != 200:
+            logging.error(f"$batch failed: {resp.status_code} {resp.text[:200]}")
+            return len(chunk)
+
+        failed = len(chunk)
+        for r in resp.json().get("responses", []):
+            answer = r.get("body")
+            if isinstance(answer, str):
+                try:
+                    answer = json.loads(answer)
+                except ValueError:
+                    continue
+            if int(r.get("status", 0)) == 200 and isinstance(answer, dict) and "@iot.count" in answer:
+                results[chunk[int(r["id"])][0]] = int(answer["@iot.count"])
+                failed -= 1
+        return failed
+
+    def counts(self, queries: Dict) -> Dict:
+        """{ключ: URL} → {ключ: число наблюдений}; ключи неудавшихся подзапросов отсутствуют."""
+        results = {}
+        if queries:
+            pump([("count", list(queries.items()))], lambda chunk: self._send(chunk, results), self.flow)
+        return results
+
+
+# --- Сверка ---
+
+def _units(sensor: Dict, schema, multidatastream: bool) -> Tuple[List[Unit], List[Unit]]:
+    """Ряды датчика в текущей модели и ряды прежней модели (если режим меняли)."""
+    ds = [("Datastreams", sensor["ds_ids"][k], k) for k in schema.measurements
+          if (sensor.get("ds_ids") or {}).get(k)]
+    mds = [("MultiDatastreams", sensor["mds_id"], "rows")] if sensor.get("mds_id") else []
+    return (mds, ds) if multidatastream else (ds, mds)
+
+
+def _verdict(s: Dict, start: str, days: List[str], server: Dict) -> Optional[str]:
+    """ok / missing (на сервере меньше) / extra (только лишние) или None, если счетчик не получен."""
+    units = s["active"] + s["legacy"]
+    if any((s["idx"], start, u) not in server for u in units):
+        return None
+    expected = {u: sum(s["local"][d].get(u[2], 0) for d in days) for u in units}
+    got = {u: server[(s["idx"], start, u)] for u in units}
+    if all(got[u] == expected[u] for u in s["active"]):
+        return "ok"
+    # Дни до смены режима целиком лежат в рядах прежней модели
+    if s["legacy"] and all(got[u] == 0 for u in s["active"]) and all(got[u] == expected[u] for u in s["legacy"]):
+        return "ok"
+    return "extra" if all(got[u] >= expected[u] for u in s["active"]) else "missing"
+
+
+def _check(counter: BatchCounter, sensors: List[Dict], windows: List[Tuple[int, List[str]]]) -> Dict:
+    """Один проход $count по окнам [(датчик, дни подряд)] → {(датчик, первый день): вердикт}."""
+    queries = {}
+    for idx, days in windows:
+        s = sensors[idx]
+        for unit in s["active"] + s["legacy"]:
+            queries[(idx, days[0], unit)] = _observations_url(unit, days[0], _day_after(days[-1]),
+                                                              "$count=true&$top=0")
+    server = counter.counts(queries)
+    METRICS.inc("audit_count_queries_total", len(queries))
+    return {(idx, days[0]): _verdict(sensors[idx], days[0], days, server) for idx, days in windows}
+
+
+def _repair(s: Dict, days: List[str], multidatastream: bool) -> Dict[str, int]:
+    """Догружает в текущую модель только наблюдения, времени которых нет ни в одном ряду датчика за день."""
+    schema, keys = s["schema"], list(s["schema"].measurements)
+    ds_ids = {} if multidatastream else {u[2]: u[1] for u in s["active"]}
+    mds_id = s["active"][0][1] if multidatastream else None
+    entity = "MultiDatastream" if multidatastream else "Datastream"
+    stats = {"repaired": 0, "failed": 0}
+
+    def batches():
+        for day in days:
+            entry = uploader.CATALOG.get(schema.name, s["sensor_id"], day)
+            try:
+                present = {str(u[1]): uploader.get_day_times(u[1], day, u[0]) for u in s["active"]}
+                legacy = set().union(*(uploader.get_day_times(u[1], day, u[0]) for u in s["legacy"]))
+                df = read_frame(schema, uploader.CATALOG.full_path(entry))
+                df = df[df["timestamp"].notna()]
+                observations = uploader.build_observations(df, keys, ds_ids, mds_id)
+            except Exception as e:
+                logging.error(f"Audit repair of {schema.name} {s['sensor_id']} on {day} failed: {e}")
+                uploader.STATE.mark(STAGE_UPLOAD, schema.name, s["sensor_id"], day, STATUS_FAILED,
+                                    detail=f"audit: {e}"[:200])
+                continue
+            missing = [o for o in observations
+                       if uploader.epoch_ms(o[1]) not in present.get(str(o[0]), ()) and uploader.epoch_ms(o[1]) not in legacy]
+            logging.info(f"🩹 {schema.name} {s['sensor_id']} {day}: re-uploading {len(missing)} missing observation(s)")
+            if missing:
+                yield day, missing
+
+    results = pump(batches(), lambda chunk: uploader.post_observations(chunk, s["foi_id"], schema.name, entity),
+                   uploader.FLOW, reconcile=lambda chunk: uploader.missing_observations(chunk, entity))
+    for day, res in results.items():
+        stats["repaired"] += res["sent"]
+        stats["failed"] += res["failed"]
+        if res["failed"]:
+            uploader.STATE.mark(STAGE_UPLOAD, schema.name, s["sensor_id"], day, STATUS_FAILED,
+                                detail=f"audit: {res['failed']} of {res['sent'] + res['failed']} observations failed")
+        else:
+            uploader.STATE.mark(STAGE_UPLOAD, schema.name, s["sensor_id"], day, STATUS_DONE, detail="audit_repaired")
+    return stats
+
+
+def run_audit(config) -> Dict[str, int]:
+    """
+    Сверяет число наблюдений во FROST с архивом для загруженных дней и догружает недостающее.
+    Сначала один $count на ряд и месяц; по дням — только внутри расхождений.
+    """
+    logging.info("--- Starting Audit ---")
+    uploader.open_session(config)
+    try:
+        return _audit(config)
+    finally:
+        uploader.close_session()
+
+
+def _audit(config) -> Dict[str, int]:
+    settings = config.get("audit", {})
+    shard = get_shard(config)
+    multidatastream = uploader.MULTIDATASTREAM
+    counter = BatchCounter(uploader.BASE_URL, settings)
+    stats = defaultdict(int)
+
+    # 1. Ряды датчиков — из синхронизации метаданных, дни — загруженные и лежащие в архиве
+    configured = {s.name: set(config["sensors"].get(s.config_key, {})) for s in schemas.active_types(config)}
+    groups = uploader.STATE.synced_groups(uploader.BASE_URL)
+    if not groups:
+        logging.warning(f"No synced groups for {uploader.BASE_URL}: run a normal upload before the audit")
+        return dict(stats)
+
+    sensors = []
+    for inv, resolved in groups.items():
+        for sensor_type, sensor in resolved.get("sensors", {}).items():
+            sensor_id = str(sensor["sensor_id"])
+            if sensor_id not in configured.get(sensor_type, ()) or not shard.owns(sensor_id):
+                continue
+            schema = schemas.get_schema(sensor_type)
+            active, legacy = _units(sensor, schema, multidatastream)
+            uploaded = {d for d, st in uploader.STATE.statuses(STAGE_UPLOAD, sensor_type, sensor_id).items()
+                        if st == STATUS_DONE}
+            if not active or not uploaded:
+                continue
+            local = local_counts(uploader.CATALOG, schema, sensor_id, uploaded)
+            if local:
+                sensors.append({"idx": len(sensors), "schema": schema, "sensor_id": sensor_id,
+                                "foi_id": resolved.get("foi_id"), "active": active, "legacy": legacy,
+                                "local": local, "days": sorted(local)})
+    stats["sensors"] = len(sensors)
+    stats["days"] = sum(len(s["days"]) for s in sensors)
+    logging.info(f"🔎 Auditing {stats['days']} day(s) of {stats['sensors']} sensor(s) on {uploader.BASE_URL}")
+
+    # 2. Месяцы, затем дни внутри несошедшихся месяцев
+    months = [(s["idx"], [d for d in s["days"] if d[:7] == m])
+              for s in sensors for m in sorted({d[:7] for d in s["days"]})]
+    month_verdicts = _check(counter, sensors, months)
+    suspect = [(idx, [d]) for idx, days in months if month_verdicts[(idx, days[0])] != "ok" for d in days]
+    stats["months"] = len(months)
+    stats["months_mismatched"] = sum(1 for v in month_verdicts.values() if v != "ok")
+    day_verdicts = _check(counter, sensors, suspect)
+
+    to_repair = defaultdict(list)
+    for (idx, day), verdict in sorted(day_verdicts.items()):
+        if verdict == "ok":
+            continue
+        stats[f"days_{verdict or 'unknown'}"] += 1
+        METRICS.inc("audit_days_mismatched_total", kind=verdict or "unknown")
+        s = sensors[idx]
+        if verdict == "missing":
+            to_repair[idx].append(day)
+        elif verdict == "extra":
+            logging.warning(f"⚠️ {s['schema'].name} {s['sensor_id']} {day}: more observations on the server than "
+                            f"in the archive (duplicates?)")
+
+    # 3. Починка: только недостающие наблюдения несошедшихся дней
+    if to_repair and settings.get("repair", True):
+        for idx, days in to_repair.items():
+            res = _repair(sensors[idx], days, multidatastream)
+            stats["observations_repaired"] += res["repaired"]
+            stats["observations_failed"] += res["failed"]
+        METRICS.inc("audit_observations_repaired_total", stats["observations_repaired"])
+
+    logging.info(f"🔎 Audit finished: {dict(stats)}")
+    return dict(stats)
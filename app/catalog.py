@@ -0,0 +1,246 @@
+import os
+import re
+import json
+import sqlite3
+import logging
+import datetime
+from typing import Optional, List, Dict, Iterable, Tuple
+
+import schemas
+from statestore import enable_wal
+
+CATALOG_FILE = "catalog.sqlite"
+
+STATUS_OK = "ok"
+STATUS_EMPTY = "empty"
+STATUS_MISSING = "missing"
+
+# 2025-06-01_sds011_sensor_82312.csv
+FILENAME_RE = re.compile(r"^(\d{4}-\d{2}-\d{2})_([a-z0-9]+)_sensor_(\d+)\.csv$", re.IGNORECASE)
+
+
+def archive_filename(sensor_type: str, sensor_id, day: str) -> str:
+    return schemas.get_schema(sensor_type).filename(sensor_id, day)
+
+
+def archive_relpath(sensor_type: str, sensor_id, day: str) -> str:
+    return os.path.join(sensor_type, str(sensor_id), archive_filename(sensor_type, sensor_id, day))
+
+
+def count_rows(text: str) -> int:
+    """Количество строк данных в CSV (без заголовка)."""
+    lines = text.count("\n") + (0 if text.endswith("\n") or not text else 1)
+    return max(0, lines - 1)
+
+
+def _count_file_rows(path: str) -> Optional[int]:
+    try:
+        with open(path, "rb") as f:
+            lines = 0
+            last = b"\n"
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                lines += chunk.count(b"\n")
+                last = chunk[-1:]
+            if last != b"\n":
+                lines += 1
+        return max(0, lines - 1)
+    except IOError:
+        return None
+
+
+class FileCatalog:
+    """
+    Каталог файлов архива в SQLite (data_dir/catalog.sqlite).
+    Одна запись на (тип, датчик, день): путь, размер, mtime, число строк и статус
+    (ok / empty / missing — 404 на источнике). Этапы спрашивают каталог, а не файловую систему.
+    В stats кэшируется сводка содержимого файла (например, число значений по колонкам);
+    она сбрасывается при перезаписи записи и проверяется по размеру и mtime.
+    """
+
+    def __init__(self, data_dir: str):
+        self.data_dir = data_dir
+        os.makedirs(data_dir, exist_ok=True)
+        self.path = os.path.join(data_dir, CATALOG_FILE)
+        is_new = not os.path.exists(self.path)
+        self.conn = sqlite3.connect(self.path, timeout=60)
+        self.conn.row_factory = sqlite3.Row
+        # Каталог общий для воркеров-шардов: WAL, чтобы запись одного не блокировала чтение и запись других
+        enable_wal(self.conn)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                sensor_type TEXT NOT NULL,
+                sensor_id   TEXT NOT NULL,
+                day         TEXT NOT NULL,
+                path        TEXT NOT NULL,
+                size        INTEGER,
+                mtime       REAL,
+                rows        INTEGER,
+                status      TEXT NOT NULL,
+                updated_at  TEXT NOT NULL,
+                stats       TEXT,
+                PRIMARY KEY (sensor_type, sensor_id, day)
+            );
+            CREATE INDEX IF NOT EXISTS files_status ON files (sensor_type, status);
+        """)
+        # Каталоги, созданные до появления колонки stats
+        if "stats" not in {r["name"] for r in self.conn.execute("PRAGMA table_info(files)")}:
+            self.conn.execute("ALTER TABLE files ADD COLUMN stats TEXT")
+            self.conn.commit()
+        if is_new:
+            # Первый запуск на существующем архиве — строим каталог с диска
+            self.reconcile()
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # --- Запись ---
+
+    def record(self, sensor_type: str, sensor_id, day: str, *, status: str = STATUS_OK,
+               size: Optional[int] = None, mtime: Optional[float] = None, rows: Optional[int] = None) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO files (sensor_type, sensor_id, day, path, size, mtime, rows, status, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (sensor_type, str(sensor_id), day, archive_relpath(sensor_type, sensor_id, day), size, mtime, rows,
+             status, datetime.datetime.now().isoformat()),
+        )
+        self.conn.commit()
+
+    def record_download(self, sensor_type: str, sensor_id, day: str, local_path: str, text: str) -> None:
+        """Регистрирует только что записанный скрапером файл."""
+        st = os.stat(local_path)
+        rows = count_rows(text)
+        self.record(sensor_type, sensor_id, day, status=STATUS_OK if st.st_size > 0 else STATUS_EMPTY,
+                    size=st.st_size, mtime=st.st_mtime, rows=rows)
+
+    def record_missing(self, sensor_type: str, sensor_id, day: str) -> None:
+        self.record(sensor_type, sensor_id, day, status=STATUS_MISSING)
+
+    # --- Чтение ---
+
+    def full_path(self, row) -> str:
+        return os.path.join(self.data_dir, row["path"])
+
+    def get(self, sensor_type: str, sensor_id, day: str) -> Optional[sqlite3.Row]:
+        return self.conn.execute(
+            "SELECT * FROM files WHERE sensor_type = ? AND sensor_id = ? AND day = ?",
+            (sensor_type, str(sensor_id), day),
+        ).fetchone()
+
+    def has_file(self, sensor_type: str, sensor_id, day: str) -> bool:
+        row = self.get(sensor_type, sensor_id, day)
+        return row is not None and row["status"] == STATUS_OK
+
+    def files(self, sensor_type: str, sensor_id=None, *, start: Optional[str] = None,
+              end: Optional[str] = None) -> List[sqlite3.Row]:
+        """Файлы со статусом ok, отсортированные по датчику и дню."""
+        sql = "SELECT * FROM files WHERE sensor_type = ? AND status = ?"
+        params = [sensor_type, STATUS_OK]
+        if sensor_id is not None:
+            sql += " AND sensor_id = ?"
+            params.append(str(sensor_id))
+        if start:
+            sql += " AND day >= ?"
+            params.append(start)
+        if end:
+            sql += " AND day <= ?"
+            params.append(end)
+        return self.conn.execute(sql + " ORDER BY sensor_id, day", params).fetchall()
+
+    def file_stats(self, row) -> Dict:
+        """Сохраненная сводка файла, если он не менялся с момента ее расчета (иначе пустой словарь)."""
+        try:
+            stats = json.loads(row["stats"] or "{}")
+        except (IndexError, ValueError):
+            return {}
+        if stats.get("size") != row["size"] or stats.get("mtime") != row["mtime"]:
+            return {}
+        return stats
+
+    def set_file_stats(self, items: Iterable[Tuple[sqlite3.Row, Dict]]) -> None:
+        """Дополняет сводки файлов [(запись каталога, новые поля)] одной транзакцией."""
+        batch = []
+        for row, fields in items:
+            stats = self.file_stats(row)
+            stats.update(fields, size=row["size"], mtime=row["mtime"])
+            batch.append((json.dumps(stats, sort_keys=True), row["sensor_type"], row["sensor_id"], row["day"]))
+        if batch:
+            with self.conn:
+                self.conn.executemany(
+                    "UPDATE files SET stats = ? WHERE sensor_type = ? AND sensor_id = ? AND day = ?", batch)
+
+    def sensors(self, sensor_type: str) -> List[str]:
+        rows = self.conn.execute(
+            "SELECT DISTINCT sensor_id FROM files WHERE sensor_type = ? AND status = ? ORDER BY sensor_id",
+            (sensor_type, STATUS_OK),
+        ).fetchall()
+        return [r["sensor_id"] for r in rows]
+
+    def summary(self, sensor_type: str) -> List[Dict]:
+        rows = self.conn.execute(
+            "SELECT sensor_id, COUNT(*) AS files, COALESCE(SUM(rows), 0) AS rows, COALESCE(SUM(size), 0) AS bytes, "
+            "MAX(mtime) AS mtime "
+            "FROM files WHERE sensor_type = ? AND status = ? GROUP BY sensor_id ORDER BY sensor_id",
+            (sensor_type, STATUS_OK),
+        ).fetchall()
+        return [dict(r) for r in rows]
+
+    # --- Сверка с диском ---
+
+    def reconcile(self) -> Dict[str, int]:
+        """
+        Перестраивает каталог по файлам на диске: добавляет новые и измененные файлы
+        (строки пересчитываются, только если поменялись размер или mtime), удаляет исчезнувшие.
+        Записи missing (404) сохраняются.
+        """
+        logging.info(f"🗂️ Reconciling file catalog with {self.data_dir}...")
+        known = {
+            (r["sensor_type"], r["sensor_id"], r["day"]): r
+            for r in self.conn.execute("SELECT * FROM files WHERE status != ?", (STATUS_MISSING,))
+        }
+        seen = set()
+        stats = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0}
+        now = datetime.datetime.now().isoformat()
+        batch = []
+
+        for sensor_type in schemas.sensor_types():
+            type_dir = os.path.join(self.data_dir, sensor_type)
+            if not os.path.isdir(type_dir):
+                continue
+            for sensor_entry in os.scandir(type_dir):
+                if not sensor_entry.is_dir():
+                    continue
+                sensor_id = sensor_entry.name.strip()
+                for entry in os.scandir(sensor_entry.path):
+                    m = FILENAME_RE.match(entry.name)
+                    if not m or not entry.is_file():
+                        continue
+                    day = m.group(1)
+                    key = (sensor_type, sensor_id, day)
+                    seen.add(key)
+                    st = entry.stat()
+                    old = known.get(key)
+                    if old is not None and old["size"] == st.st_size and old["mtime"] == st.st_mtime:
+                        stats["unchanged"] += 1
+                        continue
+                    rows = _count_file_rows(entry.path)
+                    status = STATUS_OK if st.st_size > 0 else STATUS_EMPTY
+                    batch.append((sensor_type, sensor_id, day, archive_relpath(sensor_type, sensor_id, day),
+                                  st.st_size, st.st_mtime, rows, status, now))
+                    stats["updated" if old is not None else "added"] += 1
+
+        removed = [k for k in known if k not in seen]
+        stats["removed"] = len(removed)
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO files (sensor_type, sensor_id, day, path, size, mtime, rows, status, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", batch)
+            self.conn.executemany(
+                "DELETE FROM files WHERE sensor_type = ? AND sensor_id = ? AND day = ?", removed)
+        logging.info(f"🗂️ Catalog reconciled: {stats}")
+        return stats
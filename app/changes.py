@@ -0,0 +1,102 @@
+import os
+import json
+import hashlib
+import logging
+from typing import Optional
+
+import schemas
+from catalog import FileCatalog
+from sharding import Shard
+
+# Ключи в таблице meta state.sqlite: отпечаток входов этапа на момент последнего успешного прогона
+FINGERPRINT_KEY = "fingerprint:{stage}{suffix}"
+# Отпечаток строк all_stats.xlsx, которые читает загрузчик шарда (пишет процессор под lease)
+ALL_STATS_ROWS_KEY = "all_stats_rows{suffix}"
+INVENTORY_COLUMN = "Инвентарный номер изделия"
+
+
+def _file_signature(path: str):
+    try:
+        st = os.stat(path)
+        return [path, st.st_size, st.st_mtime]
+    except OSError:
+        return [path, None, None]
+
+
+def _digest(parts) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _catalog_parts(config, shard):
+    """Агрегаты каталога по своим датчикам (файлы, строки, байты, последний mtime). CSV не открываются."""
+    parts = []
+    with FileCatalog(config.get("data_dir", "data")) as catalog:
+        for sensor_type in schemas.sensor_types():
+            parts.extend([sensor_type, s["sensor_id"], s["files"], s["rows"], s["bytes"], s["mtime"]]
+                         for s in catalog.summary(sensor_type) if shard.owns(s["sensor_id"]))
+    return parts
+
+
+def catalog_fingerprint(config, shard) -> str:
+    """Входы хранилища рядов для read API: архив своих датчиков и реестр типов."""
+    return _digest(_catalog_parts(config, shard) + [_file_signature(schemas.registry().path)])
+
+
+def processing_fingerprint(config, shard) -> str:
+    """
+    Входы процессора: агрегаты каталога по своим датчикам, description.xlsx,
+    реестр типов датчиков, настройки геокодера и радиус объединения координат.
+    """
+    data_dir = config.get("data_dir", "data")
+    parts = _catalog_parts(config, shard)
+    parts.append(_file_signature(os.path.join(data_dir, "description.xlsx")))
+    parts.append(_file_signature("description.xlsx"))
+    parts.append(_file_signature(schemas.registry().path))
+    parts.append(config.get("geocoder", {}))
+    parts.append(config.get("location_cluster_radius_m"))
+    return _digest(parts)
+
+
+def shard_rows_digest(all_stats, shard) -> str:
+    """
+    Отпечаток строк all_stats, от которых зависит загрузка шарда: свои датчики и все строки групп
+    (инвентарных номеров), в которых есть свой датчик или которыми шард владеет.
+    """
+    mine = all_stats["sensor_id"].map(shard.owns)
+    if INVENTORY_COLUMN in all_stats.columns:
+        inv = all_stats[INVENTORY_COLUMN]
+        groups = set(inv[mine].dropna()) | {i for i in inv.dropna().unique() if shard.owns(i)}
+        mine |= inv.isin(groups)
+    return hashlib.sha256(all_stats[mine].to_csv(index=False).encode("utf-8")).hexdigest()
+
+
+def remember_all_stats(store, all_stats, shard) -> None:
+    """Сохраняет отпечатки строк all_stats для каждого шарда: изменения чужих групп не будят загрузчик."""
+    for index in range(shard.count):
+        other = Shard(index, shard.count)
+        store.set_meta(ALL_STATS_ROWS_KEY.format(suffix=other.suffix), shard_rows_digest(all_stats, other))
+
+
+def upload_fingerprint(config, store, shard) -> str:
+    """
+    Входы загрузчика, кроме дней с данными: строки all_stats.xlsx этого шарда (метаданные
+    Things/Locations), реестр типов датчиков (Datastreams), адрес FROST и режим MultiDatastream.
+    Файл all_stats.xlsx общий для всех шардов, поэтому берется отпечаток своих строк, сохраненный
+    процессором; без него (файл от старой версии) — размер и mtime файла.
+    """
+    data_dir = config.get("data_dir", "data")
+    rows = (store.get_meta(ALL_STATS_ROWS_KEY.format(suffix=shard.suffix))
+            or _file_signature(os.path.join(data_dir, "all_stats.xlsx")))
+    return _digest([rows, _file_signature(schemas.registry().path), config.get("frost_url"),
+                    bool(config.get("multidatastream", False))])
+
+
+def unchanged(store, stage: str, fingerprint: str, suffix: str = "") -> bool:
+    return store.get_meta(FINGERPRINT_KEY.format(stage=stage, suffix=suffix)) == fingerprint
+
+
+def remember(store, stage: str, fingerprint: Optional[str], suffix: str = "") -> None:
+    """Сохраняет отпечаток после успешного этапа; None сбрасывает его (этап повторится в следующий раз)."""
+    key = FINGERPRINT_KEY.format(stage=stage, suffix=suffix)
+    store.set_meta(key, fingerprint or "")
+    logging.debug(f"Stage fingerprint {key} = {fingerprint}")
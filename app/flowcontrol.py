@@ -0,0 +1,232 @@
+import json
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from metrics import METRICS
+
+# Настройки по умолчанию (секция "upload" в config.json)
+DEFAULTS = {
+    "initial_concurrency": 2,
+    "min_concurrency": 1,
+    "max_concurrency": 16,
+    "initial_batch": 250,
+    "min_batch": 10,
+    "max_batch": 5000,
+    "batch_step": 50,
+    "target_latency_s": 2.0,
+    "timeout_s": 60,
+    "max_retries": 5,
+}
+
+# Ответы, означающие перегрузку сервера: повторяем и снижаем нагрузку
+OVERLOAD_STATUSES = {429, 500, 502, 503, 504}
+
+
+class Overloaded(Exception):
+    """
+    Сервер перегружен (429 / 5xx / таймаут); retry_after — пауза, которую попросил сервер.
+    maybe_applied — запрос мог быть выполнен (таймаут чтения, обрыв после отправки): вслепую не повторять.
+    """
+
+    def __init__(self, reason: str, retry_after: Optional[float] = None, maybe_applied: bool = False):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+        self.maybe_applied = maybe_applied
+
+
+class AimdController:
+    """
+    AIMD с целевой задержкой для загрузки наблюдений.
+    Успешный ответ быстрее target_latency_s — аддитивный рост (параллелизм +1 за «окно», пачка +batch_step);
+    медленный ответ — мягкое снижение; 429 / 5xx / таймаут — снижение вдвое (не чаще раза за окно).
+    """
+
+    def __init__(self, **settings):
+        conf = dict(DEFAULTS)
+        conf.update({k: v for k, v in settings.items() if v is not None and k in DEFAULTS})
+        self.conf = conf
+        self._lock = threading.Lock()
+        self._concurrency = float(min(max(conf["initial_concurrency"], conf["min_concurrency"]),
+                                      conf["max_concurrency"]))
+        self._batch = int(min(max(conf["initial_batch"], conf["min_batch"]), conf["max_batch"]))
+        self._latency = None
+        self._last_decrease = 0.0
+        self._reported = None
+        self._publish()
+
+    # --- Текущие настройки ---
+
+    @property
+    def concurrency(self) -> int:
+        return int(self._concurrency)
+
+    @property
+    def batch_size(self) -> int:
+        return self._batch
+
+    @property
+    def timeout(self) -> float:
+        return float(self.conf["timeout_s"])
+
+    def snapshot(self) -> Dict:
+        return {"concurrency": self.concurrency, "batch": self.batch_size,
+                "latency_s": round(self._latency, 3) if self._latency is not None else None}
+
+    # --- Обратная связь ---
+
+    def on_success(self, latency: float) -> None:
+        c = self.conf
+        with self._lock:
+            self._latency = latency if self._latency is None else 0.8 * self._latency + 0.2 * latency
+            if self._latency > c["target_latency_s"]:
+                # Сервер еще справляется, но медленнее цели — мягко отступаем
+                if self._cooled_down():
+                    self._concurrency = max(c["min_concurrency"], self._concurrency - 1)
+                    self._batch = max(c["min_batch"], int(self._batch * 0.8))
+                    self._last_decrease = time.monotonic()
+            else:
+                self._concurrency = min(c["max_concurrency"], self._concurrency + 1.0 / self._concurrency)
+                self._batch = min(c["max_batch"], self._batch + c["batch_step"])
+        self._publish()
+
+    def on_overload(self, reason: str) -> None:
+        METRICS.inc("upload_throttled_total", reason=reason)
+        c = self.conf
+        with self._lock:
+            # Все запросы, бывшие в полете, получат ошибку одновременно — снижаем один раз за окно
+            if self._cooled_down():
+                self._concurrency = max(c["min_concurrency"], self._concurrency / 2)
+                self._batch = max(c["min_batch"], self._batch // 2)
+                self._last_decrease = time.monotonic()
+        self._publish()
+
+    def _cooled_down(self) -> bool:
+        window = max(1.0, self._latency or 0.0)
+        return time.monotonic() - self._last_decrease >= window
+
+    def _publish(self) -> None:
+        with self._lock:
+            current = (self.concurrency, self.batch_size)
+            previous, self._reported = self._reported, current
+            latency = self._latency
+        METRICS.set_gauge("upload_concurrency", current[0])
+        METRICS.set_gauge("upload_batch_size", current[1])
+        if latency is not None:
+            METRICS.set_gauge("upload_latency_ewma_seconds", round(latency, 4))
+        if previous is None or previous == current:
+            return
+        # Рост пачки идет на каждом ответе — в INFO только смена параллелизма и откаты
+        grew = current[0] == previous[0] and current[1] > previous[1]
+        logging.log(logging.DEBUG if grew else logging.INFO,
+                    f"🎛️ Upload flow: concurrency {previous[0]} → {current[0]}, batch {previous[1]} → {current[1]}"
+                    + (f" (latency {latency:.3f}s)" if latency is not None else ""))
+
+    def limit_batch(self, size: int) -> None:
+        """Жесткий предел пачки (например, 1, если сервер не поддерживает пакетную вставку)."""
+        with self._lock:
+            self.conf["max_batch"] = self.conf["min_batch"] = max(1, size)
+            self._batch = self.conf["max_batch"]
+        self._publish()
+
+    # --- Сохранение между запусками ---
+
+    def dump(self) -> str:
+        return json.dumps({"concurrency": self._concurrency, "batch": self._batch})
+
+    def restore(self, raw: Optional[str]) -> None:
+        """Стартуем с настроек прошлого запуска (консервативно — с половины параллелизма)."""
+        if not raw:
+            return
+        try:
+            saved = json.loads(raw)
+        except ValueError:
+            return
+        c = self.conf
+        with self._lock:
+            self._concurrency = float(min(c["max_concurrency"],
+                                          max(c["min_concurrency"], saved.get("concurrency", 1) / 2)))
+            self._batch = int(min(c["max_batch"], max(c["min_batch"], saved.get("batch", self._batch))))
+        self._publish()
+
+
+def pump(batches: Iterable[Tuple[str, List]], send: Callable[[List], int],
+         controller: AimdController,
+         reconcile: Optional[Callable[[List], List]] = None) -> Dict[str, Dict[str, int]]:
+    """
+    Отправляет элементы пачками размера controller.batch_size, держа в полете не больше
+    controller.concurrency запросов. batches — (метка, элементы), читается лениво.
+    send(пачка) возвращает число неудачных элементов или бросает Overloaded.
+    Если запрос мог дойти (Overloaded.maybe_applied), повторяется только reconcile(пачка) —
+    элементы, которых на сервере нет; без reconcile такая пачка считается неудачной.
+    Возвращает {метка: {"sent": n, "failed": m}}.
+    """
+    results: Dict[str, Dict[str, int]] = {}
+    c = controller.conf
+
+    def run(chunk):
+        # После отказа остаток пачки делится под уменьшенный регулятором размер
+        parts, failed, attempt = [chunk], 0, 0
+        while parts:
+            part = parts.pop(0)
+            t0 = time.perf_counter()
+            try:
+                failed += send(part)
+            except Overloaded as e:
+                controller.on_overload(e.reason)
+                attempt += 1
+                if attempt > c["max_retries"]:
+                    return failed + len(part) + sum(len(p) for p in parts)
+                METRICS.inc("upload_retries_total")
+                delay = e.retry_after if e.retry_after is not None else min(30.0, 0.5 * 2 ** (attempt - 1))
+                time.sleep(delay * random.uniform(0.8, 1.2))
+                if e.maybe_applied:
+                    # Пачка могла записаться: повторять только то, чего на сервере нет
+                    try:
+                        unsent = reconcile(part) if reconcile else None
+                    except Exception as ex:
+                        logging.error(f"Cannot check which of {len(part)} item(s) reached the server: {ex}")
+                        unsent = None
+                    if unsent is None:
+                        failed += len(part)
+                        continue
+                    part = unsent
+                size = controller.batch_size
+                parts[:0] = [part[i:i + size] for i in range(0, len(part), size)]
+                continue
+            controller.on_success(time.perf_counter() - t0)
+        return failed
+
+    def collect(done):
+        for fut in done:
+            tag, size = fut.tag
+            entry = results.setdefault(tag, {"sent": 0, "failed": 0})
+            try:
+                failed = fut.result()
+            except Exception as e:
+                logging.error(f"Upload batch for {tag} failed: {e}")
+                failed = size
+            entry["sent"] += size - failed
+            entry["failed"] += failed
+
+    pending = set()
+    with ThreadPoolExecutor(max_workers=c["max_concurrency"], thread_name_prefix="upload") as pool:
+        for tag, items in batches:
+            results.setdefault(tag, {"sent": 0, "failed": 0})
+            start = 0
+            while start < len(items):
+                while len(pending) >= max(1, controller.concurrency):
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                chunk = items[start:start + controller.batch_size]
+                start += len(chunk)
+                fut = pool.submit(run, chunk)
+                fut.tag = (tag, len(chunk))
+                pending.add(fut)
+        done, _ = wait(pending)
+        collect(done)
+    return results
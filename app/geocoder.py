@@ -0,0 +1,496 @@
+import os
+import json
+import math
+import mmap
+import time
+import random
+import logging
+import requests
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional, Tuple, Dict, List
+
+from metrics import METRICS
+
+
+# ____________________Общий интерфейс провайдера_______________________
+
+class Geocoder:
+    """Провайдер обратного геокодирования: (lon, lat) -> адрес."""
+    name = "base"
+
+    def reverse(self, lon: float, lat: float) -> Optional[str]:
+        raise NotImplementedError
+
+    def reverse_bulk(self, df: pd.DataFrame, *, lat_col: str = "lat", lon_col: str = "lon") -> pd.Series:
+        results = [self.reverse(lon, lat) for lat, lon in zip(df[lat_col].map(_coerce_float),
+                                                              df[lon_col].map(_coerce_float))]
+        return pd.Series(results, index=df.index, name="address_ru")
+
+    def close(self) -> None:
+        """Освобождает ресурсы провайдера (файлы, соединения)."""
+
+
+def _coerce_float(x):
+    try:
+        if x is None: return None
+        if isinstance(x, (float, int)): return float(x)
+        return float(str(x).strip().replace(",", "."))
+    except Exception:
+        return None
+
+
+def _looks_swapped(lat: Optional[float], lon: Optional[float]) -> bool:
+    if lat is None or lon is None:
+        return False
+    lat_ok = 40.0 <= lat <= 82.0
+    lon_ok = (19.0 <= lon <= 180.0) or (-180.0 <= lon <= -169.0)
+    lat_like_lon = (19.0 <= lat <= 180.0) or (-180.0 <= lat <= -169.0)
+    lon_like_lat = 40.0 <= lon <= 82.0
+    return (not lat_ok and not lon_ok) and (lat_like_lon and lon_like_lat)
+
+
+# ____________________Mapbox_______________________
+
+MAPBOX_ENDPOINT = "https://api.mapbox.com/geocoding/v5/mapbox.places/{lon},{lat}.json"
+DEFAULT_THREADS = 8
+MAX_RETRIES = 5
+TIMEOUT_SEC = 12
+
+FALLBACK_TYPES: List[Optional[str]] = [
+    "address,street,neighborhood,locality,place,region,postcode,poi",
+    "address,street,place,region,postcode",
+    None
+]
+
+
+def _mk_session() -> requests.Session:
+    s = requests.Session()
+    s.headers.update({"User-Agent": "mapbox-revgeo-ru/1.2"})
+    return s
+
+
+def _sleep_backoff(attempt: int, retry_after: Optional[str] = None) -> None:
+    if retry_after:
+        try:
+            time.sleep(min(60.0, float(retry_after)));
+            return
+        except ValueError:
+            pass
+    time.sleep(0.5 * (2 ** attempt) + random.uniform(0, 0.25))
+
+
+def _reverse_once(session: requests.Session, token: str, lon: float, lat: float,
+                  *, language: str, country: Optional[str], types: Optional[str]) -> Optional[str]:
+    url = MAPBOX_ENDPOINT.format(lon=str(lon), lat=str(lat))
+    params = {
+        "access_token": token,
+        "language": language,
+        "limit": 1,
+    }
+    if country:
+        params["country"] = country
+    if types:
+        params["types"] = types
+
+    for attempt in range(MAX_RETRIES):
+        try:
+            with METRICS.http_timer("mapbox", "reverse"):
+                r = session.get(url, params=params, timeout=TIMEOUT_SEC)
+            if r.status_code == 200:
+                data = r.json()
+                feats = data.get("features") or []
+                return feats[0].get("place_name") if feats else None
+            if r.status_code in (429, 500, 502, 503, 504):
+                _sleep_backoff(attempt, r.headers.get("Retry-After"));
+                continue
+            if r.status_code in (401, 403):
+                raise RuntimeError(f"Mapbox auth error {r.status_code}: {r.text[:200]}")
+            if r.status_code in (400, 404, 422):
+                return None
+            _sleep_backoff(attempt)
+        except requests.RequestException:
+            _sleep_backoff(attempt)
+    return None
+
+
+def reverse_geocode_point(token: str, lon: float, lat: float,
+                          *, language: str = "ru", country: Optional[str] = "ru") -> Optional[str]:
+    session = _mk_session()
+    for t in FALLBACK_TYPES:
+        addr = _reverse_once(session, token, lon, lat, language=language, country=country, types=t)
+        if addr: return addr
+    for t in FALLBACK_TYPES:
+        addr = _reverse_once(session, token, lon, lat, language=language, country=None, types=t)
+        if addr: return addr
+    for dx, dy in ((1e-4, 0), (-1e-4, 0), (0, 1e-4), (0, -1e-4)):
+        for t in FALLBACK_TYPES:
+            addr = _reverse_once(session, token, lon + dx, lat + dy, language=language, country=country, types=t)
+            if addr: return addr
+    return None
+
+
+def _preflight(token: str) -> None:
+    addr = reverse_geocode_point(token, 37.6175, 55.7520, country="ru")
+    if not addr:
+        raise RuntimeError("Preflight: не получили адрес по тестовой точке. Проверьте токен Mapbox.")
+
+
+def reverse_geocode_mapbox_bulk(
+        df: pd.DataFrame,
+        *,
+        token: Optional[str] = None,
+        lat_col: str = "lat",
+        lon_col: str = "lon",
+        threads: int = DEFAULT_THREADS,
+        language: str = "ru",
+        country: Optional[str] = "ru",
+        autoswap: bool = True,
+        do_preflight: bool = True
+) -> pd.Series:
+    if not token:
+        raise ValueError("Нет токена Mapbox.")
+
+    if lat_col not in df.columns or lon_col not in df.columns:
+        raise ValueError(f"В df нет колонок '{lat_col}' и/или '{lon_col}'.")
+
+    lats = df[lat_col].map(_coerce_float)
+    lons = df[lon_col].map(_coerce_float)
+
+    if do_preflight:
+        _preflight(token)
+
+    coords = []
+    for lat, lon in zip(lats, lons):
+        if autoswap and _looks_swapped(lat, lon):
+            coords.append((lat, lon, True))
+        else:
+            coords.append((lat, lon, False))
+
+    session = _mk_session()
+    cache: Dict[Tuple[float, float], Optional[str]] = {}
+    results = [None] * len(df)
+    idx_map = list(df.index)
+
+    def _resolve_one(lon: float, lat: float) -> Optional[str]:
+        for t in FALLBACK_TYPES:
+            a = _reverse_once(session, token, lon, lat, language=language, country=country, types=t)
+            if a: return a
+        for t in FALLBACK_TYPES:
+            a = _reverse_once(session, token, lon, lat, language=language, country=None, types=t)
+            if a: return a
+        for dx, dy in ((1e-4, 0), (-1e-4, 0), (0, 1e-4), (0, -1e-4)):
+            for t in FALLBACK_TYPES:
+                a = _reverse_once(session, token, lon + dx, lat + dy, language=language, country=country, types=t)
+                if a: return a
+        return None
+
+    futures = {}
+    with ThreadPoolExecutor(max_workers=max(1, int(threads))) as ex:
+        for i, (lat, lon, swapped) in enumerate(coords):
+            if lat is None or lon is None or (isinstance(lat, float) and math.isnan(lat)) or (
+                    isinstance(lon, float) and math.isnan(lon)):
+                results[i] = None;
+                continue
+
+            use_lat, use_lon = (lon, lat) if swapped else (lat, lon)
+            key = (use_lon, use_lat)
+            if key in cache:
+                results[i] = cache[key];
+                continue
+            fut = ex.submit(_resolve_one, use_lon, use_lat)
+            futures[fut] = (i, key)
+
+        for fut in as_completed(futures):
+            i, key = futures[fut]
+            try:
+                addr = fut.result()
+            except Exception:
+                addr = None
+            cache[key] = addr
+            results[i] = addr
+
+    return pd.Series(results, index=idx_map, name="address_ru")
+
+
+class MapboxGeocoder(Geocoder):
+    """Онлайн-геокодер Mapbox (исходная логика сервиса)."""
+    name = "mapbox"
+
+    def __init__(self, token: str, *, threads: int = DEFAULT_THREADS, language: str = "ru",
+                 country: Optional[str] = "ru", do_preflight: bool = True):
+        if not token:
+            raise ValueError("Mapbox token missing")
+        self.token = token
+        self.threads = threads
+        self.language = language
+        self.country = country
+        self.do_preflight = do_preflight
+
+    def reverse(self, lon: float, lat: float) -> Optional[str]:
+        return reverse_geocode_point(self.token, lon, lat, language=self.language, country=self.country)
+
+    def reverse_bulk(self, df: pd.DataFrame, *, lat_col: str = "lat", lon_col: str = "lon") -> pd.Series:
+        out = reverse_geocode_mapbox_bulk(
+            df, token=self.token, lat_col=lat_col, lon_col=lon_col, threads=self.threads,
+            language=self.language, country=self.country, do_preflight=self.do_preflight
+        )
+        hits = int(out.notna().sum())
+        METRICS.inc("geocode_hits_total", hits, provider=self.name)
+        METRICS.inc("geocode_misses_total", len(out) - hits, provider=self.name)
+        return out
+
+
+# ____________________Офлайн-газеттир_______________________
+
+# Индекс — папка с плоскими массивами, которые открываются через mmap:
+#   keys.npy  (int64)   номер ячейки сетки, отсортирован по возрастанию
+#   lat.npy / lon.npy   координаты точек в том же порядке
+#   offsets.npy (int64) границы адресов в addr.bin (len = N + 1)
+#   addr.bin            адреса в UTF-8 подряд
+#   meta.json           размер ячейки и отпечаток исходного файла
+DEFAULT_CELL_DEG = 0.005
+DEFAULT_MAX_DISTANCE_M = 150.0
+M_PER_DEG_LAT = 110540.0
+M_PER_DEG_LON = 111320.0
+
+
+def _cell_grid(cell_deg: float) -> Tuple[int, int]:
+    """Смещение и число столбцов сетки, чтобы номер ячейки был неотрицательным."""
+    n_cols = int(math.ceil(360.0 / cell_deg)) + 2
+    offset = int(math.ceil(180.0 / cell_deg)) + 1
+    return offset, n_cols
+
+
+def _cell_keys(lat: np.ndarray, lon: np.ndarray, cell_deg: float) -> np.ndarray:
+    offset, n_cols = _cell_grid(cell_deg)
+    ilat = np.floor(lat / cell_deg).astype(np.int64) + offset
+    ilon = np.floor(lon / cell_deg).astype(np.int64) + offset
+    return ilat * n_cols + ilon
+
+
+def _source_fingerprint(path: str) -> Dict[str, float]:
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime": st.st_mtime}
+
+
+def build_gazetteer_index(source_csv: str, index_dir: str, *, cell_deg: float = DEFAULT_CELL_DEG,
+                          sep: str = ",") -> None:
+    """
+    Строит индекс из CSV-выгрузки адресов (колонки lat, lon, address),
+    например, извлеченной из OSM (addr:* узлы и здания) или из Nominatim.
+    """
+    logging.info(f"🗺️ Building gazetteer index from {source_csv}...")
+    src = pd.read_csv(source_csv, sep=sep, usecols=["lat", "lon", "address"],
+                      dtype={"lat": "float64", "lon": "float64", "address": "str"})
+    src = src.dropna(subset=["lat", "lon", "address"])
+
+    lat = src["lat"].to_numpy(dtype=np.float64)
+    lon = src["lon"].to_numpy(dtype=np.float64)
+    keys = _cell_keys(lat, lon, cell_deg)
+    order = np.argsort(keys, kind="stable")
+
+    encoded = [a.encode("utf-8") for a in src["address"].to_numpy()[order]]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded], dtype=np.int64)
+
+    os.makedirs(index_dir, exist_ok=True)
+    np.save(os.path.join(index_dir, "keys.npy"), keys[order])
+    np.save(os.path.join(index_dir, "lat.npy"), lat[order])
+    np.save(os.path.join(index_dir, "lon.npy"), lon[order])
+    np.save(os.path.join(index_dir, "offsets.npy"), offsets)
+    with open(os.path.join(index_dir, "addr.bin"), "wb") as f:
+        f.write(b"".join(encoded))
+
+    meta = {"cell_deg": cell_deg, "count": int(len(encoded)), "source": _source_fingerprint(source_csv)}
+    with open(os.path.join(index_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    logging.info(f"✅ Gazetteer index: {len(encoded)} адресов → {index_dir}")
+
+
+def ensure_gazetteer_index(source_csv: Optional[str], index_dir: str, *,
+                           cell_deg: float = DEFAULT_CELL_DEG, sep: str = ",") -> None:
+    """Перестраивает индекс, если его нет или исходный CSV изменился."""
+    meta_path = os.path.join(index_dir, "meta.json")
+    if not source_csv or not os.path.exists(source_csv):
+        if not os.path.exists(meta_path):
+            raise FileNotFoundError(f"Gazetteer index not found at {index_dir} and no source CSV to build it")
+        return
+
+    if os.path.exists(meta_path):
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("source") == _source_fingerprint(source_csv) and meta.get("cell_deg") == cell_deg:
+                return
+        except (IOError, ValueError):
+            pass
+    build_gazetteer_index(source_csv, index_dir, cell_deg=cell_deg, sep=sep)
+
+
+class OfflineGeocoder(Geocoder):
+    """
+    Обратное геокодирование по локальному газеттиру без сети.
+    Ищет ближайший адрес в 3x3 соседних ячейках сетки, промахи отдает fallback-провайдеру.
+    """
+    name = "offline"
+
+    def __init__(self, index_dir: str, *, max_distance_m: float = DEFAULT_MAX_DISTANCE_M,
+                 fallback: Optional[Geocoder] = None, autoswap: bool = True):
+        with open(os.path.join(index_dir, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.cell_deg = float(meta["cell_deg"])
+        self.max_distance_m = float(max_distance_m)
+        self.fallback = fallback
+        self.autoswap = autoswap
+        self._radius_checked_lat = 0.0
+
+        # Массивы открываются лениво через mmap — старт не зависит от размера газеттира
+        self.keys = np.load(os.path.join(index_dir, "keys.npy"), mmap_mode="r")
+        self.lat = np.load(os.path.join(index_dir, "lat.npy"), mmap_mode="r")
+        self.lon = np.load(os.path.join(index_dir, "lon.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(index_dir, "offsets.npy"), mmap_mode="r")
+        addr_path = os.path.join(index_dir, "addr.bin")
+        self._addr_file = open(addr_path, "rb")
+        if os.path.getsize(addr_path) > 0:
+            self._addr = mmap.mmap(self._addr_file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._addr = b""
+
+    def close(self) -> None:
+        if isinstance(self._addr, mmap.mmap):
+            self._addr.close()
+        self._addr = b""
+        self._addr_file.close()
+        self.keys = self.lat = self.lon = self.offsets = np.empty(0)
+        if self.fallback is not None:
+            self.fallback.close()
+
+    def _check_radius(self, lat: np.ndarray) -> None:
+        """
+        Окно 3x3 гарантированно покрывает одну ячейку в каждую сторону; по долготе это
+        cell_deg * M_PER_DEG_LON * cos(lat) метров — на широте запросов радиус может не поместиться.
+        """
+        max_lat = float(np.nanmax(np.abs(lat))) if len(lat) else 0.0
+        if max_lat <= self._radius_checked_lat:
+            return
+        self._radius_checked_lat = max_lat
+        reach = self.cell_deg * min(M_PER_DEG_LAT, M_PER_DEG_LON * max(math.cos(math.radians(max_lat)), 0.01))
+        if self.max_distance_m > reach:
+            logging.warning(f"Gazetteer cell {self.cell_deg}° covers only {reach:.0f} m at latitude {max_lat:.1f}, "
+                            f"less than radius {self.max_distance_m} m; some matches may be missed")
+
+    def _address(self, i: int) -> str:
+        return self._addr[int(self.offsets[i]):int(self.offsets[i + 1])].decode("utf-8")
+
+    def _nearest(self, lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+        """Индекс ближайшей точки газеттира для каждой координаты (-1 — нет в радиусе)."""
+        n = len(lat)
+        best = np.full(n, -1, dtype=np.int64)
+        if n == 0 or len(self.keys) == 0:
+            return best
+
+        self._check_radius(lat)
+        _, n_cols = _cell_grid(self.cell_deg)
+        centers = _cell_keys(lat, lon, self.cell_deg)
+        cos_lat = np.cos(np.radians(lat))
+        limit_sq = self.max_distance_m ** 2
+
+        # Запросы группируются по ячейке: кандидаты из 3x3 окна выбираются один раз на ячейку,
+        # а расстояния считаются матрицей "запросы ячейки × кандидаты"
+        order = np.argsort(centers, kind="stable")
+        cells, starts = np.unique(centers[order], return_index=True)
+        ends = np.append(starts[1:], n)
+        for cell, a, b in zip(cells, starts, ends):
+            # Ячейки одной строки сетки идут подряд, поэтому 3x3 окно — это три диапазона ключей
+            ranges = []
+            for d_row in (-1, 0, 1):
+                row = cell + d_row * n_cols
+                lo = int(np.searchsorted(self.keys, row - 1, side="left"))
+                hi = int(np.searchsorted(self.keys, row + 1, side="right"))
+                if lo < hi:
+                    ranges.append(np.arange(lo, hi))
+            if not ranges:
+                continue
+            cand = np.concatenate(ranges)
+            q = order[a:b]
+
+            dy = (self.lat[cand][None, :] - lat[q][:, None]) * M_PER_DEG_LAT
+            dx = (self.lon[cand][None, :] - lon[q][:, None]) * (M_PER_DEG_LON * cos_lat[q][:, None])
+            d = dx * dx + dy * dy
+            j = np.argmin(d, axis=1)
+            hit = d[np.arange(len(q)), j] <= limit_sq
+            best[q[hit]] = cand[j[hit]]
+        return best
+
+    def reverse(self, lon: float, lat: float) -> Optional[str]:
+        idx = self._nearest(np.array([lat], dtype=np.float64), np.array([lon], dtype=np.float64))[0]
+        if idx >= 0:
+            return self._address(idx)
+        return self.fallback.reverse(lon, lat) if self.fallback else None
+
+    def reverse_bulk(self, df: pd.DataFrame, *, lat_col: str = "lat", lon_col: str = "lon") -> pd.Series:
+        lats = pd.to_numeric(df[lat_col].map(_coerce_float), errors="coerce").to_numpy(dtype=np.float64)
+        lons = pd.to_numeric(df[lon_col].map(_coerce_float), errors="coerce").to_numpy(dtype=np.float64)
+        if self.autoswap:
+            swapped = np.array([_looks_swapped(a, b) for a, b in zip(lats, lons)], dtype=bool)
+            lats, lons = np.where(swapped, lons, lats), np.where(swapped, lats, lons)
+
+        valid = ~(np.isnan(lats) | np.isnan(lons))
+        results = [None] * len(df)
+        nearest = self._nearest(lats[valid], lons[valid])
+        for pos, idx in zip(np.flatnonzero(valid), nearest):
+            if idx >= 0:
+                results[pos] = self._address(idx)
+
+        out = pd.Series(results, index=df.index, name="address_ru", dtype=object)
+        misses = valid & out.isna().to_numpy()
+        n_misses = int(misses.sum())
+        METRICS.inc("geocode_hits_total", int(valid.sum()) - n_misses, provider=self.name)
+        # Промахи, переданные fallback-провайдеру, он учитывает сам (как попадание или промах)
+        unresolved = len(df) - int(valid.sum()) + (0 if self.fallback is not None else n_misses)
+        METRICS.inc("geocode_misses_total", unresolved, provider=self.name)
+        logging.info(f"Offline geocoder: {int(valid.sum()) - n_misses} hits, {n_misses} misses")
+
+        if self.fallback is not None and misses.any():
+            sub = pd.DataFrame({lat_col: lats[misses], lon_col: lons[misses]}, index=df.index[misses])
+            out.loc[sub.index] = self.fallback.reverse_bulk(sub, lat_col=lat_col, lon_col=lon_col)
+        return out
+
+
+# ____________________Выбор провайдера по конфигу_______________________
+
+def make_geocoder(config) -> Geocoder:
+    """
+    Собирает провайдера по секции "geocoder" из config.json.
+    provider: "mapbox" (по умолчанию) или "offline"; fallback: "mapbox" или null.
+    """
+    geo_conf = config.get("geocoder", {}) or {}
+    provider = geo_conf.get("provider", "mapbox")
+    token = config.get("mapbox_token")
+    threads = int(geo_conf.get("threads", DEFAULT_THREADS))
+
+    if provider == "mapbox":
+        if not token:
+            logging.error("Mapbox token not found in config")
+            raise ValueError("Mapbox token missing")
+        return MapboxGeocoder(token, threads=threads)
+
+    if provider == "offline":
+        data_dir = config.get("data_dir", "data")
+        index_dir = geo_conf.get("index_dir") or os.path.join(data_dir, "gazetteer_index")
+        cell_deg = float(geo_conf.get("cell_deg", DEFAULT_CELL_DEG))
+        ensure_gazetteer_index(geo_conf.get("gazetteer_csv"), index_dir,
+                               cell_deg=cell_deg, sep=geo_conf.get("gazetteer_sep", ","))
+
+        fallback = None
+        if geo_conf.get("fallback") == "mapbox":
+            if token:
+                fallback = MapboxGeocoder(token, threads=threads)
+            else:
+                logging.warning("Geocoder fallback is 'mapbox', but no token is set. Misses stay empty.")
+        return OfflineGeocoder(index_dir, max_distance_m=float(geo_conf.get("max_distance_m", DEFAULT_MAX_DISTANCE_M)),
+                               fallback=fallback)
+
+    raise ValueError(f"Unknown geocoder provider: {provider}")
@@ -0,0 +1,263 @@
+import time
+import asyncio
+import logging
+import datetime
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
+
+import requests
+import pandas as pd
+
+import schemas
+import uploader
+from metrics import METRICS
+from sharding import get_shard
+from flowcontrol import pump
+from statestore import STAGE_LIVE, STATUS_DONE
+
+# Настройки по умолчанию (секция "live" в config.json)
+DEFAULTS = {
+    "url": "https://data.sensor.community/airrohr/v1/sensor",
+    "interval_s": 300,
+    "concurrency": 8,
+    "timeout_s": 30,
+}
+
+# Сколько последних дней помнить отправленные времена (API отдает показания за последние минуты)
+SEEN_DAYS = 2
+
+
+class LiveSensor:
+    """Датчик живого опроса: его ряды во FROST, валидаторы последнего ответа и уже отправленные времена."""
+
+    def __init__(self, schema, sensor_id: str, sensor: Dict, foi_id):
+        self.schema = schema
+        self.sensor_id = sensor_id
+        self.validators: Dict[str, str] = {}  # ETag / Last-Modified последнего ответа 200
+        self.floor: Optional[int] = None  # последнее время на сервере при первом опросе (epoch, мс)
+        self.floor_checked = False
+        self.seen: Dict[str, Set[int]] = defaultdict(set)  # день -> отправленные времена (epoch, мс)
+        self.update(sensor, foi_id)
+
+    def update(self, sensor: Dict, foi_id) -> None:
+        self.ds_ids = sensor.get("ds_ids") or {}
+        self.mds_id = sensor.get("mds_id")
+        self.foi_id = foi_id
+
+    @property
+    def key(self) -> Tuple[str, str]:
+        return self.schema.name, self.sensor_id
+
+    def targets(self) -> List[Tuple[str, str]]:
+        """Ряды, в которые уходят наблюдения: [(ID, сущность)]."""
+        if uploader.MULTIDATASTREAM:
+            return [(self.mds_id, "MultiDatastreams")] if self.mds_id else []
+        return [(id_, "Datastreams") for id_ in self.ds_ids.values() if id_]
+
+
+def parse_readings(schema, payload) -> pd.DataFrame:
+    """Ответ API датчика → кадр timestamp (UTC) + колонки измерений схемы, по строке на время."""
+    rows = []
+    for item in payload or []:
+        sensor_type = ((item.get("sensor") or {}).get("sensor_type") or {}).get("name")
+        if sensor_type and sensor_type.upper() != schema.name.upper():
+            continue
+        row = {"timestamp": item.get("timestamp")}
+        for v in item.get("sensordatavalues") or []:
+            if v.get("value_type") in schema.measurements:
+                try:
+                    row[v["value_type"]] = float(v["value"])
+                except (TypeError, ValueError):
+                    pass
+        rows.append(row)
+    df = pd.DataFrame(rows, columns=["timestamp"] + list(schema.measurements))
+    df["timestamp"] = pd.to_datetime(df["timestamp"], utc=True, errors="coerce")
+    return df[df["timestamp"].notna()].drop_duplicates("timestamp").sort_values("timestamp")
+
+
+class LivePoller:
+    """
+    Опрашивает API data.sensor.community по датчикам из конфига раз в interval_s.
+    Запросы идут параллельно через общий пул соединений, с If-None-Match / If-Modified-Since;
+    новые показания (по времени) отправляются во FROST тем же путем, что и архив.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.settings = dict(DEFAULTS)
+        self.settings.update(config.get("live", {}))
+        self.shard = get_shard(config)
+        self.sensors: Dict[Tuple[str, str], LiveSensor] = {}
+        workers = max(1, int(self.settings["concurrency"]))
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="live")
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+    # --- Датчики ---
+
+    def refresh_sensors(self) -> List[LiveSensor]:
+        """Датчики своего шарда из конфига, для которых обычный прогон уже создал ряды во FROST."""
+        configured = {s.name: set(self.config["sensors"].get(s.config_key, {}))
+                      for s in schemas.active_types(self.config)}
+        active = {}
+        for inv, resolved in uploader.STATE.synced_groups(uploader.BASE_URL).items():
+            for sensor_type, sensor in resolved.get("sensors", {}).items():
+                sensor_id = str(sensor["sensor_id"])
+                if sensor_id not in configured.get(sensor_type, ()) or not self.shard.owns(sensor_id):
+                    continue
+                key = (sensor_type, sensor_id)
+                live = self.sensors.get(key)
+                if live is None:
+                    live = LiveSensor(schemas.get_schema(sensor_type), sensor_id, sensor, resolved.get("foi_id"))
+                else:
+                    live.update(sensor, resolved.get("foi_id"))
+                if live.targets():
+                    active[key] = live
+        if set(active) != set(self.sensors):
+            waiting = sum(len(ids) for ids in configured.values()) - len(active)
+            logging.info(f"📡 Polling {len(active)} sensor(s)"
+                         + (f"; {waiting} configured sensor(s) have no series on the server yet "
+                            f"(created by a normal upload)" if waiting > 0 else ""))
+        self.sensors = active
+        return list(active.values())
+
+    # --- Опрос ---
+
+    def _fetch(self, sensor: LiveSensor):
+        """Блокирующий запрос одного датчика (в пуле потоков); None — данные не менялись."""
+        if not sensor.floor_checked:
+            # После перезапуска не отправляем то, что сервер уже получил
+            last = [uploader.get_last_datastream_time(id_, entity) for id_, entity in sensor.targets()]
+            last = [t for t in last if t]
+            sensor.floor = uploader.epoch_ms(max(last)) if last else None
+            sensor.floor_checked = True
+
+        headers = {}
+        if sensor.validators.get("ETag"):
+            headers["If-None-Match"] = sensor.validators["ETag"]
+        if sensor.validators.get("Last-Modified"):
+            headers["If-Modified-Since"] = sensor.validators["Last-Modified"]
+        url = f"{self.settings['url'].rstrip('/')}/{sensor.sensor_id}/"
+        with METRICS.http_timer("live", "poll"):
+            resp = self.session.get(url, headers=headers, timeout=self.settings["timeout_s"])
+        if resp.status_code == 304:
+            METRICS.inc("live_polls_total", result="not_modified")
+            return None
+        resp.raise_for_status()
+        METRICS.inc("live_polls_total", result="ok")
+        sensor.validators = {k: resp.headers[k] for k in ("ETag", "Last-Modified") if resp.headers.get(k)}
+        return resp.json()
+
+    def _new_readings(self, sensor: LiveSensor, payload) -> Dict[str, pd.DataFrame]:
+        """{день: кадр} показаний, которых еще нет ни на сервере, ни среди отправленных."""
+        df = parse_readings(sensor.schema, payload)
+        if df.empty:
+            return {}
+        ms = df["timestamp"].map(lambda t: t.value // 1_000_000)
+        days = df["timestamp"].dt.strftime("%Y-%m-%d")
+        fresh = [(sensor.floor is None or m > sensor.floor) and m not in sensor.seen[d] for m, d in zip(ms, days)]
+        df, days = df[fresh], days[fresh]
+        return {day: part for day, part in df.groupby(days)}
+
+    async def poll_once(self) -> Dict[str, int]:
+        stats = defaultdict(int)
+        sensors = self.refresh_sensors()
+        stats["sensors"] = len(sensors)
+        loop = asyncio.get_running_loop()
+        payloads = await asyncio.gather(*(loop.run_in_executor(self.executor, self._fetch, s) for s in sensors),
+                                        return_exceptions=True)
+
+        batches, owners, sent_times = [], {}, {}
+        for sensor, payload in zip(sensors, payloads):
+            if isinstance(payload, Exception):
+                METRICS.inc("live_polls_total", result="error")
+                logging.warning(f"📡 Poll of {sensor.schema.name} {sensor.sensor_id} failed: {payload}")
+                stats["errors"] += 1
+                continue
+            if payload is None:
+                stats["not_modified"] += 1
+                continue
+            keys = list(sensor.schema.measurements)
+            for day, df in self._new_readings(sensor, payload).items():
+                observations = uploader.build_observations(
+                    df, keys, sensor.ds_ids, sensor.mds_id if uploader.MULTIDATASTREAM else None)
+                if not observations:
+                    continue
+                tag = (sensor.key, day)
+                batches.append((tag, observations))
+                sent_times[tag] = {t.value // 1_000_000 for t in df["timestamp"]}
+                stats["readings"] += len(df)
+                for o in observations:
+                    owners[o[0]] = sensor
+
+        if batches:
+            entity = "MultiDatastream" if uploader.MULTIDATASTREAM else "Datastream"
+
+            def send(chunk):
+                # В пачке наблюдения одного датчика (пачки режутся внутри метки)
+                owner = owners[chunk[0][0]]
+                return uploader.post_observations(chunk, owner.foi_id, owner.schema.name, entity)
+
+            results = await loop.run_in_executor(
+                None, lambda: pump(batches, send, uploader.FLOW,
+                                   reconcile=lambda chunk: uploader.missing_observations(chunk, entity)))
+            with uploader.STATE.batch():
+                for tag, res in results.items():
+                    (key, day), sensor = tag, self.sensors[tag[0]]
+                    stats["observations"] += res["sent"]
+                    stats["failed"] += res["failed"]
+                    if res["sent"]:
+                        uploader.STATE.mark(STAGE_LIVE, key[0], key[1], day, STATUS_DONE)
+                    if not res["failed"]:
+                        # С ошибками — повторим на следующем опросе, пока показания еще в ответе API
+                        sensor.seen[day].update(sent_times[tag])
+            METRICS.inc("live_observations_total", stats["observations"], result="sent")
+            METRICS.inc("live_observations_total", stats["failed"], result="failed")
+
+        self._forget_old_days()
+        return dict(stats)
+
+    def _forget_old_days(self) -> None:
+        cutoff = (datetime.datetime.now(datetime.timezone.utc).date()
+                  - datetime.timedelta(days=SEEN_DAYS)).isoformat()
+        for sensor in self.sensors.values():
+            for day in [d for d in sensor.seen if d < cutoff]:
+                del sensor.seen[day]
+
+    async def run(self, cycles: int = 0) -> None:
+        """Опрос раз в interval_s; cycles > 0 — остановиться после стольких опросов."""
+        done = 0
+        while True:
+            t0 = time.monotonic()
+            stats = await self.poll_once()
+            logging.info(f"📡 Live poll: {stats} in {time.monotonic() - t0:.2f}s")
+            # Поллер работает неделями: отчет и .prom обновляются после каждого опроса, а не на выходе
+            METRICS.write_report(self.config.get("data_dir", "data"), suffix=self.shard.suffix)
+            done += 1
+            if cycles and done >= cycles:
+                return
+            await asyncio.sleep(max(0.0, float(self.settings["interval_s"]) - (time.monotonic() - t0)))
+
+
+def run_live(config, cycles: int = 0) -> None:
+    """
+    Режим почти реального времени: наблюдения датчиков идут во FROST, не дожидаясь файла архива.
+    Когда файл дня появится, обычная загрузка досылает только отсутствующие на сервере времена.
+    """
+    logging.info("--- Starting Live Poller ---")
+    uploader.open_session(config)
+    poller = LivePoller(config)
+    try:
+        asyncio.run(poller.run(cycles))
+    except KeyboardInterrupt:
+        logging.info("📡 Live poller stopped")
+    finally:
+        poller.close()
+        uploader.close_session()
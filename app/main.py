@@ -2,12 +2,19 @@ import logging
 import sys
 import os
 import json
+import argparse
 import datetime
 from datetime import timedelta, timezone
 
-from scraper import scrape_data
-from processor import run_processing
-from uploader import run_upload
+# Этапы (pandas, requests, openpyxl) импортируются лениво — только если этапу есть что делать
+from metrics import METRICS
+from catalog import FileCatalog
+from sharding import apply_shard, normalize_sensor_id
+from statestore import (open_state_store, day_range, STAGE_DOWNLOAD, STAGE_PROCESS, STAGE_UPLOAD,
+                        STATUS_DONE, STATUS_MISSING, META_NO_GROUP)
+import changes
+import profiling
+import schemas
 
 # Настройка логирования
 logging.basicConfig(
@@ -23,156 +30,242 @@ def load_config():
     env_token = os.getenv('MAPBOX_TOKEN')
     if env_token:
         config['mapbox_token'] = env_token
+    # Типы датчиков (SDS011, BME280, ...) описаны в app/schemas.json
+    schemas.load(config.get('schemas_file'))
+    schemas.check_config(config)
     return config
 
 
-# --- РАБОТА СО STATE-ФАЙЛОМ ---
+# Сколько последних дней перепроверять, если архив ответил 404 (файлы публикуются с задержкой)
+MISSING_RECHECK_DAYS = 3
+
+
+# --- РАБОТА СО STATE ---
 
 def get_state_file_path(config):
-    """Возвращает путь к файлу состояния внутри папки data"""
+    """Возвращает путь к старому state.json (нужен только для миграции)"""
     data_dir = config.get('data_dir', 'data')
     os.makedirs(data_dir, exist_ok=True)
     return os.path.join(data_dir, 'state.json')
 
 
-def load_state(state_path):
-    """Читает состояние из JSON файла."""
-    if not os.path.exists(state_path):
-        return {}
-    try:
-        with open(state_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except Exception as e:
-        logging.warning(f"Failed to load state file {state_path}: {e}. Starting clean.")
-        return {}
+def open_state(config):
+    """Открывает state.sqlite; при первом запуске переносит туда историю из state.json."""
+    store = open_state_store(config)
+    legacy_path = get_state_file_path(config)
+    if os.path.exists(legacy_path):
+        with FileCatalog(config.get('data_dir', 'data')) as catalog:
+            store.migrate_from_json(legacy_path, schemas.config_keys(), catalog)
+    return store
 
 
-def save_state(state_path, state_data):
-    """Сохраняет состояние в JSON файл."""
-    try:
-        with open(state_path, 'w', encoding='utf-8') as f:
-            json.dump(state_data, f, indent=4, ensure_ascii=False)
-        logging.info(f"💾 State saved to {state_path}")
-    except Exception as e:
-        logging.error(f"Failed to save state file: {e}")
+# --- ЛОГИКА РАСЧЕТА ДАТ ---
 
+def _needs_download(status, day, recheck_from):
+    if status == STATUS_DONE:
+        return False
+    if status == STATUS_MISSING:
+        # 404 за старые дни окончательный, за последние — файл мог еще не появиться
+        return day >= recheck_from
+    return True  # нет записи или failed
 
-# --- ЛОГИКА РАСЧЕТА ДАТ ---
 
-def prepare_schedule_and_state(config, current_state):
+def prepare_schedule_and_state(config, store):
     """
-    Рассчитывает target_start на основе state.json.
+    Планирует точную оставшуюся работу по state.sqlite:
+    для каждого датчика — дни, которые нужно скачать (days).
     """
     today = datetime.datetime.now(timezone.utc).date()
     today_str = today.strftime("%Y-%m-%d")
+    recheck_from = (today - timedelta(days=config.get('missing_recheck_days', MISSING_RECHECK_DAYS))).strftime(
+        "%Y-%m-%d")
 
     logging.info(f"📅 Daily Job: Today is {today_str}")
 
-    sensor_types = ['sds', 'bme']
-
-    # Готовим объект будущего состояния
-    new_state = current_state.copy()
     at_least_one_task = False
 
-    for s_type in sensor_types:
-        if s_type not in config.get('sensors', {}):
-            continue
-
-        if s_type not in new_state:
-            new_state[s_type] = {}
-
-        sensors = config['sensors'][s_type]
+    for schema in schemas.active_types(config):
+        sensor_type = schema.name
+        sensors = config['sensors'][schema.config_key]
 
         for sensor_id, dates in sensors.items():
-            sensor_id_str = str(sensor_id)
-
-            # --- 1. Определение точки старта ---
-
-            # Дата по умолчанию из конфига
+            # Дата начала из конфига
             try:
                 config_start_dt = datetime.datetime.strptime(dates['start'], "%Y-%m-%d").date()
             except ValueError:
                 config_start_dt = today
+            config_start_str = config_start_dt.strftime("%Y-%m-%d")
 
-            # Проверяем State
-            sensor_state = new_state[s_type].get(sensor_id_str, {})
-            last_downloaded_str = sensor_state.get('last_downloaded')
-
-            target_start = config_start_dt
-
-            if last_downloaded_str:
-                # ВАЖНО: Если данные были скачаны, начинаем со следующего дня
-                try:
-                    last_dt = datetime.datetime.strptime(last_downloaded_str, "%Y-%m-%d").date()
-                    target_start = last_dt + timedelta(days=1)
-                    logging.info(
-                        f"Sensor {sensor_id}: Resuming from state. Last downloaded: {last_dt}. Next start: {target_start}")
-                except ValueError:
-                    logging.warning(f"Sensor {sensor_id}: Corrupted date in state. Using config start.")
-            else:
-                logging.info(f"Sensor {sensor_id}: No history in state. Starting from config: {config_start_dt}")
-                sensor_state['initial_start'] = config_start_dt.strftime("%Y-%m-%d")
+            days = day_range(config_start_dt, today)
+            downloaded = store.statuses(STAGE_DOWNLOAD, sensor_type, sensor_id, start=config_start_str)
+            to_download = [d for d in days if _needs_download(downloaded.get(d), d, recheck_from)]
 
-            # Защита от дат в будущем
-            if target_start > today:
-                logging.info(
-                    f"Sensor {sensor_id}: Data is up to date (Target {target_start} > Today). Skipping scrape.")
-                # Ставим даты так, чтобы скрапер ничего не делал (start > end)
-                config['sensors'][s_type][sensor_id]['start'] = (today + timedelta(days=1)).strftime("%Y-%m-%d")
-                config['sensors'][s_type][sensor_id]['end'] = today_str
-            else:
-                # Нормальный режим
-                config['sensors'][s_type][sensor_id]['start'] = target_start.strftime("%Y-%m-%d")
-                config['sensors'][s_type][sensor_id]['end'] = today_str
+            dates['days'] = to_download
+            # upload_days уточняются после скрапинга (plan_uploads)
+            dates['window_start'] = config_start_str
+            store.touch_sensor(sensor_type, sensor_id, initial_start=config_start_str)
+
+            if to_download:
+                dates['start'], dates['end'] = to_download[0], to_download[-1]
                 at_least_one_task = True
                 logging.info(
-                    f"   👉 Plan for {sensor_id}: {config['sensors'][s_type][sensor_id]['start']} -> {today_str}")
-
-            # --- 2. Обновляем состояние (предварительно) ---
-            # Считаем, что если скрапер отработает, то мы скачаем все вплоть до 'today_str'
-            sensor_state['last_downloaded'] = today_str
-            sensor_state['last_run_timestamp'] = datetime.datetime.now().isoformat()
-
-            new_state[s_type][sensor_id_str] = sensor_state
+                    f"   👉 Plan for {sensor_id}: {len(to_download)} day(s) to download "
+                    f"({to_download[0]} -> {to_download[-1]})")
+            else:
+                # Ставим даты так, чтобы скрапер ничего не делал (start > end)
+                dates['start'], dates['end'] = (today + timedelta(days=1)).strftime("%Y-%m-%d"), today_str
+                logging.info(f"Sensor {sensor_id}: Data is up to date.")
 
-    return config, new_state, at_least_one_task
+    return config, at_least_one_task
 
 
-def main():
+def plan_uploads(config, store, suffix=''):
+    """
+    После скрапинга уточняет upload_days: только дни, которые реально скачаны (download: done),
+    но еще не загружены. Дни с 404 в загрузку не попадают.
+    Дни датчиков без инвентарной группы (по прошлому прогону загрузки) в итог не входят:
+    пока all_stats.xlsx не изменится, загружать их некуда.
+    """
+    no_group = set(json.loads(store.get_meta(META_NO_GROUP + suffix) or "[]"))
+    total = 0
+    for schema in schemas.active_types(config):
+        for sensor_id, dates in config['sensors'][schema.config_key].items():
+            days = store.pending(STAGE_UPLOAD, STAGE_DOWNLOAD, schema.name, sensor_id,
+                                 start=dates.get('window_start'))
+            dates['upload_days'] = days
+            if f"{schema.name}:{normalize_sensor_id(sensor_id)}" not in no_group:
+                total += len(days)
+    return total
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="sensor.community → FROST ETL job")
+    parser.add_argument('--profile', action='store_true', default=os.getenv('ETL_PROFILE') == '1',
+                        help="Профилировать этапы (cProfile + tracemalloc) в data_dir/profiles/<run>/ "
+                             "(или ETL_PROFILE=1)")
+    parser.add_argument('--profile-sampling', action='store_true',
+                        default=os.getenv('ETL_PROFILE_SAMPLING') == '1',
+                        help="Дополнительно писать семплы стеков (collapsed stacks для flamegraph) "
+                             "(или ETL_PROFILE_SAMPLING=1)")
+    parser.add_argument('--reconcile-catalog', action='store_true',
+                        help="Перестроить каталог файлов (data_dir/catalog.sqlite) по диску и выйти")
+    parser.add_argument('--force', action='store_true', default=os.getenv('ETL_FORCE') == '1',
+                        help="Выполнить обработку и загрузку, даже если их входы не менялись (или ETL_FORCE=1)")
+    parser.add_argument('--resync-metadata', action='store_true',
+                        default=os.getenv('ETL_RESYNC_METADATA') == '1',
+                        help="Забыть сохраненные ID сущностей FROST и заново сверить метаданные всех групп "
+                             "(или ETL_RESYNC_METADATA=1)")
+    parser.add_argument('--audit', action='store_true', default=os.getenv('ETL_AUDIT') == '1',
+                        help="Сверить число наблюдений во FROST с архивом ($count по месяцам и дням), "
+                             "догрузить недостающее и выйти (или ETL_AUDIT=1)")
+    parser.add_argument('--live', action='store_true', default=os.getenv('ETL_LIVE') == '1',
+                        help="Режим почти реального времени: опрашивать API data.sensor.community раз в "
+                             "live.interval_s и сразу отправлять новые показания во FROST (или ETL_LIVE=1)")
+    parser.add_argument('--live-cycles', type=int, default=int(os.getenv('ETL_LIVE_CYCLES', '0')),
+                        help="Остановить живой опрос после N опросов (по умолчанию — без остановки)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
     logging.info("🚀 Job started.")
+    config = None
+    shard = None
     try:
         # 1. Загрузка
         config = load_config()
-        state_path = get_state_file_path(config)
-        current_state = load_state(state_path)
-
-        # 2. Расчет
-        config, pending_state, has_tasks = prepare_schedule_and_state(config, current_state)
-
-        # 3. ETL Пайплайн
-
-        # --- A. SCRAPING ---
-        if has_tasks:
-            scrape_data(config)
-            # ВАЖНО: Сохраняем стейт СРАЗУ после успешного скачивания.
-            # Даже если процессинг упадет, мы запомним, что файлы уже у нас.
-            save_state(state_path, pending_state)
-        else:
-            logging.info("💤 Skipping scrape (everything up to date).")
-
-        # --- B. PROCESSING ---
-        # Процессор работает с локальными файлами, он найдет всё, что есть в папке
-        run_processing(config)
-
-        # --- C. UPLOADING ---
-        # Аплоадер сам проверит сервер на дубликаты
-        run_upload(config)
+        if args.reconcile_catalog:
+            with FileCatalog(config.get('data_dir', 'data')) as catalog:
+                catalog.reconcile()
+            return
+
+        # В режиме шардинга воркер видит только свои датчики (ETL_SHARD_INDEX / ETL_SHARD_COUNT)
+        shard = apply_shard(config)
+        if shard.enabled:
+            METRICS.set_const_labels(shard=shard.index)
+        if args.profile or args.profile_sampling:
+            profiling.enable(config.get('data_dir', 'data'), sampling=args.profile_sampling,
+                             run_name=None if not shard.enabled else
+                             f"{datetime.datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}{shard.suffix}")
+        if args.audit:
+            # Отдельный режим: только сверка загруженных дней с сервером
+            from audit import run_audit
+            with METRICS.stage('audit'), profiling.stage('audit'):
+                run_audit(config)
+            logging.info("✅ Audit finished.")
+            METRICS.write_report(config.get('data_dir', 'data'), suffix=shard.suffix)
+            return
+        if args.live:
+            # Отдельный долгоживущий режим; файлы архива потом сверяются обычным прогоном
+            from live import run_live
+            with METRICS.stage('live'), profiling.stage('live'):
+                run_live(config, cycles=args.live_cycles)
+            METRICS.write_report(config.get('data_dir', 'data'), suffix=shard.suffix)
+            return
+
+        with open_state(config) as store:
+            # 2. Расчет
+            config, has_tasks = prepare_schedule_and_state(config, store)
+
+            # 3. ETL Пайплайн
+            # Каждый этап пропускается, если его входы не изменились с последнего успешного прогона
+
+            # --- A. SCRAPING ---
+            if has_tasks:
+                from scraper import scrape_data
+                # Скрапер сам отмечает в state.sqlite результат по каждому дню (done / missing / failed)
+                with METRICS.stage('scrape'), profiling.stage('scrape'):
+                    scrape_data(config)
+            else:
+                logging.info("💤 Skipping scrape (everything up to date).")
+
+            # --- B. PROCESSING ---
+            # Входы процессора: каталог своих датчиков, description.xlsx и настройки геокодера
+            process_fp = changes.processing_fingerprint(config, shard)
+            if args.force or not changes.unchanged(store, STAGE_PROCESS, process_fp, shard.suffix):
+                from processor import run_processing
+                with METRICS.stage('process'), profiling.stage('process'):
+                    processed = run_processing(config)
+                changes.remember(store, STAGE_PROCESS, process_fp if processed else None, shard.suffix)
+            else:
+                logging.info("💤 Skipping processing (archive and description unchanged).")
+
+            # --- B2. LOCAL READ STORE ---
+            # Колоночное хранилище рядов для read API (app/readapi.py) обновляется по изменившимся месяцам
+            if config.get('read_api', {}).get('enabled'):
+                store_fp = changes.catalog_fingerprint(config, shard)
+                if args.force or not changes.unchanged(store, 'tsstore', store_fp, shard.suffix):
+                    from tsstore import update_store
+                    with METRICS.stage('tsstore'), profiling.stage('tsstore'):
+                        update_store(config, shard)
+                    changes.remember(store, 'tsstore', store_fp, shard.suffix)
+
+            # --- C. UPLOADING ---
+            # Загрузка нужна, если есть скачанные, но не загруженные дни или изменились строки all_stats.xlsx
+            # этого шарда
+            upload_days = plan_uploads(config, store, shard.suffix)
+            upload_fp = changes.upload_fingerprint(config, store, shard)
+            config['resync_metadata'] = args.resync_metadata
+            if args.force or args.resync_metadata or upload_days or not changes.unchanged(store, STAGE_UPLOAD, upload_fp, shard.suffix):
+                from uploader import run_upload
+                logging.info(f"📤 {upload_days} day(s) to upload")
+                # Аплоадер сам проверит сервер на дубликаты
+                with METRICS.stage('upload'), profiling.stage('upload'):
+                    uploaded = run_upload(config)
+                changes.remember(store, STAGE_UPLOAD, upload_fp if uploaded else None, shard.suffix)
+            else:
+                logging.info("💤 Skipping upload (nothing new for the server).")
 
         logging.info("✅ Job finished successfully.")
+        METRICS.write_report(config.get('data_dir', 'data'), suffix=shard.suffix)
 
     except Exception as e:
         logging.critical(f"🔥 Job failed: {e}")
+        METRICS.write_report(config.get('data_dir', 'data') if config else 'data', status='failed', error=str(e),
+                             suffix=shard.suffix if shard else '')
         sys.exit(1)
+    finally:
+        profiling.finish()
 
 
 if __name__ == "__main__":
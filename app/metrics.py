@@ -0,0 +1,244 @@
+import os
+import json
+import time
+import logging
+import datetime
+import threading
+from contextlib import contextmanager
+from typing import Dict, Tuple, Optional
+
+# Границы бакетов гистограммы задержек HTTP (секунды)
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC_PREFIX = "sensor_etl_"
+
+
+def _label_key(labels) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape_label(value) -> str:
+    """Значение метки в текстовом формате Prometheus: экранируются \\, " и перевод строки."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _fmt_labels(key, extra=None) -> str:
+    items = list(key) + (list(extra) if extra else [])
+    if not items:
+        return ""
+    body = ",".join(f'{k}="{_escape_label(v)}"' for k, v in items)
+    return "{" + body + "}"
+
+
+def _json_labels(key) -> str:
+    return ",".join(f"{k}={v}" for k, v in key) or "total"
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.total += 1
+        self.sum += value
+        for i, b in enumerate(self.buckets):
+            if value <= b:
+                self.counts[i] += 1
+
+    def to_dict(self) -> Dict:
+        return {
+            "count": self.total,
+            "sum": round(self.sum, 6),
+            "avg": round(self.sum / self.total, 6) if self.total else None,
+            "buckets": {str(b): c for b, c in zip(self.buckets, self.counts)},
+        }
+
+
+class Metrics:
+    """
+    Счетчики, гистограммы и тайминги одного запуска.
+    Потокобезопасен: пишется из пулов потоков геокодера и загрузчика.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.started_at = time.time()
+            self.const_labels: Dict[str, str] = {}
+            self.counters: Dict[Tuple[str, tuple], float] = {}
+            self.gauges: Dict[Tuple[str, tuple], float] = {}
+            self.histograms: Dict[Tuple[str, tuple], Histogram] = {}
+            self.stages: Dict[str, float] = {}
+            self.sensor_timings: Dict[str, Dict[str, float]] = {}
+
+    # --- Запись ---
+
+    def set_const_labels(self, **labels) -> None:
+        """Метки, добавляемые ко всем метрикам в Prometheus-файле (например, номер шарда)."""
+        with self._lock:
+            self.const_labels = {k: str(v) for k, v in labels.items()}
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, _label_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels) -> None:
+        with self._lock:
+            self.gauges[(name, _label_key(labels))] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, _label_key(labels))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def stage(self, name: str):
+        """Замеряет длительность этапа пайплайна (scrape / process / upload ...)."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            dt = time.perf_counter() - t0
+            with self._lock:
+                self.stages[name] = self.stages.get(name, 0.0) + dt
+            logging.info(f"⏱️ Stage '{name}' took {dt:.2f}s")
+
+    @contextmanager
+    def sensor_timer(self, stage: str, sensor_id):
+        """Замеряет работу этапа по одному датчику."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_sensor_time(stage, sensor_id, time.perf_counter() - t0)
+
+    def add_sensor_time(self, stage: str, sensor_id, seconds: float) -> None:
+        with self._lock:
+            per_stage = self.sensor_timings.setdefault(stage, {})
+            per_stage[str(sensor_id)] = per_stage.get(str(sensor_id), 0.0) + seconds
+
+    @contextmanager
+    def http_timer(self, target: str, op: str):
+        """Гистограмма задержек HTTP-запросов к внешним сервисам (archive / mapbox / frost)."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("http_request_duration_seconds", time.perf_counter() - t0, target=target, op=op)
+
+    # --- Чтение ---
+
+    def counter(self, name: str, **labels) -> float:
+        if labels:
+            return self.counters.get((name, _label_key(labels)), 0)
+        return sum(v for (n, _), v in self.counters.items() if n == name)
+
+    def report(self, status: str = "success", error: Optional[str] = None) -> Dict:
+        with self._lock:
+            finished = time.time()
+            counters = {}
+            for (name, key), v in sorted(self.counters.items()):
+                counters.setdefault(name, {})[_json_labels(key)] = v
+            histograms = {}
+            for (name, key), h in sorted(self.histograms.items(), key=lambda kv: kv[0]):
+                histograms.setdefault(name, {})[_json_labels(key)] = h.to_dict()
+            gauges = {}
+            for (name, key), v in sorted(self.gauges.items()):
+                gauges.setdefault(name, {})[_json_labels(key)] = v
+
+            upload_s = self.stages.get("upload", 0.0)
+            observations = sum(v for (n, _), v in self.counters.items() if n == "observations_uploaded_total")
+            return {
+                "status": status,
+                "error": error,
+                "started_at": datetime.datetime.fromtimestamp(self.started_at, datetime.timezone.utc).isoformat(),
+                "finished_at": datetime.datetime.fromtimestamp(finished, datetime.timezone.utc).isoformat(),
+                "duration_s": round(finished - self.started_at, 3),
+                "stages_s": {k: round(v, 3) for k, v in self.stages.items()},
+                "observations_per_s": round(observations / upload_s, 2) if upload_s > 0 else None,
+                "counters": counters,
+                "gauges": gauges,
+                "histograms": histograms,
+                "sensor_timings_s": {st: {s: round(v, 3) for s, v in sorted(per.items())}
+                                     for st, per in self.sensor_timings.items()},
+            }
+
+    def to_prometheus(self, report: Dict) -> str:
+        """Формат textfile-коллектора node_exporter."""
+        lines = []
+        const = tuple(sorted(self.const_labels.items()))
+        with self._lock:
+            for name in sorted({n for n, _ in self.counters}):
+                lines.append(f"# TYPE {METRIC_PREFIX}{name} counter")
+                for (n, key), v in sorted(self.counters.items()):
+                    if n == name:
+                        lines.append(f"{METRIC_PREFIX}{name}{_fmt_labels(key, const)} {v}")
+            for name in sorted({n for n, _ in self.gauges}):
+                lines.append(f"# TYPE {METRIC_PREFIX}{name} gauge")
+                for (n, key), v in sorted(self.gauges.items()):
+                    if n == name:
+                        lines.append(f"{METRIC_PREFIX}{name}{_fmt_labels(key, const)} {v}")
+            for name in sorted({n for n, _ in self.histograms}):
+                lines.append(f"# TYPE {METRIC_PREFIX}{name} histogram")
+                for (n, key), h in sorted(self.histograms.items(), key=lambda kv: kv[0]):
+                    if n != name:
+                        continue
+                    for b, c in zip(h.buckets, h.counts):
+                        lines.append(f"{METRIC_PREFIX}{name}_bucket{_fmt_labels(key, const + (('le', b),))} {c}")
+                    lines.append(f"{METRIC_PREFIX}{name}_bucket{_fmt_labels(key, const + (('le', '+Inf'),))} {h.total}")
+                    lines.append(f"{METRIC_PREFIX}{name}_sum{_fmt_labels(key, const)} {h.sum}")
+                    lines.append(f"{METRIC_PREFIX}{name}_count{_fmt_labels(key, const)} {h.total}")
+
+        c = _fmt_labels(const)
+        lines.append(f"# TYPE {METRIC_PREFIX}stage_duration_seconds gauge")
+        for stage, v in report["stages_s"].items():
+            lines.append(f'{METRIC_PREFIX}stage_duration_seconds{_fmt_labels(const, (("stage", stage),))} {v}')
+        lines.append(f"# TYPE {METRIC_PREFIX}run_duration_seconds gauge")
+        lines.append(f"{METRIC_PREFIX}run_duration_seconds{c} {report['duration_s']}")
+        lines.append(f"# TYPE {METRIC_PREFIX}observations_per_second gauge")
+        lines.append(f"{METRIC_PREFIX}observations_per_second{c} {report['observations_per_s'] or 0}")
+        lines.append(f"# TYPE {METRIC_PREFIX}run_success gauge")
+        lines.append(f"{METRIC_PREFIX}run_success{c} {1 if report['status'] == 'success' else 0}")
+        lines.append(f"# TYPE {METRIC_PREFIX}run_finished_timestamp_seconds gauge")
+        lines.append(f"{METRIC_PREFIX}run_finished_timestamp_seconds{c} {int(time.time())}")
+        return "\n".join(lines) + "\n"
+
+    def write_report(self, data_dir: str, status: str = "success", error: Optional[str] = None,
+                     suffix: str = "") -> Optional[str]:
+        """
+        Пишет run_report.json и sensor_etl.prom в data_dir/metrics (атомарно, через tmp + rename).
+        suffix разделяет файлы воркеров при шардинге.
+        """
+        try:
+            out_dir = os.path.join(data_dir, "metrics")
+            os.makedirs(out_dir, exist_ok=True)
+            report = self.report(status, error)
+            report["labels"] = dict(self.const_labels)
+
+            report_path = os.path.join(out_dir, f"run_report{suffix}.json")
+            _atomic_write(report_path, json.dumps(report, indent=4, ensure_ascii=False))
+            _atomic_write(os.path.join(out_dir, f"sensor_etl{suffix}.prom"), self.to_prometheus(report))
+            logging.info(f"📊 Run report saved to {report_path}")
+            return report_path
+        except Exception as e:
+            logging.error(f"Failed to write run report: {e}")
+            return None
+
+
+def _atomic_write(path: str, text: str) -> None:
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+# Общий реестр метрик процесса
+METRICS = Metrics()
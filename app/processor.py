@@ -1,105 +1,135 @@
 import os
-import time
 import math
-import random
-import requests
+import time
+import itertools
 import pandas as pd
 import logging
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Optional, Tuple, Dict, List
+
+from geocoder import make_geocoder, M_PER_DEG_LAT, M_PER_DEG_LON
+from metrics import METRICS
+from catalog import FileCatalog
+from sharding import get_shard, normalize_sensor_id
+from statestore import open_state_store, STAGE_PROCESS, STATUS_DONE
+import changes
+from schemas import get_schema, active_types
+from transform import file_summaries
+import profiling
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
+# Координаты датчика ближе этого расстояния (дрожание GPS) считаются одной локацией; 0 — точное совпадение
+DEFAULT_CLUSTER_RADIUS_M = 25.0
+
 
 # ______________________Вспомогательные функции_____________________
 
-def scan_dir(root_path, label):
-    logging.info(f'🚀 {label}  ({root_path})')
-    if not os.path.isdir(root_path):
-        logging.warning('   ❌ директория не найдена')
+def scan_dir(catalog, label):
+    logging.info(f'🚀 {label}  ({os.path.join(catalog.data_dir, label)})')
+    # Число файлов и строк берется из каталога, без чтения файлов
+    summary = catalog.summary(label)
+    if not summary:
+        logging.warning('   ❌ в каталоге нет файлов')
         return
 
-    # только под-папки 1-го уровня
-    for entry in sorted(os.listdir(root_path)):
-        sub = os.path.join(root_path, entry)
-        if not os.path.isdir(sub):
-            continue
-
-        files = [f for f in os.listdir(sub) if os.path.isfile(os.path.join(sub, f))]
-        # Подсчет суммарного количества строк во всех файлах
-        total_lines = 0
-        for f in files:
-            file_path = os.path.join(sub, f)
-            try:
-                with open(file_path, 'r', encoding='utf-8') as file:
-                    total_lines += sum(1 for _ in file)
-            except (IOError, UnicodeDecodeError):
-                logging.warning(f'        ⚠️ Не удалось прочитать файл: {f}')
-
-        logging.info(f'   📁 {entry}/  →  {len(files)} файл(ов), суммарная длина: {total_lines} строк')
-
-
-def _read_sensor_csv(path):
-    last_err = None
-    try:
-        df = pd.read_csv(path, sep=';')
-        sub = df[['timestamp', 'lat', 'lon']].copy()
-
-        # приводим типы (учитываем возможные десятичные запятые)
-        sub['lat'] = pd.to_numeric(sub['lat'].astype(str).str.replace(',', '.'), errors='coerce')
-        sub['lon'] = pd.to_numeric(sub['lon'].astype(str).str.replace(',', '.'), errors='coerce')
-        sub['timestamp'] = pd.to_datetime(sub['timestamp'], errors='coerce', utc=False)
-
-        sub = sub.dropna(subset=['timestamp', 'lat', 'lon'])
-
-        return sub  # успех
-    except Exception as e:
-        last_err = f'{type(e).__name__}: {e}'
-
-    # если ничего не подошло — даём понять вызывающему коду
-    raise RuntimeError(f'Не удалось прочитать {os.path.basename(path)}. Последняя ошибка: {last_err}')
-
-
-def process_root(root_path, sensor_type):
-    """Собирает строки результата для одной корневой папки типа датчика."""
+    for s in summary:
+        logging.info(f'   📁 {s["sensor_id"]}/  →  {s["files"]} файл(ов), суммарная длина: {s["rows"]} строк данных')
+
+
+def _merge_bounds(bounds, mn, mx):
+    if pd.notna(mn) and (pd.isna(bounds[0]) or mn < bounds[0]):
+        bounds[0] = mn
+    if pd.notna(mx) and (pd.isna(bounds[1]) or mx > bounds[1]):
+        bounds[1] = mx
+
+
+def cluster_locations(loc_bounds, radius_m, anchors=()):
+    """
+    Сводит координаты одного датчика, отличающиеся меньше чем на radius_m, в одну локацию
+    с объединенными границами first_seen / last_seen: {(lat, lon): [min_ts, max_ts]} → то же.
+    anchors — центры прошлого прогона (из all_stats.xlsx): они остаются центрами, пока к ним
+    относится хоть одна точка, иначе дозагрузка более старого дня сдвинула бы центр и локация
+    во FROST задвоилась бы. Новые центры — самые ранние из оставшихся точек.
+    Соседи ищутся по сетке с ячейкой radius_m (окно 3x3), без попарного сравнения всех точек.
+    """
+    if radius_m <= 0 or (len(loc_bounds) < 2 and not anchors):
+        return loc_bounds
+
+    def first_seen(item):
+        (lat, lon), (mn, _) = item
+        return (pd.isna(mn), mn if pd.notna(mn) else pd.Timestamp.min, lat, lon)
+
+    items = [(a, None) for a in dict.fromkeys(anchors)] + sorted(loc_bounds.items(), key=first_seen)
+    cos_ref = max(math.cos(math.radians(items[0][0][0])), 0.01)
+    cell_lat = radius_m / M_PER_DEG_LAT
+    cell_lon = radius_m / (M_PER_DEG_LON * cos_ref)
+    limit_sq = radius_m ** 2
+
+    grid = {}  # ячейка сетки -> индексы центров
+    centers, bounds = [], []
+    for (lat, lon), point in items:
+        i, j = math.floor(lat / cell_lat), math.floor(lon / cell_lon)
+        m_per_deg_lon = M_PER_DEG_LON * math.cos(math.radians(lat))
+        best, best_d = None, limit_sq
+        for di in (-1, 0, 1):
+            for dj in (-1, 0, 1):
+                for k in grid.get((i + di, j + dj), ()):
+                    dy = (lat - centers[k][0]) * M_PER_DEG_LAT
+                    dx = (lon - centers[k][1]) * m_per_deg_lon
+                    d = dx * dx + dy * dy
+                    if d <= best_d:
+                        best, best_d = k, d
+        if best is None:
+            grid.setdefault((i, j), []).append(len(centers))
+            centers.append((lat, lon))
+            bounds.append(None if point is None else list(point))
+        elif point is None:
+            continue  # прошлые центры ближе radius_m друг к другу (радиус увеличили) — хватит первого
+        elif bounds[best] is None:
+            bounds[best] = list(point)
+        else:
+            _merge_bounds(bounds[best], *point)
+    # Центр прошлого прогона без единой точки (файлы удалены) больше не нужен
+    return {c: b for c, b in zip(centers, bounds) if b is not None}
+
+
+def process_root(catalog, sensor_type, shard=None, radius_m=DEFAULT_CLUSTER_RADIUS_M, anchors=None):
+    """
+    Собирает строки результата для одного типа датчика по файлам из каталога (только датчики своего шарда).
+    Близкие координаты датчика (в пределах radius_m) сводятся в одну локацию;
+    anchors — центры локаций прошлого прогона {(тип, номер): [(lat, lon), ...]}.
+    """
+    anchors = anchors or {}
     rows = []
-    if not os.path.isdir(root_path):
-        return rows
+    schema = get_schema(sensor_type)
+    raw_count = 0
 
-    for entry in sorted(os.listdir(root_path)):
-        sub = os.path.join(root_path, entry)
-        if not os.path.isdir(sub):
+    for sensor_id, entries in itertools.groupby(catalog.files(sensor_type), key=lambda r: r['sensor_id']):
+        if shard is not None and not shard.owns(sensor_id):
             continue
-
-        sensor_id = entry.strip()
-        csv_files = sorted([f for f in os.listdir(sub) if f.lower().endswith('.csv')])
-        days_count = len(csv_files)  # по условию = количеству файлов
+        entries = list(entries)
+        days_count = len(entries)  # по условию = количеству файлов
         if days_count == 0:
             continue
+        sensor_t0 = time.perf_counter()
 
         # границы появления по каждой точной паре (lat, lon)
         loc_bounds = {}  # (lat, lon) -> [min_ts, max_ts]
 
-        for fname in csv_files:
-            fpath = os.path.join(sub, fname)
-            try:
-                df = _read_sensor_csv(fpath)
-            except Exception:
-                # пропускаем проблемные файлы, чтобы не ронять процесс
-                continue
-
-            g = df.groupby(['lat', 'lon'])['timestamp'].agg(['min', 'max']).reset_index()
-            for _, r in g.iterrows():
-                key = (float(r['lat']), float(r['lon']))
-                mn, mx = pd.Timestamp(r['min']), pd.Timestamp(r['max'])
+        # Читаются только новые файлы (проблемные пропускаются), границы остальных — из каталога
+        for _, summary in file_summaries(catalog, schema, entries):
+            for lat, lon, first, last in summary['bounds']:
+                key = (lat, lon)
+                mn, mx = pd.Timestamp(first), pd.Timestamp(last)
                 if key not in loc_bounds:
                     loc_bounds[key] = [mn, mx]
                 else:
-                    if pd.notna(mn) and (pd.isna(loc_bounds[key][0]) or mn < loc_bounds[key][0]):
-                        loc_bounds[key][0] = mn
-                    if pd.notna(mx) and (pd.isna(loc_bounds[key][1]) or mx > loc_bounds[key][1]):
-                        loc_bounds[key][1] = mx
+                    _merge_bounds(loc_bounds[key], mn, mx)
+
+        # дрожание GPS: близкие пары сводятся в одну локацию
+        raw_count += len(loc_bounds)
+        loc_bounds = cluster_locations(loc_bounds, radius_m,
+                                       anchors.get((sensor_type, normalize_sensor_id(sensor_id)), ()))
 
         # формируем строки результата по всем локациям датчика
         for (lat, lon), (mn, mx) in loc_bounds.items():
@@ -112,189 +142,28 @@ def process_root(root_path, sensor_type):
                 'first_seen': mn.strftime('%Y-%m-%dT%H:%M:%S') if pd.notna(mn) else None,
                 'last_seen': mx.strftime('%Y-%m-%dT%H:%M:%S') if pd.notna(mx) else None,
             })
+        METRICS.add_sensor_time('process', sensor_id, time.perf_counter() - sensor_t0)
 
+    if raw_count > len(rows):
+        METRICS.inc('locations_merged_total', raw_count - len(rows), sensor_type=sensor_type)
+        logging.info(f'   📍 {sensor_type}: {raw_count} пар координат → {len(rows)} локаций (радиус {radius_m} м)')
     return rows
 
 
-# ____________________Геокодирование_______________________
-
-MAPBOX_ENDPOINT = "https://api.mapbox.com/geocoding/v5/mapbox.places/{lon},{lat}.json"
-DEFAULT_THREADS = 8
-MAX_RETRIES = 5
-TIMEOUT_SEC = 12
-
-FALLBACK_TYPES: List[Optional[str]] = [
-    "address,street,neighborhood,locality,place,region,postcode,poi",
-    "address,street,place,region,postcode",
-    None
-]
-
-
-def _mk_session() -> requests.Session:
-    s = requests.Session()
-    s.headers.update({"User-Agent": "mapbox-revgeo-ru/1.2"})
-    return s
-
-
-def _sleep_backoff(attempt: int, retry_after: Optional[str] = None) -> None:
-    if retry_after:
-        try:
-            time.sleep(min(60.0, float(retry_after)));
-            return
-        except ValueError:
-            pass
-    time.sleep(0.5 * (2 ** attempt) + random.uniform(0, 0.25))
-
-
-def _coerce_float(x):
+def previous_centers(path):
+    """Центры локаций из прошлого all_stats.xlsx: {(тип, номер): [(lat, lon), ...]} в порядке first_seen."""
+    if not os.path.exists(path):
+        return {}
     try:
-        if x is None: return None
-        if isinstance(x, (float, int)): return float(x)
-        return float(str(x).strip().replace(",", "."))
-    except Exception:
-        return None
-
-
-def _looks_swapped(lat: Optional[float], lon: Optional[float]) -> bool:
-    if lat is None or lon is None:
-        return False
-    lat_ok = 40.0 <= lat <= 82.0
-    lon_ok = (19.0 <= lon <= 180.0) or (-180.0 <= lon <= -169.0)
-    lat_like_lon = (19.0 <= lat <= 180.0) or (-180.0 <= lat <= -169.0)
-    lon_like_lat = 40.0 <= lon <= 82.0
-    return (not lat_ok and not lon_ok) and (lat_like_lon and lon_like_lat)
-
-
-def _reverse_once(session: requests.Session, token: str, lon: float, lat: float,
-                  *, language: str, country: Optional[str], types: Optional[str]) -> Optional[str]:
-    url = MAPBOX_ENDPOINT.format(lon=str(lon), lat=str(lat))
-    params = {
-        "access_token": token,
-        "language": language,
-        "limit": 1,
-    }
-    if country:
-        params["country"] = country
-    if types:
-        params["types"] = types
-
-    for attempt in range(MAX_RETRIES):
-        try:
-            r = session.get(url, params=params, timeout=TIMEOUT_SEC)
-            if r.status_code == 200:
-                data = r.json()
-                feats = data.get("features") or []
-                return feats[0].get("place_name") if feats else None
-            if r.status_code in (429, 500, 502, 503, 504):
-                _sleep_backoff(attempt, r.headers.get("Retry-After"));
-                continue
-            if r.status_code in (401, 403):
-                raise RuntimeError(f"Mapbox auth error {r.status_code}: {r.text[:200]}")
-            if r.status_code in (400, 404, 422):
-                return None
-            _sleep_backoff(attempt)
-        except requests.RequestException:
-            _sleep_backoff(attempt)
-    return None
-
-
-def reverse_geocode_point(token: str, lon: float, lat: float,
-                          *, language: str = "ru", country: Optional[str] = "ru") -> Optional[str]:
-    session = _mk_session()
-    for t in FALLBACK_TYPES:
-        addr = _reverse_once(session, token, lon, lat, language=language, country=country, types=t)
-        if addr: return addr
-    for t in FALLBACK_TYPES:
-        addr = _reverse_once(session, token, lon, lat, language=language, country=None, types=t)
-        if addr: return addr
-    for dx, dy in ((1e-4, 0), (-1e-4, 0), (0, 1e-4), (0, -1e-4)):
-        for t in FALLBACK_TYPES:
-            addr = _reverse_once(session, token, lon + dx, lat + dy, language=language, country=country, types=t)
-            if addr: return addr
-    return None
-
-
-def _preflight(token: str) -> None:
-    addr = reverse_geocode_point(token, 37.6175, 55.7520, country="ru")
-    if not addr:
-        raise RuntimeError("Preflight: не получили адрес по тестовой точке. Проверьте токен Mapbox.")
-
-
-def reverse_geocode_mapbox_bulk(
-        df: pd.DataFrame,
-        *,
-        token: Optional[str] = None,
-        lat_col: str = "lat",
-        lon_col: str = "lon",
-        threads: int = DEFAULT_THREADS,
-        language: str = "ru",
-        country: Optional[str] = "ru",
-        autoswap: bool = True,
-        do_preflight: bool = True
-) -> pd.Series:
-    if not token:
-        raise ValueError("Нет токена Mapbox.")
-
-    if lat_col not in df.columns or lon_col not in df.columns:
-        raise ValueError(f"В df нет колонок '{lat_col}' и/или '{lon_col}'.")
-
-    lats = df[lat_col].map(_coerce_float)
-    lons = df[lon_col].map(_coerce_float)
-
-    if do_preflight:
-        _preflight(token)
-
-    coords = []
-    for lat, lon in zip(lats, lons):
-        if autoswap and _looks_swapped(lat, lon):
-            coords.append((lat, lon, True))
-        else:
-            coords.append((lat, lon, False))
-
-    session = _mk_session()
-    cache: Dict[Tuple[float, float], Optional[str]] = {}
-    results = [None] * len(df)
-    idx_map = list(df.index)
-
-    def _resolve_one(lon: float, lat: float) -> Optional[str]:
-        for t in FALLBACK_TYPES:
-            a = _reverse_once(session, token, lon, lat, language=language, country=country, types=t)
-            if a: return a
-        for t in FALLBACK_TYPES:
-            a = _reverse_once(session, token, lon, lat, language=language, country=None, types=t)
-            if a: return a
-        for dx, dy in ((1e-4, 0), (-1e-4, 0), (0, 1e-4), (0, -1e-4)):
-            for t in FALLBACK_TYPES:
-                a = _reverse_once(session, token, lon + dx, lat + dy, language=language, country=country, types=t)
-                if a: return a
-        return None
-
-    futures = {}
-    with ThreadPoolExecutor(max_workers=max(1, int(threads))) as ex:
-        for i, (lat, lon, swapped) in enumerate(coords):
-            if lat is None or lon is None or (isinstance(lat, float) and math.isnan(lat)) or (
-                    isinstance(lon, float) and math.isnan(lon)):
-                results[i] = None;
-                continue
-
-            use_lat, use_lon = (lon, lat) if swapped else (lat, lon)
-            key = (use_lon, use_lat)
-            if key in cache:
-                results[i] = cache[key];
-                continue
-            fut = ex.submit(_resolve_one, use_lon, use_lat)
-            futures[fut] = (i, key)
-
-        for fut in as_completed(futures):
-            i, key = futures[fut]
-            try:
-                addr = fut.result()
-            except Exception:
-                addr = None
-            cache[key] = addr
-            results[i] = addr
-
-    return pd.Series(results, index=idx_map, name="address_ru")
+        prev = pd.read_excel(path, usecols=['sensor_type', 'sensor_id', 'lat', 'lon', 'first_seen'])
+    except Exception as e:
+        logging.warning(f"Previous location centers are not available ({path}): {e}")
+        return {}
+    centers = {}
+    for row in prev.dropna(subset=['sensor_id', 'lat', 'lon']).sort_values('first_seen').itertuples(index=False):
+        key = (str(row.sensor_type), normalize_sensor_id(row.sensor_id))
+        centers.setdefault(key, []).append((float(row.lat), float(row.lon)))
+    return centers
 
 
 def norm_id_to_int(s: pd.Series) -> pd.Series:
@@ -306,41 +175,50 @@ def norm_id_to_int(s: pd.Series) -> pd.Series:
 # ______________________Основная функция________________________
 
 def run_processing(config):
+    """Строит all_stats.xlsx; возвращает True, если файл записан."""
     logging.info("--- Starting Processing ---")
     data_dir = config['data_dir']
-    mapbox_token = config.get('mapbox_token')
+    # Провайдер выбирается в config.json (mapbox / offline), ошибки конфигурации — до сканирования
+    geocoder = make_geocoder(config)
 
-    if not mapbox_token:
-        logging.error("Mapbox token not found in config")
-        raise ValueError("Mapbox token missing")
-
-    folder_sds = os.path.join(data_dir, 'SDS011')
-    folder_bme = os.path.join(data_dir, 'BME280')
+    catalog = FileCatalog(data_dir)
+    shard = get_shard(config)
     output_xlsx = os.path.join(data_dir, 'all_stats.xlsx')
     description_path = os.path.join(data_dir, 'description.xlsx')  # Предполагаем, что файл описания тоже в data
 
+    sensor_types = [s.name for s in active_types(config)]
+    radius_m = float(config.get('location_cluster_radius_m', DEFAULT_CLUSTER_RADIUS_M))
+
     # 1. Статистика
-    scan_dir(folder_sds, 'SDS011')
-    scan_dir(folder_bme, 'BME280')
+    for sensor_type in sensor_types:
+        scan_dir(catalog, sensor_type)
 
     # 2. Сбор данных
+    # Центры локаций прошлого прогона не сдвигаются: иначе во FROST появились бы новые Locations
+    anchors = previous_centers(output_xlsx) if radius_m > 0 else {}
     all_rows = []
-    all_rows.extend(process_root(folder_sds, 'SDS011'))
-    all_rows.extend(process_root(folder_bme, 'BME280'))
+    for sensor_type in sensor_types:
+        all_rows.extend(process_root(catalog, sensor_type, shard, radius_m, anchors))
+    processed_days = [(t, e['sensor_id'], e['day']) for t in sensor_types
+                      for e in catalog.files(t) if shard.owns(e['sensor_id'])]
+    catalog.close()
 
     df = pd.DataFrame(all_rows)
 
     if df.empty:
+        geocoder.close()
         logging.warning('⚠️ Итоговая таблица пуста. Проверьте пути и содержимое.')
-        return
+        return False
 
     df = df.sort_values(['sensor_type', 'sensor_id', 'first_seen', 'lat', 'lon']).reset_index(drop=True)
 
     # 3. Добавление адреса (Геокодинг)
-    logging.info("Starting Reverse Geocoding...")
-    df["address"] = reverse_geocode_mapbox_bulk(
-        df, token=mapbox_token, lat_col="lat", lon_col="lon", threads=8
-    )
+    logging.info(f"Starting Reverse Geocoding ({geocoder.name})...")
+    try:
+        with METRICS.stage('geocode'), profiling.stage('geocode'):
+            df["address"] = geocoder.reverse_bulk(df, lat_col="lat", lon_col="lon")
+    finally:
+        geocoder.close()
 
     # Сохраняем промежуточный результат (опционально)
     # archive_stats_path = os.path.join(data_dir, 'archive_stats.xlsx')
@@ -354,28 +232,52 @@ def run_processing(config):
             description_path = local_desc
         else:
             logging.error(f"Description file not found at {description_path}")
-            return
+            return False
 
     logging.info(f"Merging with {description_path}...")
     try:
         description = pd.read_excel(description_path)
     except Exception as e:
         logging.error(f"Failed to read description file: {e}")
-        return
-
-    d1 = description[['Инвентарный номер изделия', 'Тип', 'Марка',
-                      'Номер процессора', 'SDS011']]
-    d1 = d1.rename(columns={'SDS011': 'sensor_id'}).dropna()
+        return False
 
-    d2 = description[['Инвентарный номер изделия', 'Тип', 'Марка',
-                      'Номер процессора', 'BME280']]
-    d2 = d2.rename(columns={'BME280': 'sensor_id'}).dropna()
-    d12 = pd.concat([d1, d2], axis=0)
+    # В description.xlsx у каждого типа датчика своя колонка с номером (SDS011, BME280, ...)
+    parts = []
+    for sensor_type in sensor_types:
+        column = get_schema(sensor_type).description_column
+        if column not in description.columns:
+            logging.warning(f"Column {column} not found in {description_path}")
+            continue
+        d = description[['Инвентарный номер изделия', 'Тип', 'Марка',
+                         'Номер процессора', column]]
+        parts.append(d.rename(columns={column: 'sensor_id'}).dropna())
+    if not parts:
+        logging.error(f"No sensor columns in {description_path}")
+        return False
+    d12 = pd.concat(parts, axis=0)
 
     df['sensor_id'] = norm_id_to_int(df['sensor_id'])
     d12['sensor_id'] = norm_id_to_int(d12['sensor_id'])
 
     all_stats = pd.merge(df, d12, how='left', on='sensor_id')
-    all_stats.to_excel(output_xlsx, index=False)
+    with shard.lease(data_dir, 'all_stats'):
+        if shard.enabled and os.path.exists(output_xlsx):
+            # Вливаем свою часть в общий файл: строки чужих датчиков сохраняются как есть
+            existing = pd.read_excel(output_xlsx)
+            others = existing[~existing['sensor_id'].map(shard.owns)]
+            all_stats = pd.concat([others, all_stats], ignore_index=True)
+            all_stats = all_stats.sort_values(['sensor_type', 'sensor_id', 'first_seen', 'lat', 'lon'])
+        tmp_xlsx = f'{os.path.splitext(output_xlsx)[0]}{shard.suffix}.tmp.xlsx'
+        all_stats.to_excel(tmp_xlsx, index=False)
+        os.replace(tmp_xlsx, output_xlsx)
+        # Отпечатки считаются по тому, что прочитает загрузчик, — по записанному файлу
+        with open_state_store(config) as store:
+            changes.remember_all_stats(store, pd.read_excel(output_xlsx), shard)
+
+    # Дни, вошедшие в all_stats, отмечаются одной транзакцией
+    with open_state_store(config) as store, store.batch():
+        for sensor_type, sensor_id, day in processed_days:
+            store.mark(STAGE_PROCESS, sensor_type, sensor_id, day, STATUS_DONE)
     logging.info(f'✅ Готово: {output_xlsx} | строк: {len(all_stats)}')
-    logging.info("--- Processing Finished ---")
\ No newline at end of file
+    logging.info("--- Processing Finished ---")
+    return True
\ No newline at end of file
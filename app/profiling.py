@@ -0,0 +1,200 @@
+import os
+import io
+import sys
+import time
+import pstats
+import cProfile
+import logging
+import datetime
+import threading
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from typing import Optional, List
+
+# Активная сессия профилирования; None — режим выключен и stage() ничего не делает
+PROFILER = None
+_NULL = nullcontext()
+
+TOP_ALLOCATIONS = 25
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+
+class _Sampler(threading.Thread):
+    """
+    Семплирующий профайлер: снимает стеки всех потоков процесса (пулы скрапера, геокодера,
+    живого опроса) и копит их в формате collapsed stacks; корень стека — имя потока.
+    """
+
+    def __init__(self, interval: float):
+        super().__init__(daemon=True, name="profiling-sampler")
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                    frame = frame.f_back
+                if stack:
+                    stack.append(f"thread:{names.get(thread_id, thread_id)}")
+                    self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.join()
+
+
+class StageProfiler:
+    """
+    Профилирует этапы ETL: cProfile (pstats), пик памяти и топ мест аллокаций (tracemalloc),
+    опционально — семплирующий профайлер. Результаты: data_dir/profiles/<run>/<stage>.*
+    cProfile видит только поток, в котором идет этап: время в пулах потоков там выглядит
+    как ожидание future. Работу воркеров показывает семплер (--profile-sampling) — он снимает все потоки.
+    """
+
+    def __init__(self, out_dir: str, sampling: bool = False, interval: float = DEFAULT_SAMPLE_INTERVAL):
+        self.out_dir = out_dir
+        self.sampling = sampling
+        self.interval = interval
+        self.stages: List[str] = []
+        # Стек активных этапов: вложенный этап (geocode внутри process) ставит родителя на паузу
+        self._active = []
+        os.makedirs(out_dir, exist_ok=True)
+
+    @contextmanager
+    def stage(self, name: str):
+        parent = self._active[-1] if self._active else None
+        if parent:
+            parent["profile"].disable()
+            parent["peak"] = max(parent["peak"], tracemalloc.get_traced_memory()[1])
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        mem_before = tracemalloc.get_traced_memory()[0]
+
+        sampler = None
+        if self.sampling:
+            sampler = _Sampler(self.interval)
+            sampler.start()
+
+        entry = {"name": name, "profile": cProfile.Profile(), "peak": 0}
+        self._active.append(entry)
+        t0 = time.perf_counter()
+        entry["profile"].enable()
+        try:
+            yield
+        finally:
+            entry["profile"].disable()
+            elapsed = time.perf_counter() - t0
+            self._active.pop()
+            if sampler:
+                sampler.stop()
+
+            current, peak = tracemalloc.get_traced_memory()
+            peak = max(peak, entry["peak"])
+            snapshot = tracemalloc.take_snapshot()
+            self._dump(name, entry["profile"], snapshot, elapsed, peak - mem_before, current - mem_before, sampler)
+
+            if parent:
+                parent["peak"] = max(parent["peak"], peak)
+                tracemalloc.reset_peak()
+                parent["profile"].enable()
+
+    def _dump(self, name, profile, snapshot, elapsed, peak, delta, sampler) -> None:
+        base = os.path.join(self.out_dir, name)
+        profile.dump_stats(f"{base}.pstats")
+
+        stats = snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        )).statistics("lineno")
+        with open(f"{base}.memory.txt", "w", encoding="utf-8") as f:
+            f.write(f"stage: {name}\n")
+            f.write(f"elapsed_s: {elapsed:.3f}\n")
+            f.write(f"peak_mb: {peak / 1024 / 1024:.2f}\n")
+            f.write(f"retained_mb: {delta / 1024 / 1024:.2f}\n\n")
+            f.write(f"Top {TOP_ALLOCATIONS} allocation sites:\n")
+            for stat in stats[:TOP_ALLOCATIONS]:
+                f.write(f"{stat}\n")
+
+        if sampler is not None:
+            with open(f"{base}.folded", "w", encoding="utf-8") as f:
+                for stack, count in sampler.stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+
+        if name not in self.stages:
+            self.stages.append(name)
+        logging.info(f"🔬 Profile for '{name}': {elapsed:.2f}s, peak {peak / 1024 / 1024:.1f} MB → {base}.*")
+
+    def finish(self) -> None:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        summary = summarize(self.out_dir)
+        with open(os.path.join(self.out_dir, "summary.txt"), "w", encoding="utf-8") as f:
+            f.write(summary)
+        logging.info(f"🔬 Profiling summary saved to {os.path.join(self.out_dir, 'summary.txt')}")
+
+
+def enable(data_dir: str, *, sampling: bool = False, interval: float = DEFAULT_SAMPLE_INTERVAL,
+           run_name: Optional[str] = None) -> StageProfiler:
+    """Включает профилирование этапов для текущего процесса."""
+    global PROFILER
+    run_name = run_name or datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    PROFILER = StageProfiler(os.path.join(data_dir, "profiles", run_name), sampling=sampling, interval=interval)
+    logging.info(f"🔬 Profiling enabled → {PROFILER.out_dir}")
+    return PROFILER
+
+
+def finish() -> None:
+    global PROFILER
+    if PROFILER is not None:
+        PROFILER.finish()
+        PROFILER = None
+
+
+def stage(name: str):
+    """Контекст этапа. Когда профилирование выключено, возвращает общий nullcontext — накладных расходов нет."""
+    if PROFILER is None:
+        return _NULL
+    return PROFILER.stage(name)
+
+
+def summarize(run_dir: str, top: int = 15) -> str:
+    """Топ «горячих» функций по каждому этапу (по собственному и накопленному времени)."""
+    out = io.StringIO()
+    for fname in sorted(os.listdir(run_dir)):
+        if not fname.endswith(".pstats"):
+            continue
+        stage_name = fname[:-len(".pstats")]
+        out.write(f"===== {stage_name} =====\n")
+
+        mem_path = os.path.join(run_dir, f"{stage_name}.memory.txt")
+        if os.path.exists(mem_path):
+            with open(mem_path, "r", encoding="utf-8") as f:
+                head = [f.readline().strip() for _ in range(4)]
+            out.write("  ".join(h for h in head[1:] if h) + "\n")
+
+        stats = pstats.Stats(os.path.join(run_dir, fname), stream=out)
+        stats.strip_dirs()
+        out.write(f"\n-- top {top} by tottime --\n")
+        stats.sort_stats("tottime").print_stats(top)
+        out.write(f"-- top {top} by cumulative --\n")
+        stats.sort_stats("cumulative").print_stats(top)
+    return out.getvalue()
+
+
+if __name__ == "__main__":
+    # python app/profiling.py data/profiles/<run> [top]
+    if len(sys.argv) < 2:
+        print("Usage: python app/profiling.py <profiles/run_dir> [top]")
+        sys.exit(1)
+    print(summarize(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 15))
@@ -0,0 +1,352 @@
+import re
+import sys
+import json
+import hashlib
+import logging
+import argparse
+import datetime
+import threading
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit, parse_qs, quote
+
+import schemas
+from tsstore import TimeSeriesStore, ROLLUPS
+
+API_VERSION = "v1.1"
+DEFAULT_PORT = 8090
+DEFAULT_TOP = 100
+MAX_TOP = 10000
+OBSERVATION_TYPE = "http://www.opengis.net/def/observationType/OGC-OM/2.0/OM_Measurement"
+
+_ENTITY_RE = re.compile(r"^/Datastreams\('?([^')]+)'?\)(/Observations)?$")
+# Смещение "+03:00" без кодирования в URL приходит после parse_qs как " 03:00"
+_TIME_COND_RE = re.compile(r"phenomenonTime\s+(ge|gt|le|lt|eq)\s+([0-9T:\-.Z+]+(?: \d{2}:\d{2})?)", re.IGNORECASE)
+_PROP_COND_RE = re.compile(r"properties/(\w+)\s+eq\s+'([^']*)'", re.IGNORECASE)
+
+
+class ApiError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def _iso(epoch: int) -> str:
+    return datetime.datetime.fromtimestamp(int(epoch), datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _parse_time(value: str) -> int:
+    try:
+        dt = datetime.datetime.fromisoformat(value.replace("Z", "+00:00").replace(" ", "+"))
+    except ValueError:
+        raise ApiError(400, f"Invalid time: {value}")
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return int(dt.timestamp())
+
+
+def parse_time_filter(flt: str) -> Tuple[Optional[int], Optional[int]]:
+    """
+    $filter из условий по phenomenonTime, соединенных and → (start, end) включительно, epoch UTC.
+    Любое другое условие (or, not, другие свойства) — 400, а не молча отброшенная часть фильтра.
+    """
+    start, end = None, None
+    for cond in re.split(r"\s+and\s+", flt.strip(), flags=re.IGNORECASE):
+        m = _TIME_COND_RE.fullmatch(cond.strip().strip("()").strip())
+        if not m:
+            raise ApiError(400, f"Unsupported $filter condition: {cond.strip() or flt}")
+        t, op = _parse_time(m.group(2)), m.group(1).lower()
+        if op in ("ge", "gt", "eq"):
+            t0 = t + 1 if op == "gt" else t
+            start = t0 if start is None else max(start, t0)
+        if op in ("le", "lt", "eq"):
+            t1 = t - 1 if op == "lt" else t
+            end = t1 if end is None else min(end, t1)
+    return start, end
+
+
+def datastream_id(sensor_type: str, sensor_id, column: str, rollup: Optional[str] = None) -> str:
+    """SDS011-82312-P1, агрегаты — SDS011-82312-P1-1h."""
+    return "-".join([sensor_type, str(sensor_id), column] + ([rollup] if rollup else []))
+
+
+def parse_datastream_id(ds_id: str) -> Tuple[str, str, str, Optional[str]]:
+    parts = ds_id.split("-")
+    if len(parts) not in (3, 4) or (len(parts) == 4 and parts[3] not in ROLLUPS):
+        raise ApiError(404, f"Datastream {ds_id} not found")
+    sensor_type, sensor_id, column = parts[:3]
+    # Номер датчика становится частью пути в хранилище — только цифры
+    if not re.fullmatch(r"[0-9]+", sensor_id):
+        raise ApiError(404, f"Datastream {ds_id} not found")
+    try:
+        schema = schemas.get_schema(sensor_type)
+    except ValueError:
+        raise ApiError(404, f"Datastream {ds_id} not found")
+    if column not in schema.measurements:
+        raise ApiError(404, f"Datastream {ds_id} not found")
+    return sensor_type, sensor_id, column, parts[3] if len(parts) == 4 else None
+
+
+class ResponseCache:
+    """LRU готовых ответов; ключ включает версию хранилища, поэтому после обновления кэш не отдает старое."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._data: "OrderedDict[Tuple, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key) -> Optional[bytes]:
+        with self._lock:
+            body = self._data.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, key, body: bytes) -> None:
+        with self._lock:
+            self._data[key] = body
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+
+class ReadAPI:
+    """
+    Только чтение, подмножество SensorThings API поверх TimeSeriesStore:
+    /v1.1/Datastreams, /v1.1/Datastreams('<id>'), /v1.1/Datastreams('<id>')/Observations
+    с $filter по phenomenonTime, $orderby, $top, $skip, $count и $resultFormat=dataArray.
+    Агрегаты (1h / 1d) — отдельные Datastreams с суффиксом -1h / -1d: result — среднее,
+    parameters — min / max / count.
+    """
+
+    def __init__(self, data_dir: str, cache_size: int = 512, max_top: int = MAX_TOP):
+        self.store = TimeSeriesStore(data_dir)
+        self.cache = ResponseCache(cache_size)
+        self.max_top = max_top
+
+    def get(self, path: str, base_url: str) -> Tuple[int, bytes, str]:
+        """Возвращает (status, body, etag)."""
+        key = (self.store.version(), path, base_url)
+        etag = '"' + hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:20] + '"'
+        body = self.cache.get(key)
+        if body is not None:
+            return 200, body, etag
+        try:
+            status, payload = 200, self._route(path, base_url)
+        except ApiError as e:
+            status, payload = e.status, {"code": e.status, "type": "error", "message": str(e)}
+        body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        if status == 200:
+            self.cache.put(key, body)
+        return status, body, etag
+
+    # --- Маршрутизация ---
+
+    def _route(self, path: str, base_url: str) -> Dict:
+        parts = urlsplit(path)
+        query = {k: v[-1] for k, v in parse_qs(parts.query, keep_blank_values=True).items()}
+        prefix = f"/{API_VERSION}"
+        if not parts.path.startswith(prefix):
+            raise ApiError(404, f"Use {prefix}/Datastreams")
+        resource = parts.path[len(prefix):].rstrip("/")
+        root = f"{base_url}{prefix}"
+
+        if resource == "":
+            return {"value": [{"name": "Datastreams", "url": f"{root}/Datastreams"}]}
+        if resource == "/Datastreams":
+            return self._datastreams(root, query)
+        m = _ENTITY_RE.match(resource)
+        if not m:
+            raise ApiError(404, f"Unsupported resource {resource}")
+        ds = parse_datastream_id(m.group(1))
+        if m.group(2):
+            return self._observations(root, path, ds, query)
+        return self._datastream(root, *ds)
+
+    def _datastream(self, root: str, sensor_type: str, sensor_id: str, column: str, rollup: Optional[str]) -> Dict:
+        index = self.store.index(sensor_type, sensor_id)
+        if not index:
+            raise ApiError(404, f"No local data for {sensor_type} {sensor_id}")
+        m = schemas.get_schema(sensor_type).measurements[column]
+        ds_id = datastream_id(sensor_type, sensor_id, column, rollup)
+        self_link = f"{root}/Datastreams('{ds_id}')"
+        starts = [v["start"] for v in index.values() if v.get("rows")]
+        ends = [v["end"] for v in index.values() if v.get("rows")]
+        name = f"{m['description']} {sensor_type} {sensor_id}" + (f" ({rollup} mean)" if rollup else "")
+        entity = {
+            "@iot.id": ds_id,
+            "@iot.selfLink": self_link,
+            "name": name,
+            "description": f"Local archive series for {sensor_type} sensor {sensor_id}, column {column}",
+            "observationType": OBSERVATION_TYPE,
+            "unitOfMeasurement": {"name": m["unit"], "symbol": m["symbol"], "definition": "http://unknown"},
+            "properties": {"sensorType": sensor_type, "sensorId": sensor_id, "column": column,
+                           "observedProperty": m["observed_property"], "rollup": rollup},
+            "Observations@iot.navigationLink": f"{self_link}/Observations",
+        }
+        if starts:
+            entity["phenomenonTime"] = f"{_iso(min(starts))}/{_iso(max(ends))}"
+        return entity
+
+    def _datastreams(self, root: str, query: Dict) -> Dict:
+        conds = dict((k, v) for k, v in _PROP_COND_RE.findall(query.get("$filter", "")))
+        items = []
+        for sensor_type, sensor_id in self.store.sensors():
+            # Датчик без данных в хранилище не отдается и не входит в $count
+            if not self.store.index(sensor_type, sensor_id):
+                continue
+            for column in schemas.get_schema(sensor_type).measurements:
+                for rollup in [None] + list(ROLLUPS):
+                    props = {"sensorType": sensor_type, "sensorId": sensor_id, "column": column,
+                             "rollup": rollup or ""}
+                    if all(str(props.get(k, "")) == v for k, v in conds.items()):
+                        items.append((sensor_type, sensor_id, column, rollup))
+        top, skip = self._paging(query)
+        out = {"value": [self._datastream(root, *ds) for ds in items[skip:skip + top]]}
+        if query.get("$count") == "true":
+            out["@iot.count"] = len(items)
+        return out
+
+    def _paging(self, query: Dict) -> Tuple[int, int]:
+        try:
+            top = int(query.get("$top", DEFAULT_TOP))
+            skip = int(query.get("$skip", 0))
+        except ValueError:
+            raise ApiError(400, "$top and $skip must be integers")
+        return max(0, min(top, self.max_top)), max(0, skip)
+
+    def _observations(self, root: str, path: str, ds, query: Dict) -> Dict:
+        sensor_type, sensor_id, column, rollup = ds
+        start, end = parse_time_filter(query["$filter"]) if query.get("$filter", "").strip() else (None, None)
+
+        series = self.store.query(sensor_type, sensor_id, column, start, end, rollup)
+        total = int(series["time"].size)
+        descending = query.get("$orderby", "phenomenonTime asc").strip().lower().endswith("desc")
+        top, skip = self._paging(query)
+        if descending:
+            idx = list(range(total - 1 - skip, max(total - 1 - skip - top, -1), -1))
+        else:
+            idx = list(range(skip, min(skip + top, total)))
+
+        ds_id = datastream_id(sensor_type, sensor_id, column, rollup)
+        step = ROLLUPS.get(rollup)
+        times = series["time"]
+
+        def phenomenon_time(i):
+            t = int(times[i])
+            return f"{_iso(t)}/{_iso(t + step)}" if step else _iso(t)
+
+        def result(i):
+            return float(series["mean"][i] if step else series["value"][i])
+
+        out: Dict = {}
+        if query.get("$resultFormat") == "dataArray":
+            components = ["id", "phenomenonTime", "result"] + (["parameters"] if step else [])
+            rows = []
+            for i in idx:
+                row = [f"{ds_id}-{int(times[i])}", phenomenon_time(i), result(i)]
+                if step:
+                    row.append(self._rollup_params(series, i))
+                rows.append(row)
+            out["value"] = [{
+                "Datastream@iot.navigationLink": f"{root}/Datastreams('{ds_id}')",
+                "components": components,
+                "dataArray@iot.count": len(rows),
+                "dataArray": rows,
+            }]
+        else:
+            value = []
+            for i in idx:
+                obs = {"@iot.id": f"{ds_id}-{int(times[i])}", "phenomenonTime": phenomenon_time(i),
+                       "result": result(i)}
+                if step:
+                    obs["parameters"] = self._rollup_params(series, i)
+                value.append(obs)
+            out["value"] = value
+
+        if query.get("$count") == "true":
+            out["@iot.count"] = total
+        if skip + top < total:
+            next_query = dict(query, **{"$skip": str(skip + top), "$top": str(top)})
+            qs = "&".join(f"{k}={quote(v, safe='')}" for k, v in next_query.items())
+            out["@iot.nextLink"] = f"{root}/Datastreams('{ds_id}')/Observations?{qs}"
+        return out
+
+    @staticmethod
+    def _rollup_params(series, i) -> Dict:
+        return {"min": float(series["min"][i]), "max": float(series["max"][i]), "count": int(series["count"][i])}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    api: ReadAPI = None
+
+    def do_GET(self):
+        if self.path in ("/health", "/healthz"):
+            cache = self.api.cache
+            self._send(200, json.dumps({"status": "ok", "cache_hits": cache.hits,
+                                        "cache_misses": cache.misses}).encode("utf-8"))
+            return
+        host = self.headers.get("Host") or f"{self.server.server_address[0]}:{self.server.server_address[1]}"
+        status, body, etag = self.api.get(self.path, f"http://{host}")
+        if status == 200 and self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self._send(status, body, etag)
+
+    def _send(self, status: int, body: bytes, etag: Optional[str] = None):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        if etag:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        logging.debug("read-api: " + fmt % args)
+
+
+def make_server(config, host: Optional[str] = None, port: Optional[int] = None) -> ThreadingHTTPServer:
+    conf = config.get("read_api", {}) or {}
+    api = ReadAPI(config.get("data_dir", "data"), cache_size=int(conf.get("cache_size", 512)),
+                  max_top=int(conf.get("max_top", MAX_TOP)))
+    handler = type("ReadAPIHandler", (_Handler,), {"api": api})
+    if host is None:
+        host = conf.get("host", "0.0.0.0")
+    if port is None:
+        port = int(conf.get("port", DEFAULT_PORT))
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main(argv=None):
+    from main import load_config
+
+    parser = argparse.ArgumentParser(description="Read-only SensorThings subset over the local archive")
+    parser.add_argument("--host")
+    parser.add_argument("--port", type=int)
+    args = parser.parse_args(argv)
+
+    config = load_config()
+    server = make_server(config, args.host, args.port)
+    logging.info(f"📡 Read API listening on http://{server.server_address[0]}:{server.server_address[1]}/{API_VERSION}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
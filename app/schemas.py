@@ -0,0 +1,125 @@
+import os
+import json
+import logging
+from typing import Dict, List, Optional, Iterable
+
+# Реестр типов датчиков; путь можно переопределить через config['schemas_file'] или ETL_SCHEMAS
+SCHEMAS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schemas.json")
+
+# Колонки, которые нужны от любого типа: время и координаты
+BASE_COLUMNS = ("timestamp", "lat", "lon")
+
+_REGISTRY = None
+
+
+class SensorSchema:
+    """
+    Тип датчика из schemas.json: имя файла в архиве, нужные колонки CSV с точными типами
+    и измерения (колонка → Datastream, единицы, ObservedProperty).
+    """
+
+    def __init__(self, name: str, spec: Dict):
+        self.name = name
+        self.config_key = spec.get("config_key", name.lower())
+        self.filename_pattern = spec.get("filename", "{day}_" + name.lower() + "_sensor_{sensor_id}.csv")
+        self.sensor = spec.get("sensor", {})
+        # Колонка description.xlsx с номером датчика этого типа
+        self.description_column = spec.get("description_column", name)
+        self.columns: Dict[str, str] = dict(spec.get("columns", {}))
+        self.measurements: Dict[str, Dict] = dict(spec.get("measurements", {}))
+        # MultiDatastream (режим "multidatastream"): все измерения строки — одно наблюдение-массив
+        mds = spec.get("multidatastream", {})
+        self.multidatastream = {
+            "name": mds.get("name", name + "_{inv}"),
+            "description": mds.get("description", f"{name}: " + ", ".join(self.measurements)),
+        }
+
+        undeclared = [c for c in (*BASE_COLUMNS, *self.measurements) if c not in self.columns]
+        if undeclared:
+            raise ValueError(f"Schema {name}: columns {undeclared} are not declared in 'columns'")
+
+    def filename(self, sensor_id, day: str) -> str:
+        return self.filename_pattern.format(day=day, sensor_id=sensor_id)
+
+    @property
+    def check_column(self) -> Optional[str]:
+        """Измерение, по Datastream которого определяется последняя загруженная дата."""
+        return next(iter(self.measurements), None)
+
+    def read_csv(self, path: str, columns: Optional[Iterable[str]] = None):
+        """
+        Читает только нужные колонки с заданными типами (C-парсер, без вывода типов).
+        Файлы с десятичными запятыми или мусором в числах дочитываются медленным путем.
+        """
+        import pandas as pd
+
+        dtypes = {c: self.columns[c] for c in (columns or self.columns)}
+        try:
+            return pd.read_csv(path, sep=";", usecols=lambda c: c in dtypes, dtype=dtypes)
+        except pd.errors.EmptyDataError:
+            raise
+        except ValueError:
+            df = pd.read_csv(path, sep=";", usecols=lambda c: c in dtypes, dtype=str)
+            for col, dtype in dtypes.items():
+                if col in df.columns and dtype != "str":
+                    df[col] = pd.to_numeric(df[col].str.replace(",", ".", regex=False),
+                                            errors="coerce").astype(dtype)
+            return df
+
+    def __repr__(self):
+        return f"SensorSchema({self.name})"
+
+
+class SchemaRegistry:
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+        self.observed_properties: Dict[str, Dict] = raw.get("observed_properties", {})
+        self.types: Dict[str, SensorSchema] = {
+            name: SensorSchema(name, spec) for name, spec in raw.get("sensor_types", {}).items()
+        }
+        for schema in self.types.values():
+            for col, m in schema.measurements.items():
+                if m.get("observed_property") not in self.observed_properties:
+                    raise ValueError(f"Schema {schema.name}: unknown ObservedProperty for '{col}'")
+
+
+def load(path: Optional[str] = None) -> SchemaRegistry:
+    """Загружает реестр (по умолчанию app/schemas.json) и делает его текущим для процесса."""
+    global _REGISTRY
+    _REGISTRY = SchemaRegistry(path or os.getenv("ETL_SCHEMAS") or SCHEMAS_FILE)
+    logging.debug(f"Loaded {len(_REGISTRY.types)} sensor schemas from {_REGISTRY.path}")
+    return _REGISTRY
+
+
+def registry() -> SchemaRegistry:
+    return _REGISTRY if _REGISTRY is not None else load()
+
+
+def get_schema(sensor_type: str) -> SensorSchema:
+    try:
+        return registry().types[sensor_type]
+    except KeyError:
+        raise ValueError(f"Unknown sensor type {sensor_type}: add it to {registry().path}") from None
+
+
+def sensor_types() -> List[str]:
+    return list(registry().types)
+
+
+def config_keys() -> Dict[str, str]:
+    """Ключ секции config['sensors'] → тип датчика, например {'sds': 'SDS011'}."""
+    return {s.config_key: s.name for s in registry().types.values()}
+
+
+def active_types(config) -> List[SensorSchema]:
+    """Типы, для которых в конфиге есть датчики."""
+    sensors = config.get("sensors", {})
+    return [s for s in registry().types.values() if sensors.get(s.config_key)]
+
+
+def check_config(config) -> None:
+    unknown = [k for k in config.get("sensors", {}) if k not in config_keys()]
+    if unknown:
+        logging.warning(f"No sensor schema for config sections {unknown} in {registry().path}; they are ignored")
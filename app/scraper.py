@@ -4,62 +4,98 @@ import datetime
 import time
 import logging
 
+from metrics import METRICS
+from catalog import FileCatalog
+from statestore import open_state_store, STAGE_DOWNLOAD, STATUS_DONE, STATUS_MISSING, STATUS_FAILED
+import schemas
+
 
 def scrape_data(config):
     logging.info("--- Starting Scraper ---")
     data_dir = config['data_dir']
     base_url = "https://archive.sensor.community/"
+    catalog = FileCatalog(data_dir)
+    store = open_state_store(config)
 
     tasks = []
-    # Собираем задачи из конфига
-    for sensor_id, dates in config['sensors'].get('sds', {}).items():
-        tasks.append((sensor_id, 'SDS011', dates['start'], dates['end']))
-    for sensor_id, dates in config['sensors'].get('bme', {}).items():
-        tasks.append((sensor_id, 'BME280', dates['start'], dates['end']))
+    # Собираем задачи из конфига: точный список дней от планировщика или диапазон start..end
+    for schema in schemas.active_types(config):
+        for sensor_id, dates in config['sensors'][schema.config_key].items():
+            tasks.append((sensor_id, schema, _task_days(dates)))
 
-    for sensor_id, s_type, start_str, end_str in tasks:
-        current = datetime.datetime.strptime(start_str, "%Y-%m-%d").date()
-        end = datetime.datetime.strptime(end_str, "%Y-%m-%d").date()
+    for sensor_id, schema, days in tasks:
+        s_type = schema.name
+        if not days:
+            continue
+        sensor_t0 = time.perf_counter()
 
         # Создаем папку
         sensor_dir = os.path.join(data_dir, s_type, sensor_id)
         os.makedirs(sensor_dir, exist_ok=True)
 
-        pattern = f"_{s_type.lower()}_sensor_{sensor_id}.csv"
-
-        while current <= end:
-            date_str = str(current)
-            full_name = date_str + pattern
+        for date_str in days:
+            full_name = schema.filename(sensor_id, date_str)
             local_path = os.path.join(sensor_dir, full_name)
 
-            # CHECKPOINT: Если файл есть и он больше 0 байт - пропускаем
-            if os.path.exists(local_path) and os.path.getsize(local_path) > 0:
+            # CHECKPOINT: Если файл уже есть в каталоге (и он не пустой) - пропускаем
+            if catalog.has_file(s_type, sensor_id, date_str):
                 # logging.debug(f"Skipping {full_name}, already exists.")
-                current += datetime.timedelta(days=1)
+                store.mark(STAGE_DOWNLOAD, s_type, sensor_id, date_str, STATUS_DONE)
                 continue
 
             url = f"{base_url}{date_str}/{full_name}"
+            status, detail = STATUS_FAILED, None
             try:
                 # Retry logic
                 for attempt in range(3):
                     try:
-                        resp = requests.get(url, timeout=10)
+                        with METRICS.http_timer('archive', 'download'):
+                            resp = requests.get(url, timeout=10)
                         if resp.status_code == 200:
                             with open(local_path, "w") as f:
                                 f.write(resp.text)
+                            catalog.record_download(s_type, sensor_id, date_str, local_path, resp.text)
+                            if resp.text:
+                                status = STATUS_DONE
+                            else:
+                                # Пустой файл за день — как 404: перепроверяется только в окне missing_recheck_days
+                                status, detail = STATUS_MISSING, "empty"
+                            METRICS.inc('downloads_total', sensor_type=s_type)
+                            METRICS.inc('download_bytes_total', len(resp.content), sensor_type=s_type)
                             logging.info(f"Downloaded: {full_name}")
                             break
                         elif resp.status_code == 404:
+                            METRICS.inc('downloads_not_found_total', sensor_type=s_type)
+                            catalog.record_missing(s_type, sensor_id, date_str)
+                            status = STATUS_MISSING
                             logging.warning(f"Not found: {full_name}")
                             break
                         else:
+                            METRICS.inc('download_errors_total', sensor_type=s_type, reason=resp.status_code)
                             logging.warning(f"Error {resp.status_code} for {full_name}, retrying...")
                             time.sleep(2)
                     except requests.RequestException as e:
+                        METRICS.inc('download_errors_total', sensor_type=s_type, reason='network')
                         logging.error(f"Network error: {e}, attempt {attempt + 1}")
                         time.sleep(5)
             except Exception as e:
                 logging.error(f"Critical error downloading {full_name}: {e}")
 
-            current += datetime.timedelta(days=1)
-    logging.info("--- Scraping Finished ---")
\ No newline at end of file
+            store.mark(STAGE_DOWNLOAD, s_type, sensor_id, date_str, status, detail=detail)
+
+        METRICS.add_sensor_time('scrape', sensor_id, time.perf_counter() - sensor_t0)
+    catalog.close()
+    store.close()
+    logging.info("--- Scraping Finished ---")
+
+
+def _task_days(dates):
+    if 'days' in dates:
+        return list(dates['days'])
+    current = datetime.datetime.strptime(dates['start'], "%Y-%m-%d").date()
+    end = datetime.datetime.strptime(dates['end'], "%Y-%m-%d").date()
+    days = []
+    while current <= end:
+        days.append(str(current))
+        current += datetime.timedelta(days=1)
+    return days
\ No newline at end of file
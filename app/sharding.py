@@ -0,0 +1,129 @@
+import os
+import re
+import time
+import random
+import socket
+import hashlib
+import logging
+from contextlib import contextmanager, nullcontext
+
+LEASE_TTL_SEC = 900
+LEASE_WAIT_SEC = 600
+
+
+def _score(shard_index: int, key: str) -> int:
+    digest = hashlib.blake2b(f"{shard_index}:{key}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+def normalize_sensor_id(sensor_id) -> str:
+    """'82312', 82312 и 82312.0 (из Excel) должны попадать в один шард."""
+    s = str(sensor_id).strip()
+    if s.endswith(".0") and s[:-2].isdigit():
+        s = s[:-2]
+    return s
+
+
+def owner_of(sensor_id, count: int) -> int:
+    """
+    Rendezvous (HRW) hashing: датчик принадлежит шарду с максимальным весом.
+    При добавлении воркера переезжает только ~1/N датчиков.
+    """
+    key = normalize_sensor_id(sensor_id)
+    return max(range(count), key=lambda i: _score(i, key))
+
+
+class Shard:
+    """Доля датчиков, которую обрабатывает текущий воркер."""
+
+    def __init__(self, index: int = 0, count: int = 1):
+        if count < 1 or not (0 <= index < count):
+            raise ValueError(f"Invalid shard {index}/{count}")
+        self.index = index
+        self.count = count
+
+    @property
+    def enabled(self) -> bool:
+        return self.count > 1
+
+    @property
+    def suffix(self) -> str:
+        return f".shard-{self.index}-of-{self.count}" if self.enabled else ""
+
+    def owns(self, sensor_id) -> bool:
+        if sensor_id is None or str(sensor_id).strip() in ("", "nan", "<NA>", "None"):
+            return False
+        return not self.enabled or owner_of(sensor_id, self.count) == self.index
+
+    def lease(self, data_dir: str, name: str):
+        """Взаимное исключение между воркерами; без шардинга не нужно."""
+        if not self.enabled:
+            return nullcontext()
+        return file_lease(data_dir, name)
+
+    def __repr__(self):
+        return f"Shard({self.index}/{self.count})"
+
+
+def get_shard(config) -> Shard:
+    """Шард из config['shard'] ({"index": 0, "count": 1}); ETL_SHARD_INDEX / ETL_SHARD_COUNT имеют приоритет."""
+    conf = config.get("shard", {}) or {}
+    index = int(os.getenv("ETL_SHARD_INDEX", conf.get("index", 0)))
+    count = int(os.getenv("ETL_SHARD_COUNT", conf.get("count", 1)))
+    return Shard(index, count)
+
+
+def apply_shard(config) -> Shard:
+    """Оставляет в config['sensors'] только датчики своего шарда."""
+    shard = get_shard(config)
+    config["shard"] = {"index": shard.index, "count": shard.count}
+    if not shard.enabled:
+        return shard
+
+    total, owned = 0, 0
+    for s_type, sensors in config.get("sensors", {}).items():
+        mine = {sid: dates for sid, dates in sensors.items() if shard.owns(sid)}
+        total += len(sensors)
+        owned += len(mine)
+        config["sensors"][s_type] = mine
+    logging.info(f"🧩 {shard}: {owned} of {total} sensors belong to this worker")
+    return shard
+
+
+@contextmanager
+def file_lease(data_dir: str, name: str, ttl: float = LEASE_TTL_SEC, wait: float = LEASE_WAIT_SEC):
+    """
+    Lease-файл в data_dir/leases (O_CREAT | O_EXCL работает и на общих томах).
+    Lease старше ttl считается брошенным упавшим воркером и перехватывается.
+    """
+    lease_dir = os.path.join(data_dir, "leases")
+    os.makedirs(lease_dir, exist_ok=True)
+    path = os.path.join(lease_dir, re.sub(r"[^\w.-]", "_", name) + ".lease")
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    deadline = time.time() + wait
+
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            with os.fdopen(fd, "w") as f:
+                f.write(owner)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(path) > ttl:
+                    logging.warning(f"Lease {name} is stale, taking it over")
+                    os.remove(path)
+                    continue
+            except FileNotFoundError:
+                continue
+            if time.time() > deadline:
+                raise TimeoutError(f"Lease {name} is held by another worker for too long")
+            time.sleep(0.2 + random.uniform(0, 0.3))
+
+    try:
+        yield
+    finally:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
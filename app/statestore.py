@@ -0,0 +1,288 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import datetime
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+STATE_DB_FILE = "state.sqlite"
+
+STAGE_DOWNLOAD = "download"
+STAGE_PROCESS = "process"
+STAGE_UPLOAD = "upload"
+# Дни, в которые живой опрос (live.py) уже отправлял наблюдения во FROST до появления файла архива
+STAGE_LIVE = "live"
+
+# Ключ meta: датчики конфига без инвентарной группы в all_stats.xlsx (их дни планировщик загрузки не считает)
+META_NO_GROUP = "upload_no_group"
+
+STATUS_DONE = "done"
+STATUS_MISSING = "missing"
+STATUS_FAILED = "failed"
+
+
+def enable_wal(conn: sqlite3.Connection, timeout: float = 60.0) -> None:
+    """
+    Переводит базу в WAL. Переключение режима журнала не ждет busy_timeout: если несколько воркеров
+    открывают новую базу одновременно, часть получает "database is locked" — повторяем до timeout.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            break
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) or time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={int(timeout * 1000)}")
+
+
+def day_range(start: datetime.date, end: datetime.date) -> List[str]:
+    days = []
+    current = start
+    while current <= end:
+        days.append(current.strftime("%Y-%m-%d"))
+        current += datetime.timedelta(days=1)
+    return days
+
+
+class StateStore:
+    """
+    Состояние ETL по дням в SQLite (WAL): одна запись на (тип, датчик, день, этап)
+    со статусом done / missing / failed. Записи пишутся пачками в одной транзакции,
+    несколько процессов-воркеров могут писать одновременно.
+    """
+
+    def __init__(self, data_dir: str, path: Optional[str] = None):
+        self.data_dir = data_dir
+        self.path = path or os.path.join(data_dir, STATE_DB_FILE)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        enable_wal(self.conn)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS day_state (
+                sensor_type TEXT NOT NULL,
+                sensor_id   TEXT NOT NULL,
+                day         TEXT NOT NULL,
+                stage       TEXT NOT NULL,
+                status      TEXT NOT NULL,
+                attempts    INTEGER NOT NULL DEFAULT 1,
+                detail      TEXT,
+                updated_at  TEXT NOT NULL,
+                PRIMARY KEY (sensor_type, sensor_id, stage, day)
+            );
+            CREATE TABLE IF NOT EXISTS sensors (
+                sensor_type        TEXT NOT NULL,
+                sensor_id          TEXT NOT NULL,
+                initial_start      TEXT,
+                last_run_timestamp TEXT,
+                PRIMARY KEY (sensor_type, sensor_id)
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key   TEXT PRIMARY KEY,
+                value TEXT
+            );
+            CREATE TABLE IF NOT EXISTS frost_sync (
+                server      TEXT NOT NULL,
+                inv         TEXT NOT NULL,
+                fingerprint TEXT,
+                resolved    TEXT NOT NULL,
+                updated_at  TEXT NOT NULL,
+                PRIMARY KEY (server, inv)
+            );
+        """)
+        self._pending: Optional[List[Tuple]] = None
+
+    def close(self) -> None:
+        self.flush()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # --- Запись ---
+
+    def mark(self, stage: str, sensor_type: str, sensor_id, day: str, status: str,
+             detail: Optional[str] = None) -> None:
+        row = (sensor_type, str(sensor_id), day, stage, status, detail, datetime.datetime.now().isoformat())
+        if self._pending is not None:
+            self._pending.append(row)
+        else:
+            self._write([row])
+
+    @contextmanager
+    def batch(self):
+        """Копит отметки и записывает их одной транзакцией на выходе из блока."""
+        outer = self._pending is not None
+        if not outer:
+            self._pending = []
+        try:
+            yield self
+        finally:
+            if not outer:
+                self.flush()
+                self._pending = None
+
+    def flush(self) -> None:
+        if self._pending:
+            rows, self._pending = self._pending, []
+            self._write(rows)
+
+    def _write(self, rows: List[Tuple]) -> None:
+        with self._transaction():
+            self.conn.executemany(
+                "INSERT INTO day_state (sensor_type, sensor_id, day, stage, status, detail, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (sensor_type, sensor_id, stage, day) DO UPDATE SET "
+                "status = excluded.status, detail = excluded.detail, updated_at = excluded.updated_at, "
+                "attempts = day_state.attempts + 1 "
+                # Повторная отметка done -> done ничего не меняет и не переписывает страницу
+                "WHERE NOT (day_state.status = 'done' AND excluded.status = 'done')",
+                rows,
+            )
+
+    @contextmanager
+    def _transaction(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def touch_sensor(self, sensor_type: str, sensor_id, initial_start: Optional[str] = None) -> None:
+        with self._transaction():
+            self.conn.execute(
+                "INSERT INTO sensors (sensor_type, sensor_id, initial_start, last_run_timestamp) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (sensor_type, sensor_id) DO UPDATE SET "
+                "initial_start = COALESCE(sensors.initial_start, excluded.initial_start), "
+                "last_run_timestamp = excluded.last_run_timestamp",
+                (sensor_type, str(sensor_id), initial_start, datetime.datetime.now().isoformat()),
+            )
+
+    # --- Чтение ---
+
+    def statuses(self, stage: str, sensor_type: str, sensor_id, start: Optional[str] = None,
+                 end: Optional[str] = None) -> Dict[str, str]:
+        sql = "SELECT day, status FROM day_state WHERE stage = ? AND sensor_type = ? AND sensor_id = ?"
+        params = [stage, sensor_type, str(sensor_id)]
+        if start:
+            sql += " AND day >= ?"
+            params.append(start)
+        if end:
+            sql += " AND day <= ?"
+            params.append(end)
+        return {r["day"]: r["status"] for r in self.conn.execute(sql, params)}
+
+    def pending(self, stage: str, after_stage: str, sensor_type: str, sensor_id,
+                start: Optional[str] = None) -> List[str]:
+        """Дни, завершенные на этапе after_stage (done), но еще не завершенные на этапе stage."""
+        sql = ("SELECT a.day FROM day_state a LEFT JOIN day_state b "
+               "ON b.sensor_type = a.sensor_type AND b.sensor_id = a.sensor_id AND b.day = a.day AND b.stage = ? "
+               "WHERE a.stage = ? AND a.status = ? AND a.sensor_type = ? AND a.sensor_id = ? "
+               "AND (b.status IS NULL OR b.status != ?)")
+        params = [stage, after_stage, STATUS_DONE, sensor_type, str(sensor_id), STATUS_DONE]
+        if start:
+            sql += " AND a.day >= ?"
+            params.append(start)
+        return [r["day"] for r in self.conn.execute(sql + " ORDER BY a.day", params)]
+
+    def counts(self) -> Dict[str, Dict[str, int]]:
+        out: Dict[str, Dict[str, int]] = {}
+        for r in self.conn.execute("SELECT stage, status, COUNT(*) AS n FROM day_state GROUP BY stage, status"):
+            out.setdefault(r["stage"], {})[r["status"]] = r["n"]
+        return out
+
+    def get_meta(self, key: str) -> Optional[str]:
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else None
+
+    def set_meta(self, key: str, value: str) -> None:
+        with self._transaction():
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    # --- Синхронизация метаданных с FROST ---
+
+    def get_sync(self, server: str, inv) -> Optional[Tuple[Optional[str], Dict]]:
+        """(отпечаток, найденные ID) для группы на данном сервере FROST."""
+        row = self.conn.execute("SELECT fingerprint, resolved FROM frost_sync WHERE server = ? AND inv = ?",
+                                (server, str(inv))).fetchone()
+        return (row["fingerprint"], json.loads(row["resolved"])) if row else None
+
+    def set_sync(self, server: str, inv, fingerprint: Optional[str], resolved: Dict) -> None:
+        with self._transaction():
+            self.conn.execute(
+                "INSERT OR REPLACE INTO frost_sync (server, inv, fingerprint, resolved, updated_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (server, str(inv), fingerprint, json.dumps(resolved, ensure_ascii=False, default=str),
+                 datetime.datetime.now().isoformat()),
+            )
+
+    def synced_groups(self, server: str) -> Dict[str, Dict]:
+        """Все синхронизированные группы сервера: {инвентарный номер: найденные ID}."""
+        rows = self.conn.execute("SELECT inv, resolved FROM frost_sync WHERE server = ? ORDER BY inv", (server,))
+        return {r["inv"]: json.loads(r["resolved"]) for r in rows}
+
+    def clear_sync(self, server: Optional[str] = None) -> int:
+        """Забывает синхронизированные ID (например, после пересоздания базы FROST)."""
+        with self._transaction():
+            if server is None:
+                cur = self.conn.execute("DELETE FROM frost_sync")
+            else:
+                cur = self.conn.execute("DELETE FROM frost_sync WHERE server = ?", (server,))
+        return cur.rowcount
+
+    # --- Миграция со state.json ---
+
+    def migrate_from_json(self, state_path: str, type_names: Dict[str, str], catalog=None) -> bool:
+        """
+        Переносит старый state.json: дни initial_start..last_downloaded считаются скачанными
+        (done, если файл есть в каталоге, иначе missing). Файл переименовывается в state.json.migrated.
+        """
+        if not os.path.exists(state_path) or self.get_meta("migrated_state_json"):
+            return False
+        try:
+            with open(state_path, "r", encoding="utf-8") as f:
+                legacy = json.load(f)
+        except Exception as e:
+            logging.warning(f"Failed to read legacy state {state_path}: {e}. Skipping migration.")
+            return False
+
+        logging.info(f"🔁 Migrating {state_path} into {self.path}...")
+        migrated = 0
+        with self.batch():
+            for type_key, sensors in legacy.items():
+                sensor_type = type_names.get(type_key)
+                if not sensor_type or not isinstance(sensors, dict):
+                    continue
+                for sensor_id, st in sensors.items():
+                    try:
+                        first = datetime.datetime.strptime(st["initial_start"], "%Y-%m-%d").date()
+                        last = datetime.datetime.strptime(st["last_downloaded"], "%Y-%m-%d").date()
+                    except (KeyError, TypeError, ValueError):
+                        continue
+                    on_disk = {e["day"] for e in catalog.files(sensor_type, sensor_id)} if catalog else set()
+                    for day in day_range(first, last):
+                        status = STATUS_DONE if (catalog is None or day in on_disk) else STATUS_MISSING
+                        self.mark(STAGE_DOWNLOAD, sensor_type, sensor_id, day, status, detail="migrated")
+                        migrated += 1
+                    self.touch_sensor(sensor_type, sensor_id, st.get("initial_start"))
+
+        self.set_meta("migrated_state_json", datetime.datetime.now().isoformat())
+        os.replace(state_path, state_path + ".migrated")
+        logging.info(f"🔁 Migrated {migrated} sensor-days from state.json")
+        return True
+
+
+def open_state_store(config) -> StateStore:
+    """state.sqlite лежит в data_dir; путь можно переопределить через config['state_db']."""
+    return StateStore(config.get("data_dir", "data"), config.get("state_db"))
@@ -0,0 +1,109 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import pandas as pd
+
+from metrics import METRICS
+
+# Сколько разобранных файлов держать в памяти (день одного датчика — сотни-тысячи строк)
+CACHE_FILES = 256
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+class FrameCache:
+    """LRU разобранных CSV по (путь, размер, mtime): файл, прочитанный процессором, берут хранилище рядов и загрузчик."""
+
+    def __init__(self, max_files: int = CACHE_FILES):
+        self.max_files = max_files
+        self._frames: "OrderedDict[Tuple, pd.DataFrame]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            frame = self._frames.get(key)
+            if frame is not None:
+                self._frames.move_to_end(key)
+            return frame
+
+    def put(self, key, frame) -> None:
+        with self._lock:
+            self._frames[key] = frame
+            self._frames.move_to_end(key)
+            while len(self._frames) > self.max_files:
+                self._frames.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._frames.clear()
+
+
+FRAMES = FrameCache()
+
+
+def read_frame(schema, path: str) -> pd.DataFrame:
+    """
+    Единственный разбор файла архива: все колонки схемы с точными типами, timestamp — в UTC
+    (битое время — NaT). Результат общий для всех этапов, изменять его нельзя.
+    """
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime)
+    frame = FRAMES.get(key)
+    if frame is not None:
+        METRICS.inc("parse_cache_total", result="hit")
+        return frame
+
+    METRICS.inc("parse_cache_total", result="miss")
+    frame = schema.read_csv(path)
+    if "timestamp" in frame.columns:
+        frame["timestamp"] = pd.to_datetime(frame["timestamp"], utc=True, errors="coerce")
+    FRAMES.put(key, frame)
+    return frame
+
+
+def summarize(schema, frame: pd.DataFrame) -> Dict:
+    """
+    Сводка файла, которую хранит каталог: границы времени по каждой точной паре координат
+    и число значений по колонкам измерений ("rows" — строки хотя бы с одним значением).
+    """
+    keys = list(schema.measurements)
+    valid = frame[frame["timestamp"].notna()] if "timestamp" in frame.columns else frame.iloc[0:0]
+
+    located = valid.dropna(subset=[c for c in ("lat", "lon") if c in valid.columns])
+    bounds = []
+    if {"lat", "lon"} <= set(located.columns) and not located.empty:
+        g = located.groupby(["lat", "lon"])["timestamp"].agg(["min", "max"]).reset_index()
+        bounds = [[float(r.lat), float(r.lon), r.min.strftime(TIME_FORMAT), r.max.strftime(TIME_FORMAT)]
+                  for r in g.itertuples(index=False)]
+
+    present = valid.reindex(columns=keys).notna()
+    counts = {k: int(v) for k, v in present.sum().items()}
+    counts["rows"] = int(present.any(axis=1).sum())
+    return {"bounds": bounds, "counts": counts}
+
+
+def file_summaries(catalog, schema, entries: Iterable) -> Iterator[Tuple[object, Dict]]:
+    """
+    (запись каталога, сводка) по файлам; сводки неизмененных файлов берутся из каталога без чтения,
+    новые считаются по одному разбору файла и сохраняются в каталог пачкой.
+    """
+    fresh: List[Tuple[object, Dict]] = []
+    try:
+        for e in entries:
+            stats = catalog.file_stats(e)
+            summary = {"bounds": stats.get("bounds"), "counts": stats.get("counts")}
+            if summary["bounds"] is None or summary["counts"] is None or \
+                    any(k not in summary["counts"] for k in schema.measurements):
+                try:
+                    summary = summarize(schema, read_frame(schema, catalog.full_path(e)))
+                except Exception as ex:
+                    logging.warning(f"Cannot read {e['path']}: {type(ex).__name__}: {ex}")
+                    continue
+                fresh.append((e, summary))
+            yield e, summary
+    finally:
+        catalog.set_file_stats(fresh)
+        METRICS.inc("files_summarized_total", len(fresh))
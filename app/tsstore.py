@@ -0,0 +1,251 @@
+import os
+import json
+import hashlib
+import logging
+import itertools
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+import schemas
+from metrics import METRICS
+
+STORE_DIR = "tsstore"
+INDEX_FILE = "index.json"
+VERSION_FILE = "VERSION"
+
+# Предрассчитанные агрегаты: имя → шаг в секундах
+ROLLUPS = {"1h": 3600, "1d": 86400}
+
+
+def _sources_digest(entries) -> str:
+    parts = [(e["day"], e["size"], e["mtime"]) for e in entries]
+    return hashlib.sha1(json.dumps(parts).encode("utf-8")).hexdigest()
+
+
+def _rollup(times: np.ndarray, columns: Dict[str, np.ndarray], step: int) -> Dict[str, np.ndarray]:
+    """Агрегаты по интервалам step: mean / min / max / count для каждой колонки (NaN не учитываются)."""
+    out = {"time": np.empty(0, dtype=np.int64)}
+    if times.size == 0:
+        for col in columns:
+            for agg in ("mean", "min", "max"):
+                out[f"{col}__{agg}"] = np.empty(0)
+            out[f"{col}__count"] = np.empty(0, dtype=np.int64)
+        return out
+
+    buckets = times // step * step
+    out["time"], starts = np.unique(buckets, return_index=True)
+    for col, values in columns.items():
+        valid = ~np.isnan(values)
+        count = np.add.reduceat(valid.astype(np.int64), starts)
+        total = np.add.reduceat(np.where(valid, values, 0.0), starts)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            out[f"{col}__mean"] = np.where(count > 0, total / np.maximum(count, 1), np.nan)
+        with np.errstate(invalid="ignore"):
+            out[f"{col}__min"] = np.fmin.reduceat(values, starts)
+            out[f"{col}__max"] = np.fmax.reduceat(values, starts)
+        out[f"{col}__count"] = count
+    return out
+
+
+@lru_cache(maxsize=256)
+def _load_month(path: str, mtime: float) -> Dict[str, np.ndarray]:
+    # mtime входит в ключ: пересобранный месяц не берется из кэша
+    with np.load(path) as npz:
+        return {k: npz[k] for k in npz.files}
+
+
+class TimeSeriesStore:
+    """
+    Колоночное хранилище рядов из локального архива: data_dir/tsstore/<тип>/<датчик>/<YYYY-MM>.npz.
+    В файле месяца — отсортированное время (epoch, UTC) и колонки измерений, плюс агрегаты 1h / 1d.
+    index.json датчика хранит диапазоны времени по месяцам и отпечаток исходных CSV,
+    поэтому пересобираются только месяцы, файлы которых изменились.
+    """
+
+    def __init__(self, data_dir: str):
+        self.root = os.path.join(data_dir, STORE_DIR)
+
+    # --- Пути и индекс ---
+
+    def sensor_dir(self, sensor_type: str, sensor_id) -> str:
+        path = os.path.join(self.root, sensor_type, str(sensor_id))
+        # Тип и номер приходят и из URL read API: путь не должен выходить за корень хранилища
+        root = os.path.realpath(self.root)
+        if os.path.commonpath([root, os.path.realpath(path)]) != root or os.path.realpath(path) == root:
+            raise ValueError(f"Invalid sensor path: {sensor_type}/{sensor_id}")
+        return path
+
+    def month_path(self, sensor_type: str, sensor_id, month: str) -> str:
+        return os.path.join(self.sensor_dir(sensor_type, sensor_id), f"{month}.npz")
+
+    def index(self, sensor_type: str, sensor_id) -> Dict[str, Dict]:
+        path = os.path.join(self.sensor_dir(sensor_type, sensor_id), INDEX_FILE)
+        try:
+            return _read_index(path, os.path.getmtime(path))
+        except OSError:
+            return {}
+
+    def _write_index(self, sensor_type: str, sensor_id, index: Dict) -> None:
+        path = os.path.join(self.sensor_dir(sensor_type, sensor_id), INDEX_FILE)
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.replace(tmp, path)
+
+    def version(self) -> float:
+        """Меняется после каждого обновления хранилища (используется как ключ кэша API)."""
+        try:
+            return os.path.getmtime(os.path.join(self.root, VERSION_FILE))
+        except OSError:
+            return 0.0
+
+    def sensors(self) -> List[Tuple[str, str]]:
+        out = []
+        for sensor_type in schemas.sensor_types():
+            type_dir = os.path.join(self.root, sensor_type)
+            if os.path.isdir(type_dir):
+                out.extend((sensor_type, e.name) for e in sorted(os.scandir(type_dir), key=lambda e: e.name)
+                           if e.is_dir())
+        return out
+
+    # --- Обновление ---
+
+    def update(self, catalog, sensor_types: List[str], shard=None) -> Dict[str, int]:
+        """Пересобирает месяцы, у которых в каталоге изменился набор файлов (размер / mtime)."""
+        stats = {"built": 0, "removed": 0, "unchanged": 0}
+        for sensor_type in sensor_types:
+            schema = schemas.get_schema(sensor_type)
+            for sensor_id, entries in itertools.groupby(catalog.files(sensor_type), key=lambda r: r["sensor_id"]):
+                if shard is not None and not shard.owns(sensor_id):
+                    continue
+                entries = list(entries)
+                index = self.index(sensor_type, sensor_id)
+                new_index = {}
+                for month, month_entries in itertools.groupby(entries, key=lambda r: r["day"][:7]):
+                    month_entries = list(month_entries)
+                    digest = _sources_digest(month_entries)
+                    old = index.get(month)
+                    if old and old.get("sources") == digest and os.path.exists(
+                            self.month_path(sensor_type, sensor_id, month)):
+                        new_index[month] = old
+                        stats["unchanged"] += 1
+                        continue
+                    paths = [catalog.full_path(e) for e in month_entries]
+                    new_index[month] = self._build_month(schema, sensor_id, month, paths)
+                    new_index[month]["sources"] = digest
+                    stats["built"] += 1
+
+                for month in set(index) - set(new_index):
+                    try:
+                        os.remove(self.month_path(sensor_type, sensor_id, month))
+                    except FileNotFoundError:
+                        pass
+                    stats["removed"] += 1
+                if new_index != index:
+                    self._write_index(sensor_type, sensor_id, new_index)
+
+        if stats["built"] or stats["removed"] or not os.path.exists(os.path.join(self.root, VERSION_FILE)):
+            os.makedirs(self.root, exist_ok=True)
+            with open(os.path.join(self.root, VERSION_FILE), "w") as f:
+                f.write(str(sum(stats.values())))
+        METRICS.inc("tsstore_months_built_total", stats["built"])
+        logging.info(f"🗄️ Time-series store updated: {stats}")
+        return stats
+
+    def _build_month(self, schema, sensor_id, month: str, paths: List[str]) -> Dict:
+        import pandas as pd
+        from transform import read_frame
+
+        columns = list(schema.measurements)
+        frames = []
+        for path in paths:
+            try:
+                frames.append(read_frame(schema, path).reindex(columns=["timestamp"] + columns))
+            except Exception as e:
+                logging.warning(f"tsstore: skipping {path}: {e}")
+        df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=["timestamp"] + columns)
+
+        ts = pd.to_datetime(df["timestamp"], utc=True, errors="coerce")
+        keep = ts.notna().to_numpy()
+        times = ts[keep].dt.tz_convert(None).to_numpy().astype("datetime64[s]").astype(np.int64)
+        order = np.argsort(times, kind="stable")
+        times = times[order]
+        values = {}
+        for col in columns:
+            v = df[col].to_numpy(dtype=np.float64, na_value=np.nan) if col in df.columns \
+                else np.full(len(df), np.nan)
+            values[col] = v[keep][order]
+
+        arrays = {"time": times}
+        arrays.update(values)
+        for name, step in ROLLUPS.items():
+            for key, arr in _rollup(times, values, step).items():
+                arrays[f"{name}__{key}"] = arr
+
+        path = self.month_path(schema.name, sensor_id, month)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.tmp.npz"
+        np.savez(tmp, **arrays)
+        os.replace(tmp, path)
+        return {
+            "rows": int(times.size),
+            "start": int(times[0]) if times.size else None,
+            "end": int(times[-1]) if times.size else None,
+        }
+
+    # --- Чтение ---
+
+    def query(self, sensor_type: str, sensor_id, column: str, start: Optional[int] = None,
+              end: Optional[int] = None, rollup: Optional[str] = None) -> Dict[str, np.ndarray]:
+        """
+        Ряд колонки за [start, end] (epoch-секунды, включительно), без пропусков.
+        Для rollup возвращаются time, mean, min, max, count.
+        """
+        prefix = f"{rollup}__" if rollup else ""
+        fields = ["mean", "min", "max", "count"] if rollup else [None]
+        parts = {f: [] for f in ["time"] + fields}
+
+        for month, meta in sorted(self.index(sensor_type, sensor_id).items()):
+            if not meta.get("rows"):
+                continue
+            if (start is not None and meta["end"] < start - ROLLUPS.get(rollup, 0)) or \
+                    (end is not None and meta["start"] > end):
+                continue
+            path = self.month_path(sensor_type, sensor_id, month)
+            try:
+                data = _load_month(path, os.path.getmtime(path))
+            except OSError:
+                continue
+            times = data[f"{prefix}time"]
+            lo = 0 if start is None else np.searchsorted(times, start, side="left")
+            hi = times.size if end is None else np.searchsorted(times, end, side="right")
+            if rollup:
+                valid = data[f"{prefix}{column}__count"][lo:hi] > 0
+            else:
+                valid = ~np.isnan(data[column][lo:hi])
+            parts["time"].append(times[lo:hi][valid])
+            for f in fields:
+                key = f"{prefix}{column}__{f}" if f else column
+                parts[f].append(data[key][lo:hi][valid])
+
+        out = {}
+        for f, chunks in parts.items():
+            out["value" if f is None else f] = np.concatenate(chunks) if chunks else np.empty(0)
+        return out
+
+
+@lru_cache(maxsize=1024)
+def _read_index(path: str, mtime: float) -> Dict:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def update_store(config, shard=None) -> Dict[str, int]:
+    """Обновляет хранилище рядов по каталогу для типов датчиков из конфига."""
+    from catalog import FileCatalog
+
+    with FileCatalog(config.get("data_dir", "data")) as catalog:
+        store = TimeSeriesStore(catalog.data_dir)
+        return store.update(catalog, [s.name for s in schemas.active_types(config)], shard)
@@ -5,7 +5,19 @@ from datetime import datetime, timedelta, timezone
 import logging
 import os
 import uuid
+import hashlib
+import urllib.parse
 import dateutil.parser
+from urllib3.exceptions import NewConnectionError
+
+from metrics import METRICS
+from catalog import FileCatalog
+from sharding import get_shard, normalize_sensor_id
+from statestore import (open_state_store, day_range, STAGE_DOWNLOAD, STAGE_UPLOAD, STAGE_LIVE, STATUS_DONE,
+                        STATUS_FAILED, META_NO_GROUP)
+from flowcontrol import AimdController, Overloaded, OVERLOAD_STATUSES, pump
+from transform import read_frame
+import schemas
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
@@ -14,9 +26,23 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
 BASE_URL = "http://localhost:8080/FROST-Server/v1.1"
 HEADERS = {"Content-Type": "application/json"}
 DATA_DIR = "data"
+CATALOG = None
+STATE = None
+FLOW = AimdController()
+# Ключ meta, под которым регулятор сохраняется между запусками (свой у каждого сервера и шарда)
+FLOW_KEY = None
+# Пакетная вставка через CreateObservations (dataArray); выключается, если сервер ее не поддерживает
+CREATE_OBSERVATIONS = True
+# Режим MultiDatastream: один MultiDatastream на датчик, одно наблюдение-массив на строку CSV
+MULTIDATASTREAM = False
+
+OM_MEASUREMENT = "http://www.opengis.net/def/observationType/OGC-OM/2.0/OM_Measurement"
+OM_COMPLEX = "http://www.opengis.net/def/observationType/OGC-OM/2.0/OM_ComplexObservation"
+# Наблюдений на страницу при выборке времен за день
+TIMES_PAGE_SIZE = 10000
 
 created_ids = {
-    "Things": [], "Sensors": [], "Datastreams": [],
+    "Things": [], "Sensors": [], "Datastreams": [], "MultiDatastreams": [],
     "Locations": [], "HistoricalLocations": [],
     "ObservedProperties": [], "FeaturesOfInterest": []
 }
@@ -27,7 +53,9 @@ created_ids = {
 def check_existing(endpoint, filter_str):
     try:
         url = f"{BASE_URL}/{endpoint}?$filter={filter_str}"
-        response = requests.get(url)
+        METRICS.inc("frost_lookups_total", endpoint=endpoint)
+        with METRICS.http_timer("frost", "lookup"):
+            response = requests.get(url)
         if response.status_code == 200:
             data = response.json()
             if data.get("value") and len(data["value"]) > 0:
@@ -37,14 +65,18 @@ def check_existing(endpoint, filter_str):
     return None
 
 
-def get_last_datastream_time(datastream_id):
+def get_last_datastream_time(datastream_id, entity="Datastreams", before=None):
     """
-    Запрашивает у Frost последнее наблюдение для конкретного Datastream.
-    Нужен для избежания дубликатов.
+    Запрашивает у Frost последнее наблюдение для конкретного Datastream (или MultiDatastream).
+    Нужен для избежания дубликатов. before (день YYYY-MM-DD) — только наблюдения раньше этого дня.
     """
     try:
-        url = f"{BASE_URL}/Datastreams({datastream_id})/Observations?$top=1&$orderby=phenomenonTime desc"
-        resp = requests.get(url)
+        url = f"{BASE_URL}/{entity}({datastream_id})/Observations?$top=1&$orderby=phenomenonTime desc"
+        if before:
+            url += "&$filter=" + urllib.parse.quote(f"phenomenonTime lt {before}T00:00:00Z")
+        METRICS.inc("frost_lookups_total", endpoint="Observations")
+        with METRICS.http_timer("frost", "last_time"):
+            resp = requests.get(url)
         if resp.status_code == 200:
             data = resp.json()
             if data.get('value'):
@@ -59,10 +91,33 @@ def get_last_datastream_time(datastream_id):
                     dt = dt.replace(tzinfo=timezone.utc)
                 return dt
     except Exception as e:
-        logging.warning(f"Failed to get last time for DS {datastream_id}: {e}")
+        logging.warning(f"Failed to get last time for {entity}({datastream_id}): {e}")
     return None
 
 
+def epoch_ms(t) -> int:
+    """phenomenonTime (строка ISO, интервал или Timestamp) → миллисекунды epoch для сравнения времен."""
+    return pd.Timestamp(str(t).split("/")[0]).value // 1_000_000
+
+
+def get_day_times(datastream_id, day, entity="Datastreams"):
+    """Времена (epoch, мс) наблюдений ряда за день UTC — только phenomenonTime, постранично."""
+    end = (datetime.strptime(day, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+    window = f"phenomenonTime ge {day}T00:00:00Z and phenomenonTime lt {end}T00:00:00Z"
+    url = (f"{BASE_URL}/{entity}({datastream_id})/Observations?$filter={urllib.parse.quote(window)}"
+           f"&$select=phenomenonTime&$orderby=phenomenonTime&$top={TIMES_PAGE_SIZE}")
+    out = set()
+    while url:
+        METRICS.inc("frost_lookups_total", endpoint="Observations")
+        with METRICS.http_timer("frost", "day_times"):
+            resp = requests.get(url, timeout=FLOW.timeout)
+        resp.raise_for_status()
+        data = resp.json()
+        out.update(epoch_ms(o["phenomenonTime"]) for o in data.get("value", []))
+        url = data.get("@iot.nextLink")
+    return out
+
+
 def post_entity(endpoint, data, dry_run=False):
     name = data.get("name", "")
     if "name" in data:
@@ -74,7 +129,9 @@ def post_entity(endpoint, data, dry_run=False):
         return str(uuid.uuid4())
 
     try:
-        response = requests.post(f"{BASE_URL}/{endpoint}", headers=HEADERS, json=data)
+        METRICS.inc("frost_posts_total", endpoint=endpoint)
+        with METRICS.http_timer("frost", "create"):
+            response = requests.post(f"{BASE_URL}/{endpoint}", headers=HEADERS, json=data)
         # 201 Created или 200 OK
         if response.status_code in [200, 201]:
             try:
@@ -94,41 +151,68 @@ def post_entity(endpoint, data, dry_run=False):
             except Exception:
                 pass
 
+        METRICS.inc("frost_failures_total", endpoint=endpoint)
         logging.error(f"Error creating {endpoint}: {response.text}")
         return None
     except requests.exceptions.RequestException as e:
+        METRICS.inc("frost_failures_total", endpoint=endpoint)
         logging.error(f"Request failed for {endpoint}: {e}")
         return None
 
 
-def create_observed_properties(dry_run=False):
-    obs_props = [
-        {"name": "Относительная влажность воздуха", "description": "Relative humidity in percent",
-         "definition": "http://dbpedia.org/page/Humidity"},
-        {"name": "Температура воздуха", "description": "Air temperature in Celsius",
-         "definition": "http://dbpedia.org/page/Temperature"},
-        {"name": "Атмосферное давление", "description": "Atmospheric pressure in Pa",
-         "definition": "http://dbpedia.org/page/Atmospheric_pressure"},
-        {"name": "PM2.5",
-         "description": "Concentration of particulate matter with diameter up to 2.5 micrometers in µg/m³",
-         "definition": "http://dbpedia.org/page/Particulates"},
-        {"name": "PM10",
-         "description": "Concentration of particulate matter with diameter up to 10 micrometers in µg/m³",
-         "definition": "http://dbpedia.org/page/Particulates"},
-    ]
+def patch_entity(endpoint, id_, data):
+    """Частичное обновление сущности (PATCH); True при успехе."""
+    try:
+        METRICS.inc("frost_patches_total", endpoint=endpoint)
+        with METRICS.http_timer("frost", "update"):
+            response = requests.patch(f"{BASE_URL}/{endpoint}({id_})", headers=HEADERS, json=data)
+        if response.status_code in (200, 204):
+            return True
+        logging.error(f"Error updating {endpoint}({id_}): {response.text}")
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Request failed for {endpoint}({id_}): {e}")
+    METRICS.inc("frost_failures_total", endpoint=endpoint)
+    return False
+
+
+def create_observed_properties(sensor_types, dry_run=False):
+    """ObservedProperties из реестра схем, на которые ссылаются измерения указанных типов датчиков."""
+    registry = schemas.registry()
+    names = {m["observed_property"] for t in sensor_types for m in schemas.get_schema(t).measurements.values()}
     obs_prop_ids = {}
-    for prop in obs_props:
-        id_ = post_entity("ObservedProperties", prop, dry_run)
+    for name, prop in registry.observed_properties.items():
+        if name not in names:
+            continue
+        id_ = post_entity("ObservedProperties", {"name": name, **prop}, dry_run)
         if id_:
-            obs_prop_ids[prop["name"]] = id_
+            obs_prop_ids[name] = id_
     return obs_prop_ids
 
 
 # --- Основная логика обработки ---
 
-def process_group(group, obs_prop_ids, dry_run=False):
+class _ObservedProperties(dict):
+    """ID ObservedProperties; запрашиваются у сервера только при первом обращении (для новых Datastreams)."""
+
+    def __init__(self, sensor_types, dry_run=False):
+        super().__init__()
+        self._sensor_types = sensor_types
+        self._dry_run = dry_run
+        self._loaded = False
+
+    def __missing__(self, name):
+        if not self._loaded:
+            self._loaded = True
+            self.update(create_observed_properties(self._sensor_types, self._dry_run))
+            if name in self:
+                return self[name]
+        raise KeyError(name)
+
+
+def group_desired_state(group):
     """
-    Создает Thing, Sensors, Locations, Datastreams для группы (Инвентарного номера).
+    Желаемое состояние метаданных группы (Инвентарного номера): свойства Thing,
+    номера датчиков по типам и список локаций. None, если группа неполная.
     """
     try:
         inv = group['Инвентарный номер изделия'].iloc[0]
@@ -138,63 +222,99 @@ def process_group(group, obs_prop_ids, dry_run=False):
     except Exception:
         return None
 
-    # 1. Create Thing
-    thing_data = {
-        "name": f"Стационарный датчик пыли {inv}",
-        "description": "SDS011+BME280",
-        "properties": {"brand": str(brand), "processorId": str(proc_id), "type": str(type_)}
+    # По одному датчику каждого типа из реестра схем
+    sensor_vals = {}
+    for sensor_type in schemas.sensor_types():
+        rows = group[group['sensor_type'] == sensor_type]
+        val = rows['sensor_id'].iloc[0] if not rows.empty else None
+        if pd.notna(val) and val:
+            sensor_vals[sensor_type] = normalize_sensor_id(val)
+
+    if not sensor_vals:
+        return None
+
+    locations = []
+    unique_locations = group[['address', 'lon', 'lat', 'first_seen']].drop_duplicates().reset_index(drop=True)
+    for _, row in unique_locations.iterrows():
+        try:
+            lon, lat = float(row['lon']), float(row['lat'])
+            # Парсим время появления локации
+            first_seen_iso = dateutil.parser.isoparse(str(row['first_seen'])).strftime("%Y-%m-%dT%H:%M:%SZ")
+        except (ValueError, TypeError):
+            continue  # Skip invalid time
+        locations.append({"address": str(row['address']), "lon": lon, "lat": lat, "time": first_seen_iso})
+
+    return {
+        "inv": f"{inv}",
+        "thing": {
+            "name": f"Стационарный датчик пыли {inv}",
+            "description": "SDS011+BME280",
+            "properties": {"brand": str(brand), "processorId": str(proc_id), "type": str(type_)}
+        },
+        "sensors": sensor_vals,
+        "locations": locations,
     }
-    thing_id = post_entity("Things", thing_data, dry_run)
-    if not thing_id: return None
 
-    # 2. Find Sensors IDs
-    sds_rows = group[group['sensor_type'] == 'SDS011']
-    bme_rows = group[group['sensor_type'] == 'BME280']
 
-    sds_sensor_id_val = sds_rows['sensor_id'].iloc[0] if not sds_rows.empty else None
-    bme_sensor_id_val = bme_rows['sensor_id'].iloc[0] if not bme_rows.empty else None
+def group_fingerprint(desired):
+    """Отпечаток желаемого состояния вместе с описанием типов датчиков (Sensors / Datastreams) из реестра."""
+    specs = {t: {"sensor": schemas.get_schema(t).sensor, "measurements": schemas.get_schema(t).measurements}
+             for t in desired["sensors"]}
+    specs = {t: {**spec, "multidatastream": schemas.get_schema(t).multidatastream if MULTIDATASTREAM else None}
+             for t, spec in specs.items()}
+    raw = json.dumps([desired, specs], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
 
-    if not sds_sensor_id_val and not bme_sensor_id_val:
-        return None
 
-    # 3. Create Sensors entities
-    sds_db_id = None
-    if sds_sensor_id_val:
-        sds_data = {
-            "name": f"SDS011_{inv}",
-            "description": "PM Sensor",
-            "encodingType": "application/pdf",
-            "metadata": "https://nova-fitness.com/SDS011.pdf"
-        }
-        sds_db_id = post_entity("Sensors", sds_data, dry_run)
-
-    bme_db_id = None
-    if bme_sensor_id_val:
-        bme_data = {
-            "name": f"BME280_{inv}",
-            "description": "Meteo Sensor",
-            "encodingType": "application/pdf",
-            "metadata": "https://bosch.com/BME280.pdf"
-        }
-        bme_db_id = post_entity("Sensors", bme_data, dry_run)
+def _location_key(loc):
+    return f"{loc['address']}|{loc['lon']}|{loc['lat']}|{loc['time']}"
 
-    # 4. Create Locations / HistoricalLocations / FOI
-    # (Восстановленная логика из вашего исходного кода)
-    unique_locations = group[['address', 'lon', 'lat', 'first_seen']].drop_duplicates().reset_index(drop=True)
+
+def process_group(desired, obs_prop_ids, dry_run=False, known=None):
+    """
+    Создает Thing, Sensors, Locations, Datastreams для группы (Инвентарного номера).
+    known — ID, найденные при прошлой синхронизации: для них запросы к серверу не делаются,
+    создается только то, чего еще нет (например, новая локация).
+    """
+    known = known or {}
+    inv = desired["inv"]
+    thing_data = desired["thing"]
+
+    # 1. Create Thing (или обновляем свойства, если они поменялись)
+    complete = True
+    thing_id = known.get("thing_id")
+    if thing_id and known.get("thing") != thing_data and not dry_run:
+        complete = patch_entity("Things", thing_id, {"description": thing_data["description"],
+                                                     "properties": thing_data["properties"]})
+    elif not thing_id:
+        thing_id = post_entity("Things", thing_data, dry_run)
+    if not thing_id: return None
+
+    # 2. Create Sensors entities
+    known_sensors = known.get("sensors", {})
+    sensor_db_ids = {}
+    for sensor_type, sensor_val in desired["sensors"].items():
+        prev = known_sensors.get(sensor_type, {})
+        if prev.get("sensor_db_id") and prev.get("sensor_id") == sensor_val:
+            sensor_db_ids[sensor_type] = prev["sensor_db_id"]
+            continue
+        sensor_data = {"name": f"{sensor_type}_{inv}", **schemas.get_schema(sensor_type).sensor}
+        sensor_db_ids[sensor_type] = post_entity("Sensors", sensor_data, dry_run)
+        complete = complete and bool(sensor_db_ids[sensor_type])
+
+    # 3. Create Locations / HistoricalLocations / FOI
+    known_locations = known.get("locations", {})
+    locations = {}
     last_foi_id = None
 
-    for _, row in unique_locations.iterrows():
+    for loc in desired["locations"]:
+        key = _location_key(loc)
+        if key in known_locations:
+            locations[key] = known_locations[key]
+            last_foi_id = known_locations[key]["foi_id"]
+            continue
         try:
-            lon, lat = float(row['lon']), float(row['lat'])
-            address = str(row['address'])
-            first_seen_str = str(row['first_seen'])
-
-            # Парсим время появления локации
-            try:
-                parsed_time = dateutil.parser.isoparse(first_seen_str)
-                first_seen_iso = parsed_time.strftime("%Y-%m-%dT%H:%M:%SZ")
-            except ValueError:
-                continue  # Skip invalid time
+            lon, lat, address, first_seen_iso = loc["lon"], loc["lat"], loc["address"], loc["time"]
 
             # Create Location
             loc_data = {
@@ -204,7 +324,9 @@ def process_group(group, obs_prop_ids, dry_run=False):
                 "location": {"type": "Point", "coordinates": [lon, lat]}
             }
             loc_id = post_entity("Locations", loc_data, dry_run)
-            if not loc_id: continue
+            if not loc_id:
+                complete = False
+                continue
 
             # Create HistoricalLocation
             # Проверяем существование
@@ -230,19 +352,21 @@ def process_group(group, obs_prop_ids, dry_run=False):
             foi_id = post_entity("FeaturesOfInterest", foi_data, dry_run)
             if foi_id:
                 last_foi_id = foi_id  # Запоминаем последний FOI, чтобы использовать при загрузке
+                locations[key] = {"loc_id": loc_id, "foi_id": foi_id}
+            else:
+                complete = False
 
         except Exception as e:
+            complete = False
             logging.error(f"Error processing location for {inv}: {e}")
 
-    # 5. Create Datastreams
-    ds_ids = {}
-
+    # 4. Create Datastreams
     def create_ds(name, desc, unit, symb, sens_db_id, prop_name):
         if not sens_db_id: return None
         ds_data = {
             "name": name,
             "description": desc,
-            "observationType": "http://www.opengis.net/def/observationType/OGC-OM/2.0/OM_Measurement",
+            "observationType": OM_MEASUREMENT,
             "unitOfMeasurement": {"name": unit, "symbol": symb, "definition": "http://unknown"},
             "Thing": {"@iot.id": thing_id},
             "Sensor": {"@iot.id": sens_db_id},
@@ -250,171 +374,455 @@ def process_group(group, obs_prop_ids, dry_run=False):
         }
         return post_entity("Datastreams", ds_data, dry_run)
 
-    ds_ids["P1"] = create_ds(f"PM10_{inv}", "PM10", "microgram per cubic meter", "µg/m³", sds_db_id, "PM10")
-    ds_ids["P2"] = create_ds(f"PM2.5_{inv}", "PM2.5", "microgram per cubic meter", "µg/m³", sds_db_id, "PM2.5")
-    ds_ids["temperature"] = create_ds(f"Temperature_{inv}", "Temp", "Celsius", "°C", bme_db_id, "Температура воздуха")
-    ds_ids["humidity"] = create_ds(f"Humidity_{inv}", "Hum", "Percent", "%", bme_db_id,
-                                   "Относительная влажность воздуха")
-    ds_ids["pressure"] = create_ds(f"Pressure_{inv}", "Press", "Hectopascal", "hPa", bme_db_id, "Атмосферное давление")
+    def create_mds(schema, sens_db_id):
+        if not sens_db_id: return None
+        measurements = list(schema.measurements.values())
+        mds_data = {
+            "name": schema.multidatastream["name"].format(inv=inv),
+            "description": schema.multidatastream["description"],
+            "observationType": OM_COMPLEX,
+            "multiObservationDataTypes": [OM_MEASUREMENT] * len(measurements),
+            "unitOfMeasurements": [{"name": m["unit"], "symbol": m["symbol"], "definition": "http://unknown"}
+                                   for m in measurements],
+            "Thing": {"@iot.id": thing_id},
+            "Sensor": {"@iot.id": sens_db_id},
+            "ObservedProperties": [{"@iot.id": obs_prop_ids[m["observed_property"]]} for m in measurements]
+        }
+        return post_entity("MultiDatastreams", mds_data, dry_run)
+
+    # Datastream на каждое измерение схемы (колонка CSV → Datastream ID) или один MultiDatastream на датчик.
+    # ID другой модели сохраняются: по ним при смене режима определяется, с какого времени продолжать
+    sensors = {}
+    for sensor_type, sensor_val in desired["sensors"].items():
+        schema = schemas.get_schema(sensor_type)
+        prev = known_sensors.get(sensor_type, {})
+        # Ряды прошлой синхронизации годятся, только если Sensor создан и это тот же Sensor
+        reuse = sensor_db_ids[sensor_type] is not None and prev.get("sensor_db_id") == sensor_db_ids[sensor_type]
+        ds_ids = dict(prev.get("ds_ids", {})) if reuse else {}
+        mds_id = prev.get("mds_id") if reuse else None
+        if MULTIDATASTREAM:
+            if not mds_id:
+                mds_id = create_mds(schema, sensor_db_ids[sensor_type])
+                complete = complete and bool(mds_id)
+        else:
+            for column, m in schema.measurements.items():
+                if ds_ids.get(column):
+                    continue
+                ds_ids[column] = create_ds(m["datastream"].format(inv=inv), m["description"], m["unit"],
+                                           m["symbol"], sensor_db_ids[sensor_type], m["observed_property"])
+                complete = complete and bool(ds_ids[column])
+        sensors[sensor_type] = {"sensor_id": sensor_val, "sensor_db_id": sensor_db_ids[sensor_type],
+                                "ds_ids": ds_ids, "mds_id": mds_id}
 
     return {
         "thing_id": thing_id,
-        "sds_val": sds_sensor_id_val,
-        "bme_val": bme_sensor_id_val,
-        "ds_ids": ds_ids,
-        "foi_id": last_foi_id  # Передаем FOI ID для наблюдений
+        "thing": thing_data,
+        "sensors": sensors,
+        "locations": locations,
+        "foi_id": last_foi_id,  # Передаем FOI ID для наблюдений
+        "complete": complete,
     }
 
 
-def upload_observations_safe(sensor_id, datastream_ids, sensor_type, start_date_str, end_date_str, foi_id=None):
+def sync_group(group, obs_prop_ids, dry_run=False, owner=True):
     """
-    Загружает наблюдения, проверяя дату на сервере для избежания дублей.
+    Синхронизация метаданных группы по отпечатку: если желаемое состояние не менялось
+    с прошлой успешной синхронизации, ID берутся из state.sqlite без единого запроса.
+    owner=False (группу синхронизирует другой воркер) — только готовый результат с тем же отпечатком.
+    """
+    desired = group_desired_state(group)
+    if desired is None:
+        return None
+    fingerprint = group_fingerprint(desired)
+    cached = STATE.get_sync(BASE_URL, desired["inv"]) if STATE else None
+    if cached and cached[0] == fingerprint:
+        METRICS.inc("metadata_sync_total", result="unchanged")
+        return cached[1]
+    if not owner:
+        METRICS.inc("metadata_sync_total", result="waiting")
+        logging.info(f"Group {desired['inv']} is synced by another shard; its sensors are uploaded on a later run")
+        return None
+
+    res = process_group(desired, obs_prop_ids, dry_run, known=cached[1] if cached else None)
+    METRICS.inc("metadata_sync_total", result="updated" if cached else "created")
+    if res and STATE and not dry_run:
+        # Неполный результат сохраняется без отпечатка: в следующий раз досоздается только недостающее
+        STATE.set_sync(BASE_URL, desired["inv"], fingerprint if res["complete"] else None, res)
+    return res
+
+
+def _retry_after(resp):
+    try:
+        return float(resp.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _may_have_landed(exc) -> bool:
+    """False, только если соединение с сервером не установилось и запрос точно не дошел."""
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return False
+    reason = getattr(exc.args[0], "reason", None) if exc.args else None
+    return not isinstance(reason, NewConnectionError)
+
+
+def missing_observations(chunk, entity="Datastream"):
+    """
+    Наблюдения пачки, времени которых в ряду за тот же день на сервере нет.
+    Нужна после таймаута CreateObservations: запрос мог записаться, слепой повтор дал бы дубли.
     """
+    present = {}
+    for ds_id, day in {(o[0], o[1][:10]) for o in chunk}:
+        present[(ds_id, day)] = get_day_times(ds_id, day, f"{entity}s")
+    unsent = [o for o in chunk if epoch_ms(o[1]) not in present[(o[0], o[1][:10])]]
+    if len(unsent) < len(chunk):
+        logging.info(f"{len(chunk) - len(unsent)} of {len(chunk)} observations reached the server "
+                     f"before the failure; resending {len(unsent)}")
+    return unsent
+
+
+def _post_observation(ds_id, ts_str, value, foi_id, entity="Datastream"):
+    """Одно наблюдение через /Observations (если нет CreateObservations); True при успехе."""
+    obs = {"phenomenonTime": ts_str, "result": value, entity: {"@iot.id": ds_id}}
+    # Привязка FeatureOfInterest (координаты)
+    if foi_id:
+        obs["FeatureOfInterest"] = {"@iot.id": foi_id}
+    METRICS.inc("frost_posts_total", endpoint="Observations")
     try:
-        start = datetime.strptime(start_date_str, "%Y-%m-%d").date()
-        end = datetime.strptime(end_date_str, "%Y-%m-%d").date()
-    except Exception:
+        with METRICS.http_timer("frost", "observation"):
+            resp = requests.post(f"{BASE_URL}/Observations", headers=HEADERS, json=obs, timeout=FLOW.timeout)
+    except requests.exceptions.RequestException:
+        return False
+    return resp.status_code in (200, 201)
+
+
+def post_observations(chunk, foi_id, sensor_type, entity="Datastream"):
+    """
+    Отправляет пачку [(ds_id, phenomenonTime, result)] одним запросом CreateObservations.
+    entity — "Datastream" или "MultiDatastream" (тогда result — список значений измерений).
+    Возвращает число отклоненных наблюдений; при 429 / 5xx / таймауте бросает Overloaded,
+    чтобы регулятор снизил нагрузку и повторил пачку. Запрос не идемпотентен: если он мог дойти
+    (таймаут чтения, обрыв соединения, нечитаемый ответ), повтор идет через missing_observations.
+    """
+    global CREATE_OBSERVATIONS
+    if not CREATE_OBSERVATIONS:
+        failed = sum(not _post_observation(ds_id, ts, v, foi_id, entity) for ds_id, ts, v in chunk)
+        METRICS.inc("observations_uploaded_total", len(chunk) - failed, sensor_type=sensor_type)
+        METRICS.inc("frost_failures_total", failed, endpoint="Observations")
+        return failed
+
+    components = ["phenomenonTime", "result"] + (["FeatureOfInterest/id"] if foi_id else [])
+    by_ds = {}
+    for ds_id, ts, value in chunk:
+        by_ds.setdefault(ds_id, []).append([ts, value, foi_id] if foi_id else [ts, value])
+    payload = [{entity: {"@iot.id": ds_id}, "components": components, "dataArray": rows}
+               for ds_id, rows in by_ds.items()]
+
+    METRICS.inc("frost_posts_total", endpoint="CreateObservations")
+    try:
+        with METRICS.http_timer("frost", "observations"):
+            resp = requests.post(f"{BASE_URL}/CreateObservations", headers=HEADERS, json=payload,
+                                 timeout=FLOW.timeout)
+    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+        reason = "timeout" if isinstance(e, requests.exceptions.Timeout) else "connection"
+        raise Overloaded(reason, maybe_applied=_may_have_landed(e))
+
+    if resp.status_code in OVERLOAD_STATUSES:
+        raise Overloaded(f"http_{resp.status_code}", _retry_after(resp))
+    if resp.status_code in (404, 405, 501):
+        # Расширение dataArray выключено на сервере — дальше по одному наблюдению
+        if CREATE_OBSERVATIONS:
+            logging.warning(f"CreateObservations is not available ({resp.status_code}); "
+                            f"falling back to one request per observation")
+            CREATE_OBSERVATIONS = False
+            FLOW.limit_batch(1)
+        return post_observations(chunk, foi_id, sensor_type, entity)
+    if resp.status_code not in (200, 201):
+        logging.error(f"CreateObservations failed: {resp.status_code} {resp.text[:200]}")
+        METRICS.inc("frost_failures_total", len(chunk), endpoint="CreateObservations")
+        return len(chunk)
+
+    # Ответ — ссылка на каждое созданное наблюдение или "error..." для отклоненного
+    try:
+        links = resp.json()
+    except ValueError:
+        links = None
+    if not isinstance(links, list):
+        # Запрос выполнен, но неизвестно, какие наблюдения приняты: сверяемся с сервером
+        logging.warning(f"CreateObservations returned an unreadable response: {resp.text[:200]}")
+        raise Overloaded("bad_response", maybe_applied=True)
+    failed = sum(1 for link in links if not str(link).startswith("http")) + max(0, len(chunk) - len(links))
+    METRICS.inc("observations_uploaded_total", len(chunk) - failed, sensor_type=sensor_type)
+    if failed:
+        METRICS.inc("frost_failures_total", failed, endpoint="CreateObservations")
+    return failed
+
+
+def build_observations(df, keys, datastream_ids, multidatastream_id=None):
+    """
+    Наблюдения дня [(ds_id, phenomenonTime, result)] по колонкам, без построчного обхода.
+    df['timestamp'] уже приведен к UTC. С multidatastream_id строка — одно наблюдение-массив.
+    """
+    times = [t.isoformat() for t in df['timestamp']]
+    observations = []
+    if multidatastream_id:
+        # Одна строка — одно наблюдение [значения в порядке измерений схемы]; пропуски — null
+        matrix = [df[k].to_numpy(dtype=float, na_value=float("nan")) if k in df.columns
+                  else [float("nan")] * len(df) for k in keys]
+        for i, ts_str in enumerate(times):
+            row = [float(col[i]) if col[i] == col[i] else None for col in matrix]
+            if any(v is not None for v in row):
+                observations.append((multidatastream_id, ts_str, row))
+        return observations
+
+    for key in keys:
+        ds_id = datastream_ids.get(key)
+        if not ds_id or key not in df.columns:
+            continue
+        values = df[key].to_numpy(dtype=float, na_value=float("nan"))
+        observations.extend((ds_id, times[i], float(values[i]))
+                            for i in range(len(values)) if values[i] == values[i])
+    return observations
+
+
+def upload_observations_safe(sensor_id, datastream_ids, sensor_type, start_date_str, end_date_str, foi_id=None,
+                             days=None, multidatastream_id=None):
+    """
+    Загружает наблюдения, проверяя дату на сервере для избежания дублей.
+    days — точный список дней от планировщика; если не задан, берется диапазон start..end.
+    multidatastream_id — грузить строки CSV наблюдениями-массивами в MultiDatastream, а не по Datastream на колонку.
+    Результат по каждому дню отмечается в state.sqlite (upload: done / failed).
+    """
+    if days is None:
+        try:
+            start = datetime.strptime(start_date_str, "%Y-%m-%d").date()
+            end = datetime.strptime(end_date_str, "%Y-%m-%d").date()
+        except Exception:
+            return
+        days = day_range(start, end)
+    if not days:
         return
+    start_date_str, end_date_str = min(days), max(days)
+
+    schema = schemas.get_schema(sensor_type)
+    keys = list(schema.measurements)
 
     # 1. ПРОВЕРКА ДАТЫ НА СЕРВЕРЕ (Дедупликация)
-    check_key = "P1" if sensor_type == "SDS011" else "temperature"
-    target_ds_id = datastream_ids.get(check_key)
+    # Учитываются обе модели: после смены режима загрузка продолжается с последнего времени старых рядов
+    targets = [(datastream_ids.get(schema.check_column), "Datastreams"), (multidatastream_id, "MultiDatastreams")]
+    targets = [(id_, entity) for id_, entity in targets if id_]
+
+    def last_time(before=None):
+        return max((t for t in (get_last_datastream_time(id_, entity, before=before) for id_, entity in targets)
+                    if t), default=None)
+
+    # Дни, куда уже писал живой опрос (live.py), сверяются по временам наблюдений. Остальным нужна
+    # граница без его свежих данных: для дней до первого такого дня — одна общая, после — по дню
+    all_live = {d for d, st in STATE.statuses(STAGE_LIVE, sensor_type, sensor_id).items() if st == STATUS_DONE}
+    first_live = min(all_live) if all_live else None
+    live_days = all_live & set(days)
+
+    def cutoff(date_str):
+        if first_live and date_str > first_live:
+            next_day = datetime.strptime(date_str, "%Y-%m-%d").date() + timedelta(days=1)
+            return last_time(before=next_day.isoformat())
+        return last_server_time
 
     last_server_time = None
-    if target_ds_id:
-        last_server_time = get_last_datastream_time(target_ds_id)
+    if targets:
+        last_server_time = last_time(before=first_live)
         if last_server_time:
             logging.info(f"Sensor {sensor_id} ({sensor_type}): Last data on server {last_server_time}")
         else:
             logging.info(f"Sensor {sensor_id} ({sensor_type}): No data on server. Full upload.")
 
-    current = start
-    while current <= end:
-        date_str = current.strftime("%Y-%m-%d")
+    # Файлы датчика за период — одним запросом к каталогу, без проверок диска по каждому дню
+    day_files = {
+        e['day']: CATALOG.full_path(e)
+        for e in CATALOG.files(sensor_type, sensor_id, start=start_date_str, end=end_date_str)
+    }
 
-        # Оптимизация: пропуск дня целиком, если он старше данных на сервере
-        if last_server_time:
-            current_dt_end = datetime.combine(current, datetime.max.time()).replace(tzinfo=timezone.utc)
-            if current_dt_end < last_server_time:
-                current += timedelta(days=1)
+    def day_batches():
+        # Дни читаются лениво: в памяти только файлы, пачки которых сейчас в полете
+        for date_str in days:
+            last_known = None if date_str in live_days else cutoff(date_str)
+            # Оптимизация: пропуск дня целиком, если он старше данных на сервере
+            if last_known:
+                current = datetime.strptime(date_str, "%Y-%m-%d").date()
+                current_dt_end = datetime.combine(current, datetime.max.time()).replace(tzinfo=timezone.utc)
+                if current_dt_end < last_known:
+                    STATE.mark(STAGE_UPLOAD, sensor_type, sensor_id, date_str, STATUS_DONE, detail="on_server")
+                    continue
+
+            csv_path = day_files.get(date_str)
+            if not csv_path:
+                # Скачан, но файла в каталоге нет (удален, каталог пересобран): без отметки день считался бы
+                # ожидающим загрузки на каждом прогоне. Сбрасываем скачивание — скрапер заберет файл снова
+                logging.warning(f"{sensor_type} {sensor_id} {date_str}: no archive file in the catalog; "
+                                f"scheduling a new download")
+                STATE.mark(STAGE_DOWNLOAD, sensor_type, sensor_id, date_str, STATUS_FAILED, detail="no_file")
+                STATE.mark(STAGE_UPLOAD, sensor_type, sensor_id, date_str, STATUS_FAILED, detail="no_file")
                 continue
 
-        # Формирование пути к файлу
-        subfolder = "SDS011" if sensor_type == "SDS011" else "BME280"
-        filename = f"{date_str}_{sensor_type.lower()}_sensor_{sensor_id}.csv"
-        csv_path = os.path.join(DATA_DIR, subfolder, str(sensor_id), filename)
-
-        if not os.path.exists(csv_path):
-            current += timedelta(days=1)
-            continue
-
-        try:
-            df = pd.read_csv(csv_path, sep=";", engine='python')
-            if df.empty or "timestamp" not in df.columns:
-                current += timedelta(days=1)
+            try:
+                # Разбор общий с обработкой (обычно файл уже в кэше), timestamp уже в UTC
+                df = read_frame(schema, csv_path)
+                if "timestamp" not in df.columns:
+                    STATE.mark(STAGE_UPLOAD, sensor_type, sensor_id, date_str, STATUS_DONE, detail="empty")
+                    continue
+                df = df[df['timestamp'].notna()]
+                if df.empty:
+                    STATE.mark(STAGE_UPLOAD, sensor_type, sensor_id, date_str, STATUS_DONE, detail="empty")
+                    continue
+
+                # ФИЛЬТРАЦИЯ СТРОК (Только новые)
+                if last_known:
+                    df = df[df['timestamp'] > last_known]
+
+                if df.empty:
+                    STATE.mark(STAGE_UPLOAD, sensor_type, sensor_id, date_str, STATUS_DONE, detail="on_server")
+                    continue
+
+                observations = build_observations(df, keys, datastream_ids, multidatastream_id)
+                if date_str in live_days:
+                    # Сверка с живым опросом: только времена, которых в ряду за этот день еще нет
+                    plural = "MultiDatastreams" if multidatastream_id else "Datastreams"
+                    present = {id_: get_day_times(id_, date_str, plural) for id_ in {o[0] for o in observations}}
+                    total = len(observations)
+                    observations = [o for o in observations if epoch_ms(o[1]) not in present[o[0]]]
+                    logging.info(f"Sensor {sensor_id} {date_str}: {total - len(observations)} of {total} "
+                                 f"observations already sent by the live poller")
+            except Exception as e:
+                logging.error(f"Error processing CSV {csv_path}: {e}")
+                STATE.mark(STAGE_UPLOAD, sensor_type, sensor_id, date_str, STATUS_FAILED, detail=str(e)[:200])
                 continue
 
-            # Парсинг и приведение к UTC
-            df['timestamp'] = pd.to_datetime(df['timestamp'], utc=True)
-
-            # ФИЛЬТРАЦИЯ СТРОК (Только новые)
-            if last_server_time:
-                df = df[df['timestamp'] > last_server_time]
-
-            if df.empty:
-                current += timedelta(days=1)
+            if not observations:
+                STATE.mark(STAGE_UPLOAD, sensor_type, sensor_id, date_str, STATUS_DONE)
                 continue
+            logging.info(f"Uploading {len(observations)} records for {sensor_id} on {date_str}")
+            yield date_str, observations
+
+    # Отправка: параллелизм и размер пачек подбирает FLOW по ответам сервера
+    entity = "MultiDatastream" if multidatastream_id else "Datastream"
+    results = pump(day_batches(), lambda chunk: post_observations(chunk, foi_id, sensor_type, entity), FLOW,
+                   reconcile=lambda chunk: missing_observations(chunk, entity))
+    for date_str, res in results.items():
+        if res["failed"]:
+            STATE.mark(STAGE_UPLOAD, sensor_type, sensor_id, date_str, STATUS_FAILED,
+                       detail=f"{res['failed']} of {res['sent'] + res['failed']} observations failed")
+        else:
+            STATE.mark(STAGE_UPLOAD, sensor_type, sensor_id, date_str, STATUS_DONE)
 
-            observations = []
-            keys = ["P1", "P2"] if sensor_type == "SDS011" else ["temperature", "humidity", "pressure"]
-
-            for _, row in df.iterrows():
-                ts_str = row['timestamp'].isoformat()
-
-                for key in keys:
-                    ds_id = datastream_ids.get(key)
-                    val = row.get(key)
-
-                    if ds_id and pd.notna(val):
-                        obs = {
-                            "phenomenonTime": ts_str,
-                            "result": float(val),
-                            "Datastream": {"@iot.id": ds_id}
-                        }
-                        # Привязка FeatureOfInterest (координаты)
-                        if foi_id:
-                            obs["FeatureOfInterest"] = {"@iot.id": foi_id}
-
-                        observations.append(obs)
-
-            # Отправка
-            if observations:
-                logging.info(f"Uploading {len(observations)} records for {sensor_id} on {date_str}")
-                for obs in observations:
-                    requests.post(f"{BASE_URL}/Observations", headers=HEADERS, json=obs)
-
-        except Exception as e:
-            logging.error(f"Error processing CSV {csv_path}: {e}")
 
-        current += timedelta(days=1)
+def open_session(config):
+    """Настраивает модуль на сервер из конфига: каталог, state.sqlite и регулятор загрузки."""
+    global BASE_URL, DATA_DIR, CATALOG, STATE, FLOW, FLOW_KEY, CREATE_OBSERVATIONS, MULTIDATASTREAM
+    BASE_URL = config['frost_url']
+    DATA_DIR = config['data_dir']
+    CREATE_OBSERVATIONS = True
+    MULTIDATASTREAM = bool(config.get('multidatastream', False))
+    if MULTIDATASTREAM:
+        logging.info("MultiDatastream mode: one array observation per CSV row")
+    CATALOG = FileCatalog(DATA_DIR)
+    STATE = open_state_store(config)
+    # Регулятор стартует с настроек, найденных прошлым запуском этого воркера для этого сервера
+    FLOW_KEY = f"upload_flow:{BASE_URL}{get_shard(config).suffix}"
+    FLOW = AimdController(**config.get('upload', {}))
+    FLOW.restore(STATE.get_meta(FLOW_KEY))
+    logging.info(f"🎛️ Upload flow start: {FLOW.snapshot()}")
+
+
+def close_session():
+    logging.info(f"🎛️ Upload flow end: {FLOW.snapshot()}")
+    STATE.set_meta(FLOW_KEY, FLOW.dump())
+    CATALOG.close()
+    STATE.close()
 
 
 def run_upload(config):
+    """Синхронизирует метаданные и наблюдения с FROST; возвращает True, если проход завершен."""
     logging.info("--- Starting Upload (Safe Mode) ---")
-    global BASE_URL, DATA_DIR
-    BASE_URL = config['frost_url']
-    DATA_DIR = config['data_dir']
+    data_dir = config['data_dir']
 
-    excel_path = os.path.join(DATA_DIR, "all_stats.xlsx")
+    excel_path = os.path.join(data_dir, "all_stats.xlsx")
     if not os.path.exists(excel_path):
         logging.warning("all_stats.xlsx not found.")
-        return
+        return False
 
     try:
         df = pd.read_excel(excel_path)
     except Exception:
         logging.error("Failed to read all_stats.xlsx")
-        return
-
-    obs_prop_ids = create_observed_properties()
-
-    sds_conf = config['sensors'].get('sds', {})
-    bme_conf = config['sensors'].get('bme', {})
-
-    if 'Инвентарный номер изделия' in df.columns:
-        groups = df.groupby('Инвентарный номер изделия')
-        for inv, group in groups:
-            logging.info(f"Processing Inventory: {inv}")
-
-            # Создаем структуру на сервере (Things, Sensors...)
-            res = process_group(group, obs_prop_ids)
-            if not res: continue
-
-            # Загружаем SDS данные
-            if res['sds_val'] and str(res['sds_val']) in sds_conf:
-                cfg = sds_conf[str(res['sds_val'])]
-                upload_observations_safe(
-                    res['sds_val'],
-                    res['ds_ids'],
-                    "SDS011",
-                    cfg['start'],
-                    cfg['end'],
-                    res['foi_id']  # Передаем ID гео-точки
-                )
-
-            # Загружаем BME данные
-            if res['bme_val'] and str(res['bme_val']) in bme_conf:
-                cfg = bme_conf[str(res['bme_val'])]
-                upload_observations_safe(
-                    res['bme_val'],
-                    res['ds_ids'],
-                    "BME280",
-                    cfg['start'],
-                    cfg['end'],
-                    res['foi_id']
-                )
-
+        return False
+
+    active = schemas.active_types(config)
+    # Группу синхронизирует владелец инвентарного номера, а в ней могут быть типы, которых нет
+    # в его доле конфига: ObservedProperties нужны для всех типов из all_stats.xlsx
+    present = set(df['sensor_type'].dropna().astype(str)) if 'sensor_type' in df.columns else set()
+    obs_prop_ids = _ObservedProperties([s.name for s in active]
+                                       + sorted(present & set(schemas.sensor_types()) - {s.name for s in active}))
+    open_session(config)
+    try:
+        shard = get_shard(config)
+        if config.get('resync_metadata'):
+            dropped = STATE.clear_sync(BASE_URL)
+            logging.info(f"Metadata resync requested: forgot {dropped} synced group(s) for {BASE_URL}")
+
+        # Датчикам без инвентарной группы (нет в description.xlsx) грузить некуда: запоминаем их,
+        # чтобы планировщик не запускал загрузку ради их дней на каждом прогоне
+        grouped = set()
+        if {'Инвентарный номер изделия', 'sensor_type', 'sensor_id'} <= set(df.columns):
+            rows = df.loc[df['Инвентарный номер изделия'].notna(), ['sensor_type', 'sensor_id']]
+            grouped = {(str(t), normalize_sensor_id(i)) for t, i in rows.itertuples(index=False)}
+        no_group = sorted(f"{s.name}:{normalize_sensor_id(i)}" for s in active
+                          for i in config['sensors'].get(s.config_key, {})
+                          if (s.name, normalize_sensor_id(i)) not in grouped)
+        if no_group:
+            logging.warning(f"No inventory group in all_stats.xlsx for {', '.join(no_group)}; "
+                            f"their days are not uploaded until they appear in description.xlsx")
+        STATE.set_meta(META_NO_GROUP + shard.suffix, json.dumps(no_group))
+
+        if 'Инвентарный номер изделия' in df.columns:
+            groups = df.groupby('Инвентарный номер изделия')
+            for inv, group in groups:
+                # Метаданные группы синхронизирует один воркер — владелец инвентарного номера;
+                # остальные воркеры с датчиками группы берут готовые ID из state.sqlite
+                if not any(shard.owns(s) for s in group['sensor_id'].dropna().unique()) and not shard.owns(inv):
+                    continue
+                logging.info(f"Processing Inventory: {inv}")
+
+                # Создаем структуру на сервере (Things, Sensors...)
+                # Lease не дает двум воркерам одновременно создать одну и ту же Thing
+                with shard.lease(DATA_DIR, f"thing-{inv}"):
+                    res = sync_group(group, obs_prop_ids, owner=shard.owns(inv))
+                if not res: continue
+
+                # Загружаем данные каждого датчика группы, который есть в конфиге
+                for sensor_type, sensor in res['sensors'].items():
+                    type_conf = config['sensors'].get(schemas.get_schema(sensor_type).config_key, {})
+                    if str(sensor['sensor_id']) not in type_conf:
+                        continue
+                    cfg = type_conf[str(sensor['sensor_id'])]
+                    if MULTIDATASTREAM and not sensor.get('mds_id'):
+                        logging.warning(f"No MultiDatastream for {sensor_type} {sensor['sensor_id']}; skipping upload")
+                        continue
+                    with METRICS.sensor_timer('upload', sensor['sensor_id']):
+                        upload_observations_safe(
+                            sensor['sensor_id'],
+                            sensor['ds_ids'],
+                            sensor_type,
+                            cfg['start'],
+                            cfg['end'],
+                            res['foi_id'],  # Передаем ID гео-точки
+                            cfg.get('upload_days'),
+                            sensor.get('mds_id') if MULTIDATASTREAM else None
+                        )
+    finally:
+        # Сессия закрывается и настройки регулятора сохраняются и при ошибке
+        close_session()
     logging.info("--- Upload Finished ---")
+    return True
 
 
 if __name__ == "__main__":
@@ -0,0 +1,185 @@
+import json
+import os
+import re
+import sys
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+import pytest
+
+# Модули приложения плоские и импортируются так же, как при `python app/main.py`
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app")
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
+
+import schemas  # noqa: E402
+from metrics import METRICS  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def _clean_process_state():
+    """Реестр схем по умолчанию и пустые метрики в каждом тесте."""
+    schemas.load(None)
+    METRICS.reset()
+    yield
+    METRICS.reset()
+
+
+SDS_HEADER = "sensor_id;sensor_type;location;lat;lon;timestamp;P1;durP1;ratioP1;P2;durP2;ratioP2\n"
+
+
+@pytest.fixture
+def write_sds_day():
+    """Пишет файл архива SDS011 за день: write(data_dir, sensor_id, day, [(время, P1, P2)], lat, lon)."""
+
+    def write(data_dir, sensor_id, day, readings, lat=55.75, lon=37.61):
+        folder = os.path.join(str(data_dir), "SDS011", str(sensor_id))
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"{day}_sds011_sensor_{sensor_id}.csv")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(SDS_HEADER)
+            for ts, p1, p2 in readings:
+                f.write(f"{sensor_id};SDS011;1;{lat};{lon};{day}T{ts};{p1};;;{p2};;\n")
+        return path
+
+    return write
+
+
+class FakeFrost:
+    """
+    FROST в памяти для тестов загрузчика и аудита: создание сущностей (ID в заголовке Location),
+    поиск по name, выборка наблюдений ряда по phenomenonTime с $orderby/$top/$count,
+    CreateObservations, $batch и PATCH. Все запросы записываются в requests.
+    """
+
+    def __init__(self):
+        self.db = {}
+        self.requests = []
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def add(self, entity, obj):
+        with self._lock:
+            self._next_id += 1
+            obj["@iot.id"] = str(self._next_id)
+            self.db.setdefault(entity, {})[obj["@iot.id"]] = obj
+        return obj["@iot.id"]
+
+    def observations(self, entity, ds_id):
+        return [o for o in self.db.get("Observations", {}).values()
+                if str(o.get(entity, {}).get("@iot.id")) == str(ds_id)]
+
+    def created(self):
+        """Созданные сущности по типам: {"Things": 1, ...}."""
+        counts = {}
+        for method, path in self.requests:
+            if method == "POST" and "(" not in path and path not in ("/CreateObservations", "/$batch"):
+                counts[path.strip("/")] = counts.get(path.strip("/"), 0) + 1
+        return counts
+
+    def query(self, path, qs):
+        m = re.match(r"/(Multi)?Datastreams\((\w+)\)/Observations$", path)
+        if m:
+            objs = self.observations(f"{m.group(1) or ''}Datastream", m.group(2))
+        else:
+            objs = list(self.db.get(path.strip("/"), {}).values())
+        flt = qs.get("$filter", [""])[0]
+        name = re.match(r"name eq '(.*)'$", flt)
+        hist = re.match(r"time eq '(.*?)' and Thing/@iot.id eq (\w+) and Locations/any\(l:l/@iot.id eq (\w+)\)", flt)
+        if name:
+            objs = [o for o in objs if o.get("name") == name.group(1).replace("''", "'")]
+        elif hist:
+            objs = [o for o in objs if o["time"] == hist.group(1) and str(o["Thing"]["@iot.id"]) == hist.group(2)
+                    and any(str(loc["@iot.id"]) == hist.group(3) for loc in o["Locations"])]
+        for op, value in re.findall(r"phenomenonTime (ge|gt|lt|le) (\S+)", flt):
+            bound = pd.Timestamp(value)
+            cmp = {"ge": "__ge__", "gt": "__gt__", "lt": "__lt__", "le": "__le__"}[op]
+            objs = [o for o in objs if getattr(pd.Timestamp(o["phenomenonTime"].split("/")[0]), cmp)(bound)]
+        if "phenomenonTime" in qs.get("$orderby", [""])[0]:
+            objs.sort(key=lambda o: pd.Timestamp(o["phenomenonTime"].split("/")[0]),
+                      reverse=qs["$orderby"][0].endswith("desc"))
+        top = int(qs.get("$top", ["100"])[0])
+        res = {"value": objs[:top]}
+        if qs.get("$count", ["false"])[0] == "true":
+            res["@iot.count"] = len(objs)
+        return res
+
+    def create_observations(self, body):
+        links = []
+        for item in body:
+            entity = "MultiDatastream" if "MultiDatastream" in item else "Datastream"
+            for row in item["dataArray"]:
+                obs = {entity: item[entity]}
+                for component, value in zip(item["components"], row):
+                    if component == "FeatureOfInterest/id":
+                        obs["FeatureOfInterest"] = {"@iot.id": value}
+                    else:
+                        obs[component] = value
+                links.append(f"http://frost.test/v1.1/Observations({self.add('Observations', obs)})")
+        return links
+
+
+class _FakeFrostHandler(BaseHTTPRequestHandler):
+    frost = None
+
+    def _path(self):
+        url = urllib.parse.urlparse(self.path)
+        path = url.path.split("/v1.1", 1)[-1]
+        self.frost.requests.append((self.command, path))
+        return path, urllib.parse.parse_qs(url.query)
+
+    def _body(self):
+        return json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"null")
+
+    def _send(self, code, body=None, headers=None):
+        data = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.send_response(code)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        path, qs = self._path()
+        self._send(200, self.frost.query(path, qs))
+
+    def do_POST(self):
+        path, _ = self._path()
+        body = self._body()
+        if path == "/CreateObservations":
+            return self._send(201, self.frost.create_observations(body))
+        if path == "/$batch":
+            answers = []
+            for r in body["requests"]:
+                url = urllib.parse.urlparse("/" + r["url"].lstrip("/"))
+                answers.append({"id": r["id"], "status": 200,
+                                "body": self.frost.query(url.path, urllib.parse.parse_qs(url.query))})
+            return self._send(200, {"responses": answers})
+        entity = path.strip("/")
+        id_ = self.frost.add(entity, body)
+        self._send(201, None, {"Location": f"http://frost.test/v1.1/{entity}({id_})"})
+
+    def do_PATCH(self):
+        path, _ = self._path()
+        entity, id_ = re.match(r"/(\w+)\((\w+)\)", path).groups()
+        self.frost.db.get(entity, {}).get(id_, {}).update(self._body())
+        self._send(200, {})
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+@pytest.fixture
+def fake_frost():
+    """Сервер FakeFrost на свободном порту: (frost, base_url)."""
+    frost = FakeFrost()
+    handler = type("Handler", (_FakeFrostHandler,), {"frost": frost})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield frost, f"http://127.0.0.1:{server.server_port}/FROST-Server/v1.1"
+    server.shutdown()
+    server.server_close()
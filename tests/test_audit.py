@@ -0,0 +1,81 @@
+import pytest
+
+from audit import run_audit
+from metrics import METRICS
+from statestore import STAGE_UPLOAD, STATUS_DONE, StateStore
+
+DAYS = ["2025-06-01", "2025-06-02", "2025-07-01"]
+READINGS = [("00:00:00", 10.0, 5.0), ("00:05:00", 12.0, 6.0), ("00:10:00", 14.0, 7.0)]
+DS_IDS = {"P1": "13", "P2": "14"}
+
+
+@pytest.fixture
+def audited(tmp_path, fake_frost, write_sds_day, monkeypatch):
+    """Архив и FROST с загруженными днями датчика 82312; run() запускает аудит и возвращает статистику."""
+    monkeypatch.delenv("ETL_SHARD_INDEX", raising=False)
+    monkeypatch.delenv("ETL_SHARD_COUNT", raising=False)
+    frost, url = fake_frost
+    for day in DAYS:
+        write_sds_day(tmp_path, 82312, day, READINGS)
+        for ts, p1, p2 in READINGS:
+            for column, value in (("P1", p1), ("P2", p2)):
+                frost.add("Observations", {"Datastream": {"@iot.id": DS_IDS[column]},
+                                           "phenomenonTime": f"{day}T{ts}Z", "result": value})
+    with StateStore(str(tmp_path)) as store:
+        store.set_sync(url, "РСУНДПл000001", "fp", {
+            "thing_id": "1", "foi_id": "7", "complete": True,
+            "sensors": {"SDS011": {"sensor_id": "82312", "sensor_db_id": "3", "ds_ids": DS_IDS, "mds_id": None}},
+        })
+        for day in DAYS:
+            store.mark(STAGE_UPLOAD, "SDS011", "82312", day, STATUS_DONE)
+    config = {"frost_url": url, "data_dir": str(tmp_path),
+              "sensors": {"sds": {"82312": {"start": DAYS[0], "end": "auto"}}}}
+
+    def run():
+        frost.requests.clear()
+        return run_audit(config)
+
+    return frost, run
+
+
+def _drop(frost, ds_id, phenomenon_time):
+    obs = frost.db["Observations"]
+    (key,) = [k for k, o in obs.items()
+              if o["Datastream"]["@iot.id"] == ds_id and o["phenomenonTime"] == phenomenon_time]
+    del obs[key]
+
+
+def test_matching_months_need_a_single_count_batch(audited):
+    frost, run = audited
+    stats = run()
+    assert stats["months"] == 2 and stats["months_mismatched"] == 0
+    assert frost.requests == [("POST", "/$batch")]
+    # Один $count на ряд и месяц, по дням — ничего
+    assert METRICS.counter("audit_count_queries_total") == 4
+
+
+def test_missing_day_is_found_by_drill_down_and_repaired(audited, tmp_path):
+    frost, run = audited
+    _drop(frost, "14", "2025-06-02T00:05:00Z")
+
+    stats = run()
+    assert stats["months_mismatched"] == 1 and stats["days_missing"] == 1
+    # Месяцы (2 ряда x 2 месяца), затем дни только несошедшегося июня (2 ряда x 2 дня)
+    assert METRICS.counter("audit_count_queries_total") == 8
+    # Догружено ровно недостающее наблюдение, через CreateObservations
+    assert stats["observations_repaired"] == 1 and stats.get("observations_failed", 0) == 0
+    assert frost.requests.count(("POST", "/CreateObservations")) == 1
+    assert len(frost.observations("Datastream", "14")) == len(DAYS) * len(READINGS)
+    with StateStore(str(tmp_path)) as store:
+        assert set(store.statuses(STAGE_UPLOAD, "SDS011", "82312").values()) == {STATUS_DONE}
+
+    assert run()["months_mismatched"] == 0
+
+
+def test_extra_observations_are_reported_not_repaired(audited):
+    frost, run = audited
+    frost.add("Observations", {"Datastream": {"@iot.id": "13"}, "phenomenonTime": "2025-07-01T00:00:00Z",
+                               "result": 10.0})
+    stats = run()
+    assert stats["days_extra"] == 1 and "days_missing" not in stats
+    assert ("POST", "/CreateObservations") not in frost.requests
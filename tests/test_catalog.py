@@ -0,0 +1,62 @@
+import os
+
+from catalog import FileCatalog, STATUS_MISSING, STATUS_OK, count_rows
+
+READINGS = [("00:00:00", 10.0, 5.0), ("00:05:00", 12.0, 6.0)]
+
+
+def test_count_rows():
+    assert count_rows("") == 0
+    assert count_rows("header\n") == 0
+    assert count_rows("header\na\nb\n") == 2
+    assert count_rows("header\na\nb") == 2
+
+
+def test_first_open_builds_catalog_from_disk(tmp_path, write_sds_day):
+    write_sds_day(tmp_path, 82312, "2025-06-01", READINGS)
+    write_sds_day(tmp_path, 82312, "2025-06-02", READINGS[:1])
+    (tmp_path / "SDS011" / "82312" / "notes.txt").write_text("не файл архива")
+
+    with FileCatalog(str(tmp_path)) as catalog:
+        rows = catalog.files("SDS011")
+        assert [(r["sensor_id"], r["day"], r["rows"]) for r in rows] == [
+            ("82312", "2025-06-01", 2), ("82312", "2025-06-02", 1)]
+        assert catalog.has_file("SDS011", 82312, "2025-06-01")
+        assert catalog.sensors("SDS011") == ["82312"]
+        assert catalog.files("SDS011", start="2025-06-02")[0]["day"] == "2025-06-02"
+
+
+def test_reconcile_detects_changes_and_keeps_missing(tmp_path, write_sds_day):
+    write_sds_day(tmp_path, 82312, "2025-06-01", READINGS)
+    removed = write_sds_day(tmp_path, 82312, "2025-06-02", READINGS)
+    with FileCatalog(str(tmp_path)) as catalog:
+        catalog.record_missing("SDS011", 82312, "2025-06-03")
+
+        os.remove(removed)
+        path = write_sds_day(tmp_path, 82312, "2025-06-01", READINGS + [("00:10:00", 1.0, 1.0)])
+        os.utime(path, (1, 1))
+        write_sds_day(tmp_path, 82313, "2025-06-01", READINGS)
+
+        stats = catalog.reconcile()
+        assert stats == {"added": 1, "updated": 1, "removed": 1, "unchanged": 0}
+        assert catalog.get("SDS011", 82312, "2025-06-01")["rows"] == 3
+        assert catalog.get("SDS011", 82312, "2025-06-02") is None
+        assert catalog.get("SDS011", 82312, "2025-06-03")["status"] == STATUS_MISSING
+        assert catalog.reconcile()["unchanged"] == 2
+
+
+def test_file_stats_invalidated_by_rewrite(tmp_path, write_sds_day):
+    path = write_sds_day(tmp_path, 82312, "2025-06-01", READINGS)
+    with FileCatalog(str(tmp_path)) as catalog:
+        row = catalog.get("SDS011", 82312, "2025-06-01")
+        catalog.set_file_stats([(row, {"counts": {"P1": 2}})])
+        assert catalog.file_stats(catalog.get("SDS011", 82312, "2025-06-01"))["counts"] == {"P1": 2}
+
+        st = os.stat(path)
+        catalog.record("SDS011", 82312, "2025-06-01", status=STATUS_OK, size=st.st_size + 1, mtime=st.st_mtime)
+        assert catalog.file_stats(catalog.get("SDS011", 82312, "2025-06-01")) == {}
+
+
+def test_catalog_uses_wal(tmp_path):
+    with FileCatalog(str(tmp_path)) as catalog:
+        assert catalog.conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
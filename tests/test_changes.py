@@ -0,0 +1,122 @@
+import json
+
+import pandas as pd
+import pytest
+
+import changes
+from catalog import FileCatalog
+from sharding import Shard
+from statestore import StateStore
+
+
+def _all_stats(**lat):
+    # INV1 синхронизирует шард 0 (владелец номера), в ней датчик шарда 1; INV2 целиком у шарда 1
+    rows = [("SDS011", 82312, "INV1"), ("BME280", 82310, "INV1"), ("SDS011", 82311, "INV2")]
+    return pd.DataFrame([{"sensor_type": t, "sensor_id": i, "lat": lat.get(f"s{i}", 55.75),
+                          "Инвентарный номер изделия": inv} for t, i, inv in rows])
+
+
+def test_upload_fingerprint_ignores_rows_of_other_shards(tmp_path):
+    config = {"data_dir": str(tmp_path), "frost_url": "http://frost.test/v1.1"}
+    shards = [Shard(0, 2), Shard(1, 2)]
+    with StateStore(str(tmp_path)) as store:
+        def fingerprints(all_stats):
+            changes.remember_all_stats(store, all_stats, shards[0])
+            return [changes.upload_fingerprint(config, store, s) for s in shards]
+
+        before = fingerprints(_all_stats())
+        # Датчик группы, с которой шард 0 не связан, переехал: загрузчик шарда 0 не будится
+        moved = fingerprints(_all_stats(s82311=55.80))
+        assert moved[0] == before[0] and moved[1] != before[1]
+        # Датчик шарда 1 в группе шарда 0: метаданные группы сверяют оба
+        moved = fingerprints(_all_stats(s82310=55.80))
+        assert moved[0] != before[0] and moved[1] != before[1]
+
+
+def test_upload_fingerprint_without_row_digest_uses_file(tmp_path):
+    config = {"data_dir": str(tmp_path), "frost_url": "http://frost.test/v1.1"}
+    with StateStore(str(tmp_path)) as store:
+        before = changes.upload_fingerprint(config, store, Shard())
+        (tmp_path / "all_stats.xlsx").write_bytes(b"xlsx")
+        assert changes.upload_fingerprint(config, store, Shard()) != before
+
+
+def test_remember_and_unchanged_per_suffix(tmp_path):
+    with StateStore(str(tmp_path)) as store:
+        assert not changes.unchanged(store, "process", "fp1")
+        changes.remember(store, "process", "fp1")
+        assert changes.unchanged(store, "process", "fp1")
+        assert not changes.unchanged(store, "process", "fp2")
+        # У каждого шарда свой отпечаток
+        assert not changes.unchanged(store, "process", "fp1", ".shard-0-of-2")
+        # None (этап не завершился) сбрасывает отпечаток: этап повторится
+        changes.remember(store, "process", None)
+        assert not changes.unchanged(store, "process", "fp1")
+
+
+def test_processing_fingerprint_inputs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config = {"data_dir": str(tmp_path / "data"), "geocoder": {"provider": "offline"}}
+    (tmp_path / "data").mkdir()
+
+    def fingerprint(**overrides):
+        return changes.processing_fingerprint({**config, **overrides}, Shard())
+
+    base = fingerprint()
+    assert fingerprint() == base
+    assert fingerprint(geocoder={"provider": "mapbox"}) != base
+    assert fingerprint(location_cluster_radius_m=50) != base
+
+    description = tmp_path / "data" / "description.xlsx"
+    description.write_bytes(b"v1")
+    with_description = fingerprint()
+    assert with_description != base
+    description.write_bytes(b"v2, longer")
+    assert fingerprint() != with_description
+
+
+def test_processing_fingerprint_follows_own_archive_files(tmp_path, write_sds_day):
+    config = {"data_dir": str(tmp_path)}
+    mine, other = Shard(0, 2), Shard(1, 2)
+    write_sds_day(tmp_path, 82312, "2025-06-01", [("00:00:00", 1.0, 2.0)])  # датчик шарда 0
+    before = [changes.processing_fingerprint(config, s) for s in (mine, other)]
+    write_sds_day(tmp_path, 82312, "2025-06-02", [("00:00:00", 1.0, 2.0)])
+    with FileCatalog(str(tmp_path)) as catalog:
+        catalog.reconcile()
+    after = [changes.processing_fingerprint(config, s) for s in (mine, other)]
+    assert after[0] != before[0] and after[1] == before[1]
+
+
+@pytest.fixture
+def job(tmp_path, monkeypatch):
+    """main.main() на пустом конфиге; этапы обработки и загрузки подменены счетчиками запусков."""
+    import main
+    import processor
+    import uploader
+    for var in ("ETL_SHARD_INDEX", "ETL_SHARD_COUNT", "ETL_FORCE", "ETL_RESYNC_METADATA"):
+        monkeypatch.delenv(var, raising=False)
+    config = {"data_dir": str(tmp_path), "frost_url": "http://frost.test/v1.1", "sensors": {}}
+    monkeypatch.setattr(main, "load_config", lambda: json.loads(json.dumps(config)))
+    calls = []
+
+    def run_upload(cfg):
+        calls.append("upload" + (" resync" if cfg.get("resync_metadata") else ""))
+        return True
+
+    monkeypatch.setattr(processor, "run_processing", lambda cfg: calls.append("process") or True)
+    monkeypatch.setattr(uploader, "run_upload", run_upload)
+
+    def run(*args):
+        calls.clear()
+        main.main(list(args))
+        return list(calls)
+
+    return run
+
+
+def test_unchanged_tree_skips_processing_and_upload(job):
+    assert job() == ["process", "upload"]
+    assert job() == []
+    assert job("--force") == ["process", "upload"]
+    assert job("--resync-metadata") == ["upload resync"]
+    assert job() == []
@@ -0,0 +1,139 @@
+import threading
+
+from flowcontrol import AimdController, Overloaded, pump
+from metrics import METRICS
+
+
+def test_additive_increase_below_target_latency():
+    ctl = AimdController(initial_concurrency=2, initial_batch=100, batch_step=50, target_latency_s=1.0)
+    for _ in range(4):
+        ctl.on_success(0.1)
+    assert ctl.concurrency == 3
+    assert ctl.batch_size == 300
+    assert METRICS.gauges[("upload_batch_size", ())] == 300
+
+
+def test_multiplicative_decrease_once_per_window():
+    ctl = AimdController(initial_concurrency=8, initial_batch=400, min_concurrency=1, min_batch=10)
+    ctl.on_overload("429")
+    ctl.on_overload("429")
+    assert (ctl.concurrency, ctl.batch_size) == (4, 200)
+    assert METRICS.counter("upload_throttled_total", reason="429") == 2
+
+
+def test_slow_responses_back_off_within_limits():
+    ctl = AimdController(initial_concurrency=1, initial_batch=10, min_concurrency=1, min_batch=10,
+                         target_latency_s=0.5)
+    ctl.on_success(5.0)
+    assert (ctl.concurrency, ctl.batch_size) == (1, 10)
+
+
+def test_restore_starts_from_half_of_saved_concurrency():
+    ctl = AimdController(max_concurrency=16)
+    ctl.restore('{"concurrency": 12, "batch": 900}')
+    assert (ctl.concurrency, ctl.batch_size) == (6, 900)
+    ctl.restore("not json")
+    assert ctl.concurrency == 6
+
+
+def test_limit_batch():
+    ctl = AimdController(initial_batch=500)
+    ctl.limit_batch(1)
+    ctl.on_success(0.01)
+    assert ctl.batch_size == 1
+
+
+def test_pump_splits_batches_and_reports_per_tag():
+    ctl = AimdController(initial_batch=3, max_batch=3, initial_concurrency=2)
+    sent, lock = [], threading.Lock()
+
+    def send(chunk):
+        with lock:
+            sent.append(list(chunk))
+        return sum(1 for x in chunk if x < 0)
+
+    res = pump([("a", list(range(7))), ("b", [-1, 5])], send, ctl)
+    assert res == {"a": {"sent": 7, "failed": 0}, "b": {"sent": 1, "failed": 1}}
+    assert all(len(c) <= 3 for c in sent)
+    assert sorted(x for c in sent for x in c) == sorted(list(range(7)) + [-1, 5])
+
+
+def test_pump_retries_overload_with_smaller_batches():
+    ctl = AimdController(initial_batch=8, min_batch=2, max_retries=3)
+    calls = []
+
+    def send(chunk):
+        calls.append(len(chunk))
+        if len(calls) == 1:
+            raise Overloaded("503", retry_after=0)
+        return 0
+
+    res = pump([("a", list(range(8)))], send, ctl)
+    assert res == {"a": {"sent": 8, "failed": 0}}
+    assert calls == [8, 4, 4]
+    assert METRICS.counter("upload_retries_total") == 1
+
+
+def test_pump_gives_up_after_max_retries():
+    ctl = AimdController(initial_batch=4, max_retries=2)
+
+    def send(chunk):
+        raise Overloaded("timeout", retry_after=0)
+
+    assert pump([("a", [1, 2, 3])], send, ctl) == {"a": {"sent": 0, "failed": 3}}
+
+
+def test_maybe_applied_resends_only_reconciled_items():
+    ctl = AimdController(initial_batch=10)
+    server, calls = set(), []
+
+    def send(chunk):
+        calls.append(list(chunk))
+        server.update(chunk)
+        if len(calls) == 1:
+            # Запись прошла, но ответ не дошел
+            raise Overloaded("timeout", retry_after=0, maybe_applied=True)
+        return 0
+
+    res = pump([("a", [1, 2, 3])], send, ctl, reconcile=lambda part: [x for x in part if x not in server])
+    assert res == {"a": {"sent": 3, "failed": 0}}
+    assert calls == [[1, 2, 3]]
+
+
+def test_maybe_applied_without_reconcile_is_not_resent():
+    ctl = AimdController(initial_batch=10)
+    calls = []
+
+    def send(chunk):
+        calls.append(chunk)
+        raise Overloaded("timeout", retry_after=0, maybe_applied=True)
+
+    assert pump([("a", [1, 2])], send, ctl) == {"a": {"sent": 0, "failed": 2}}
+    assert len(calls) == 1
+
+
+def test_failed_reconcile_counts_batch_as_failed():
+    ctl = AimdController(initial_batch=10)
+
+    def send(chunk):
+        raise Overloaded("timeout", retry_after=0, maybe_applied=True)
+
+    def reconcile(part):
+        raise RuntimeError("server unavailable")
+
+    assert pump([("a", [1, 2])], send, ctl, reconcile=reconcile) == {"a": {"sent": 0, "failed": 2}}
+
+
+def test_only_unestablished_connections_are_safe_to_resend():
+    import requests
+    from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+    import uploader
+
+    # Так requests оборачивает отказ в соединении
+    refused = requests.exceptions.ConnectionError(
+        MaxRetryError(None, "/v1.1/CreateObservations", reason=NewConnectionError(None, "Connection refused")))
+    assert not uploader._may_have_landed(requests.exceptions.ConnectTimeout("connect timeout"))
+    assert not uploader._may_have_landed(refused)
+    assert uploader._may_have_landed(requests.exceptions.ReadTimeout("read timeout"))
+    assert uploader._may_have_landed(requests.exceptions.ConnectionError("connection reset by peer"))
@@ -0,0 +1,114 @@
+import logging
+
+import pandas as pd
+import pytest
+
+import geocoder
+from geocoder import Geocoder, OfflineGeocoder, build_gazetteer_index, ensure_gazetteer_index
+from metrics import METRICS
+
+GAZETTEER = [
+    (55.7539, 37.6208, "Красная площадь, 1"),
+    (55.7520, 37.6175, "Кремль, 1"),
+    (55.7601, 37.6186, "Театральная площадь, 1"),
+    (59.9398, 30.3146, "Дворцовая площадь, 2"),
+]
+
+
+class _Fallback(Geocoder):
+    name = "fallback"
+
+    def __init__(self):
+        self.queries = []
+        self.closed = False
+
+    def reverse_bulk(self, df, *, lat_col="lat", lon_col="lon"):
+        self.queries.extend(zip(df[lat_col], df[lon_col]))
+        METRICS.inc("geocode_hits_total", len(df), provider=self.name)
+        return pd.Series(["из fallback"] * len(df), index=df.index)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def index_dir(tmp_path):
+    src = tmp_path / "gazetteer.csv"
+    pd.DataFrame(GAZETTEER, columns=["lat", "lon", "address"]).to_csv(src, index=False)
+    out = tmp_path / "index"
+    build_gazetteer_index(str(src), str(out))
+    return out
+
+
+def test_nearest_address_within_radius(index_dir):
+    geo = OfflineGeocoder(str(index_dir))
+    try:
+        assert geo.reverse(37.6209, 55.7540) == "Красная площадь, 1"
+        assert geo.reverse(30.3150, 59.9400) == "Дворцовая площадь, 2"
+        # Ближайшая точка дальше max_distance_m
+        assert geo.reverse(37.6400, 55.7540) is None
+    finally:
+        geo.close()
+
+
+def test_bulk_keeps_index_and_counts_invalid_coordinates(index_dir):
+    df = pd.DataFrame({"lat": [55.7521, 55.7539, None, 10.0], "lon": [37.6176, 37.6208, 37.6, 10.0]},
+                      index=[10, 11, 12, 13])
+    geo = OfflineGeocoder(str(index_dir))
+    try:
+        out = geo.reverse_bulk(df)
+    finally:
+        geo.close()
+    assert list(out.index) == [10, 11, 12, 13]
+    assert out.tolist() == ["Кремль, 1", "Красная площадь, 1", None, None]
+    assert METRICS.counter("geocode_hits_total", provider="offline") == 2
+    assert METRICS.counter("geocode_misses_total", provider="offline") == 2
+
+
+def test_fallback_gets_only_misses_and_counts_them(index_dir):
+    fallback = _Fallback()
+    geo = OfflineGeocoder(str(index_dir), fallback=fallback)
+    df = pd.DataFrame({"lat": [55.7539, 10.0, None], "lon": [37.6208, 10.0, None]})
+    out = geo.reverse_bulk(df)
+    geo.close()
+
+    assert out.tolist() == ["Красная площадь, 1", "из fallback", None]
+    assert fallback.queries == [(10.0, 10.0)]
+    assert fallback.closed
+    # Каждая точка учтена один раз: промах, переданный fallback, считает только он
+    assert METRICS.counter("geocode_hits_total", provider="offline") == 1
+    assert METRICS.counter("geocode_hits_total", provider="fallback") == 1
+    assert METRICS.counter("geocode_misses_total", provider="offline") == 1
+
+
+def test_radius_warning_depends_on_latitude(index_dir, caplog):
+    # Ячейка 0.005° по долготе: ~313 м на широте Москвы, ~0 м у полюса
+    geo = OfflineGeocoder(str(index_dir), max_distance_m=300)
+    with caplog.at_level(logging.WARNING):
+        geo.reverse(37.62, 55.75)
+        assert not [r for r in caplog.records if "Gazetteer cell" in r.message]
+        geo.reverse(10.0, 80.0)
+        assert [r for r in caplog.records if "Gazetteer cell" in r.message]
+    geo.close()
+
+
+def test_index_rebuilt_only_when_source_changes(tmp_path, monkeypatch):
+    src = tmp_path / "gazetteer.csv"
+    pd.DataFrame(GAZETTEER[:1], columns=["lat", "lon", "address"]).to_csv(src, index=False)
+    out = tmp_path / "index"
+    builds = []
+    real_build = geocoder.build_gazetteer_index
+    monkeypatch.setattr(geocoder, "build_gazetteer_index", lambda *a, **k: (builds.append(a), real_build(*a, **k)))
+
+    ensure_gazetteer_index(str(src), str(out))
+    ensure_gazetteer_index(str(src), str(out))
+    assert len(builds) == 1
+
+    pd.DataFrame(GAZETTEER, columns=["lat", "lon", "address"]).to_csv(src, index=False)
+    ensure_gazetteer_index(str(src), str(out))
+    assert len(builds) == 2
+
+
+def test_missing_index_without_source(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        ensure_gazetteer_index(None, str(tmp_path / "index"))
@@ -0,0 +1,162 @@
+import asyncio
+import datetime
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+import pytest
+
+import schemas
+import uploader
+from flowcontrol import AimdController
+from live import LivePoller, parse_readings
+from statestore import STAGE_LIVE, StateStore
+
+SERVER = "http://frost.test/FROST-Server/v1.1"
+
+
+def reading(ts, p1, p2, sensor_type="SDS011"):
+    return {"timestamp": ts.strftime("%Y-%m-%d %H:%M:%S"),
+            "sensor": {"id": 82312, "sensor_type": {"name": sensor_type}},
+            "sensordatavalues": [{"value_type": "P1", "value": str(p1)}, {"value_type": "P2", "value": str(p2)},
+                                 {"value_type": "noise", "value": "1"}]}
+
+
+class _LiveApi(BaseHTTPRequestHandler):
+    """Заглушка API data.sensor.community: ответ по номеру датчика, ETag и 304 на If-None-Match."""
+    protocol_version = "HTTP/1.1"
+    version = "v1"
+    payloads = {}
+    requests = []
+
+    def do_GET(self):
+        sensor_id = self.path.strip("/").split("/")[-1]
+        etag = f'"{self.version}-{sensor_id}"'
+        self.requests.append((sensor_id, self.headers.get("If-None-Match")))
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = json.dumps(self.payloads.get(sensor_id, [])).encode("utf-8")
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+@pytest.fixture
+def live_api():
+    _LiveApi.version, _LiveApi.payloads, _LiveApi.requests = "v1", {}, []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _LiveApi)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield _LiveApi, f"http://127.0.0.1:{server.server_port}/airrohr/v1/sensor"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def frost(tmp_path, monkeypatch):
+    """Состояние с синхронизированной группой и FROST, который запоминает отправленные наблюдения."""
+    monkeypatch.delenv("ETL_SHARD_INDEX", raising=False)
+    monkeypatch.delenv("ETL_SHARD_COUNT", raising=False)
+    store = StateStore(str(tmp_path))
+    store.set_sync(SERVER, "РСУНДПл000001", "fp", {
+        "thing_id": "1", "foi_id": "7", "complete": True,
+        "sensors": {"SDS011": {"sensor_id": "82312", "sensor_db_id": "3",
+                               "ds_ids": {"P1": "13", "P2": "14"}, "mds_id": None}},
+    })
+    posted, server_last = [], {"time": None}
+
+    def post_observations(chunk, foi_id, sensor_type, entity="Datastream"):
+        posted.extend(chunk)
+        return 0
+
+    monkeypatch.setattr(uploader, "STATE", store)
+    monkeypatch.setattr(uploader, "BASE_URL", SERVER)
+    monkeypatch.setattr(uploader, "MULTIDATASTREAM", False)
+    monkeypatch.setattr(uploader, "FLOW", AimdController())
+    monkeypatch.setattr(uploader, "post_observations", post_observations)
+    monkeypatch.setattr(uploader, "get_last_datastream_time", lambda ds_id, entity, before=None: server_last["time"])
+    yield store, posted, server_last
+    store.close()
+
+
+def make_config(tmp_path, url):
+    return {"data_dir": str(tmp_path), "sensors": {"sds": {"82312": {"start": "2025-06-01", "end": "auto"},
+                                                          "99999": {"start": "2025-06-01", "end": "auto"}}},
+            "live": {"url": url, "interval_s": 0, "concurrency": 2, "timeout_s": 5}}
+
+
+def test_parse_readings_keeps_schema_columns():
+    now = pd.Timestamp("2025-06-01 12:00:00")
+    payload = [reading(now, 10, 5), reading(now, 10, 5), reading(now + pd.Timedelta(minutes=5), "bad", 6),
+               reading(now, 1, 1, sensor_type="BME280"), {"timestamp": "not a time"}]
+    df = parse_readings(schemas.get_schema("SDS011"), payload)
+    assert list(df.columns) == ["timestamp", "P1", "P2"]
+    assert df["timestamp"].dt.tz is not None
+    assert len(df) == 2
+    assert pd.isna(df["P1"].iloc[1]) and df["P2"].iloc[1] == 6.0
+
+
+def test_poll_sends_new_readings_once(tmp_path, live_api, frost):
+    api, url = live_api
+    store, posted, _ = frost
+    now = pd.Timestamp.now(tz="UTC").floor("min").tz_localize(None)
+    api.payloads["82312"] = [reading(now - pd.Timedelta(minutes=10 - 5 * i), 10 + i, 5 + i) for i in range(3)]
+
+    poller = LivePoller(make_config(tmp_path, url))
+    try:
+        asyncio.run(poller.run(cycles=2))
+        # 3 показания × 2 Datastream; второй опрос — 304, ничего не отправлено
+        assert len(posted) == 6
+        assert {o[0] for o in posted} == {"13", "14"}
+        assert api.requests[1] == ("82312", '"v1-82312"')
+
+        # Новая версия ответа: одно показание уже отправлено, одно новое
+        api.version = "v2"
+        api.payloads["82312"] = api.payloads["82312"][-1:] + [reading(now + pd.Timedelta(minutes=5), 20, 9)]
+        asyncio.run(poller.run(cycles=1))
+        assert len(posted) == 8
+        assert sorted(o[2] for o in posted[-2:]) == [9.0, 20.0]
+    finally:
+        poller.close()
+
+    day = now.strftime("%Y-%m-%d")
+    assert store.statuses(STAGE_LIVE, "SDS011", "82312") == {day: "done"}
+    # Отчет обновляется после каждого опроса
+    report = json.loads((tmp_path / "metrics" / "run_report.json").read_text(encoding="utf-8"))
+    assert report["counters"]["live_polls_total"] == {"result=not_modified": 1, "result=ok": 2}
+
+
+def test_restart_skips_what_the_server_already_has(tmp_path, live_api, frost):
+    api, url = live_api
+    _, posted, server_last = frost
+    now = pd.Timestamp.now(tz="UTC").floor("min").tz_localize(None)
+    api.payloads["82312"] = [reading(now - pd.Timedelta(minutes=10 - 5 * i), 10 + i, 5 + i) for i in range(3)]
+    server_last["time"] = (now - pd.Timedelta(minutes=5)).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    poller = LivePoller(make_config(tmp_path, url))
+    try:
+        asyncio.run(poller.run(cycles=1))
+    finally:
+        poller.close()
+    assert len(posted) == 2
+    assert {o[1] for o in posted} == {now.tz_localize(datetime.timezone.utc).isoformat()}
+
+
+def test_failed_poll_does_not_stop_the_cycle(tmp_path, frost):
+    _, posted, _ = frost
+    poller = LivePoller(make_config(tmp_path, "http://127.0.0.1:9/airrohr/v1/sensor"))
+    try:
+        stats = asyncio.run(poller.poll_once())
+    finally:
+        poller.close()
+    assert stats["errors"] == 1 and stats["sensors"] == 1
+    assert posted == []
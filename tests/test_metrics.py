@@ -0,0 +1,74 @@
+import json
+import threading
+
+from metrics import Histogram, Metrics, METRIC_PREFIX
+
+
+def test_counters_by_labels_and_total():
+    m = Metrics()
+    m.inc("files_total", result="ok")
+    m.inc("files_total", 2, result="ok")
+    m.inc("files_total", result="missing")
+    assert m.counter("files_total", result="ok") == 3
+    assert m.counter("files_total") == 4
+    assert m.counter("files_total", result="failed") == 0
+
+
+def test_counters_are_thread_safe():
+    m = Metrics()
+    threads = [threading.Thread(target=lambda: [m.inc("hits_total") for _ in range(1000)]) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert m.counter("hits_total") == 8000
+
+
+def test_histogram_buckets_are_cumulative():
+    h = Histogram(buckets=(0.1, 1.0))
+    for v in (0.05, 0.5, 5.0):
+        h.observe(v)
+    assert h.counts == [1, 2]
+    assert h.total == 3
+    assert h.to_dict()["buckets"] == {"0.1": 1, "1.0": 2}
+
+
+def test_report_observation_rate():
+    m = Metrics()
+    m.inc("observations_uploaded_total", 500, sensor_type="SDS011")
+    m.stages["upload"] = 2.0
+    report = m.report()
+    assert report["observations_per_s"] == 250.0
+    assert report["counters"]["observations_uploaded_total"] == {"sensor_type=SDS011": 500}
+
+
+def test_prometheus_escapes_label_values():
+    m = Metrics()
+    m.set_const_labels(shard="0")
+    m.inc("errors_total", reason='bad "quote"\\path\nline')
+    text = m.to_prometheus(m.report())
+    assert f'{METRIC_PREFIX}errors_total{{reason="bad \\"quote\\"\\\\path\\nline",shard="0"}} 1' in text
+    # Каждая метрика на одной строке — файл читается textfile-коллектором
+    assert all(line.startswith(("# TYPE ", METRIC_PREFIX)) for line in text.splitlines())
+
+
+def test_prometheus_histogram_lines():
+    m = Metrics()
+    m.observe("http_request_duration_seconds", 0.2, target="frost", op="post")
+    text = m.to_prometheus(m.report())
+    name = f"{METRIC_PREFIX}http_request_duration_seconds"
+    assert f'{name}_bucket{{op="post",target="frost",le="0.25"}} 1' in text
+    assert f'{name}_bucket{{op="post",target="frost",le="+Inf"}} 1' in text
+    assert f'{name}_count{{op="post",target="frost"}} 1' in text
+
+
+def test_write_report_per_suffix(tmp_path):
+    m = Metrics()
+    m.inc("runs_total")
+    path = m.write_report(str(tmp_path), status="failed", error="boom", suffix=".shard-1-of-2")
+    assert path == str(tmp_path / "metrics" / "run_report.shard-1-of-2.json")
+    report = json.loads((tmp_path / "metrics" / "run_report.shard-1-of-2.json").read_text(encoding="utf-8"))
+    assert (report["status"], report["error"]) == ("failed", "boom")
+    prom = (tmp_path / "metrics" / "sensor_etl.shard-1-of-2.prom").read_text(encoding="utf-8")
+    assert f"{METRIC_PREFIX}run_success 0" in prom
+    assert not list((tmp_path / "metrics").glob("*.tmp"))
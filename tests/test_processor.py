@@ -0,0 +1,80 @@
+import math
+
+import pandas as pd
+
+from geocoder import M_PER_DEG_LAT, M_PER_DEG_LON
+from processor import cluster_locations, previous_centers
+
+T = pd.Timestamp
+
+
+def _north(lat, lon, meters):
+    return lat + meters / M_PER_DEG_LAT, lon
+
+
+def _east(lat, lon, meters):
+    return lat, lon + meters / (M_PER_DEG_LON * math.cos(math.radians(lat)))
+
+
+HOME = (55.75, 37.61)
+
+
+def test_jitter_within_radius_is_merged_with_union_of_bounds():
+    points = {
+        HOME: [T("2025-06-01 00:00"), T("2025-06-01 23:00")],
+        _north(*HOME, 8): [T("2025-06-02 00:00"), T("2025-06-03 12:00")],
+        _east(*HOME, -10): [T("2025-05-30 06:00"), T("2025-05-30 07:00")],
+    }
+    merged = cluster_locations(points, 25)
+    # Центр — самая ранняя точка, границы — объединение всех
+    assert merged == {_east(*HOME, -10): [T("2025-05-30 06:00"), T("2025-06-03 12:00")]}
+
+
+def test_points_beyond_radius_stay_separate():
+    far = _east(*HOME, 40)
+    points = {HOME: [T("2025-06-01"), T("2025-06-02")], far: [T("2025-06-03"), T("2025-06-04")]}
+    assert cluster_locations(points, 25) == points
+
+
+def test_neighbours_across_grid_cell_boundary_are_found():
+    radius = 25.0
+    edge = math.ceil(HOME[0] / (radius / M_PER_DEG_LAT)) * radius / M_PER_DEG_LAT
+    below, above = _north(edge, HOME[1], -3), _north(edge, HOME[1], 3)
+    assert math.floor(below[0] / (radius / M_PER_DEG_LAT)) != math.floor(above[0] / (radius / M_PER_DEG_LAT))
+    merged = cluster_locations({below: [T("2025-06-01"), T("2025-06-01")],
+                                above: [T("2025-06-02"), T("2025-06-02")]}, radius)
+    assert merged == {below: [T("2025-06-01"), T("2025-06-02")]}
+
+
+def test_zero_radius_is_noop():
+    points = {HOME: [T("2025-06-01"), T("2025-06-02")], _north(*HOME, 1): [T("2025-06-03"), T("2025-06-04")]}
+    assert cluster_locations(points, 0) == points
+    assert cluster_locations(points, 0, anchors=[HOME]) == points
+
+
+def test_backfilled_older_day_keeps_previous_center():
+    jitter = _north(*HOME, 5)
+    first = cluster_locations({HOME: [T("2025-06-10"), T("2025-06-12")]}, 25)
+    # Дозагрузили более ранний день с дрожанием: центр остается прежним, расширяются только границы
+    backfilled = {HOME: [T("2025-06-10"), T("2025-06-12")], jitter: [T("2025-06-01"), T("2025-06-01 12:00")]}
+    assert cluster_locations(backfilled, 25, anchors=list(first)) == {HOME: [T("2025-06-01"), T("2025-06-12")]}
+    # Без прошлых центров центром стала бы новая ранняя точка
+    assert list(cluster_locations(backfilled, 25)) == [jitter]
+
+
+def test_previous_center_without_points_is_dropped():
+    moved = _east(*HOME, 500)
+    assert cluster_locations({moved: [T("2025-06-01"), T("2025-06-02")]}, 25, anchors=[HOME]) == \
+        {moved: [T("2025-06-01"), T("2025-06-02")]}
+
+
+def test_previous_centers_from_all_stats(tmp_path):
+    path = tmp_path / "all_stats.xlsx"
+    assert previous_centers(str(path)) == {}
+    pd.DataFrame([
+        {"sensor_type": "SDS011", "sensor_id": 82312, "lat": 55.76, "lon": 37.59, "first_seen": "2025-06-10T00:00:00"},
+        {"sensor_type": "SDS011", "sensor_id": 82312, "lat": 55.75, "lon": 37.61, "first_seen": "2025-06-01T00:00:00"},
+        {"sensor_type": "BME280", "sensor_id": 82313, "lat": 55.75, "lon": 37.61, "first_seen": "2025-06-01T00:00:00"},
+    ]).to_excel(path, index=False)
+    assert previous_centers(str(path)) == {("SDS011", "82312"): [(55.75, 37.61), (55.76, 37.59)],
+                                           ("BME280", "82313"): [(55.75, 37.61)]}
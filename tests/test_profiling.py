@@ -0,0 +1,69 @@
+import os
+import pstats
+import time
+import tracemalloc
+from contextlib import nullcontext
+
+import pytest
+
+import profiling
+
+
+@pytest.fixture(autouse=True)
+def _no_profiler():
+    profiling.finish()
+    yield
+    profiling.finish()
+
+
+def _busy(seconds):
+    end = time.perf_counter() + seconds
+    data = []
+    while time.perf_counter() < end:
+        data.append(bytearray(1024))
+    return len(data)
+
+
+def test_stage_is_a_shared_nullcontext_when_disabled(tmp_path):
+    ctx = profiling.stage("process")
+    assert isinstance(ctx, nullcontext) and ctx is profiling.stage("upload")
+    with ctx:
+        pass
+    profiling.finish()
+    assert not (tmp_path / "profiles").exists()
+
+
+def test_enabled_stage_writes_pstats_memory_and_summary(tmp_path):
+    profiler = profiling.enable(str(tmp_path), run_name="run1")
+    run_dir = tmp_path / "profiles" / "run1"
+    assert profiler.out_dir == str(run_dir)
+
+    with profiling.stage("process"):
+        _busy(0.05)
+        with profiling.stage("geocode"):
+            _busy(0.02)
+    profiling.finish()
+
+    assert profiling.PROFILER is None and not tracemalloc.is_tracing()
+    for stage in ("process", "geocode"):
+        stats = pstats.Stats(str(run_dir / f"{stage}.pstats"))
+        assert any(func[2] == "_busy" for func in stats.stats)
+        memory = (run_dir / f"{stage}.memory.txt").read_text(encoding="utf-8")
+        assert memory.startswith(f"stage: {stage}\n") and "Top 25 allocation sites:" in memory
+    assert not (run_dir / "process.folded").exists()
+    summary = (run_dir / "summary.txt").read_text(encoding="utf-8")
+    assert "===== geocode =====" in summary and "===== process =====" in summary
+
+
+def test_sampling_writes_collapsed_stacks(tmp_path):
+    profiling.enable(str(tmp_path), sampling=True, interval=0.001, run_name="run2")
+    with profiling.stage("scrape"):
+        _busy(0.1)
+    profiling.finish()
+
+    lines = (tmp_path / "profiles" / "run2" / "scrape.folded").read_text(encoding="utf-8").splitlines()
+    assert lines
+    stack, count = lines[0].rsplit(" ", 1)
+    assert stack.startswith("thread:") and int(count) > 0
+    assert any("_busy" in line for line in lines)
+    assert os.path.exists(tmp_path / "profiles" / "run2" / "scrape.pstats")
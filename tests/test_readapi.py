@@ -0,0 +1,120 @@
+import json
+
+import pytest
+
+from catalog import FileCatalog
+from readapi import ApiError, ReadAPI, parse_datastream_id, parse_time_filter
+from tsstore import TimeSeriesStore
+
+T0 = 1748736000  # 2025-06-01T00:00:00Z
+BASE = "http://localhost:8090"
+
+
+def test_parse_datastream_id():
+    assert parse_datastream_id("SDS011-82312-P1") == ("SDS011", "82312", "P1", None)
+    assert parse_datastream_id("BME280-82313-temperature-1d") == ("BME280", "82313", "temperature", "1d")
+
+
+@pytest.mark.parametrize("ds_id", [
+    "SDS011-82312", "SDS011-82312-P1-5m", "XYZ-82312-P1", "SDS011-82312-temperature",
+    "SDS011-..-P1", "SDS011-82312abc-P1", "SDS011-%2e%2e-P1",
+])
+def test_parse_datastream_id_rejects(ds_id):
+    with pytest.raises(ApiError) as e:
+        parse_datastream_id(ds_id)
+    assert e.value.status == 404
+
+
+def test_parse_time_filter():
+    assert parse_time_filter("phenomenonTime ge 2025-06-01T00:00:00Z") == (T0, None)
+    assert parse_time_filter("(phenomenonTime gt 2025-06-01T00:00:00Z) and phenomenonTime lt 2025-06-02T00:00:00Z") \
+        == (T0 + 1, T0 + 86399)
+    assert parse_time_filter("phenomenonTime eq 2025-06-01T00:00:00") == (T0, T0)
+    assert parse_time_filter("phenomenonTime ge 2025-06-01T03:00:00+03:00") == (T0, None)
+    # Неэкранированный "+" в URL после декодирования становится пробелом
+    assert parse_time_filter("phenomenonTime ge 2025-06-01T03:00:00 03:00") == (T0, None)
+
+
+@pytest.mark.parametrize("flt", [
+    "phenomenonTime ge 2025-06-01T00:00:00Z or phenomenonTime le 2025-06-02T00:00:00Z",
+    "phenomenonTime ge 2025-06-01T00:00:00Z and result gt 10",
+    "not phenomenonTime ge 2025-06-01T00:00:00Z",
+    "phenomenonTime ge yesterday",
+    "phenomenonTime ge 2025-06-01 03:00:00",
+])
+def test_parse_time_filter_rejects(flt):
+    with pytest.raises(ApiError) as e:
+        parse_time_filter(flt)
+    assert e.value.status == 400
+
+
+@pytest.fixture
+def api(tmp_path, write_sds_day):
+    write_sds_day(tmp_path, 82312, "2025-06-01", [("00:00:00", 10.0, 1.0), ("00:30:00", 20.0, 2.0),
+                                                 ("01:00:00", 30.0, 3.0)])
+    with FileCatalog(str(tmp_path)) as catalog:
+        TimeSeriesStore(str(tmp_path)).update(catalog, ["SDS011"])
+    return ReadAPI(str(tmp_path))
+
+
+def _get(api, path):
+    status, body, _ = api.get(path, BASE)
+    return status, json.loads(body)
+
+
+def test_observations_paging_and_order(api):
+    status, out = _get(api, "/v1.1/Datastreams('SDS011-82312-P1')/Observations?$top=2&$count=true")
+    assert status == 200
+    assert [o["result"] for o in out["value"]] == [10.0, 20.0]
+    assert out["@iot.count"] == 3
+    assert out["@iot.nextLink"].endswith("/Observations?$top=2&$count=true&$skip=2")
+
+    _, out = _get(api, "/v1.1/Datastreams('SDS011-82312-P1')/Observations?$orderby=phenomenonTime%20desc&$top=1")
+    assert out["value"][0]["phenomenonTime"] == "2025-06-01T01:00:00Z"
+
+
+def test_rollup_observations_as_data_array(api):
+    _, out = _get(api, "/v1.1/Datastreams('SDS011-82312-P1-1h')/Observations?$resultFormat=dataArray")
+    block = out["value"][0]
+    assert block["components"] == ["id", "phenomenonTime", "result", "parameters"]
+    assert block["dataArray"][0][1:] == ["2025-06-01T00:00:00Z/2025-06-01T01:00:00Z", 15.0,
+                                         {"min": 10.0, "max": 20.0, "count": 2}]
+
+
+def test_errors_are_json(api):
+    status, out = _get(api, "/v1.1/Datastreams('SDS011-..%2F..-P1')/Observations")
+    assert status == 404 and out["code"] == 404
+    status, out = _get(api, "/v1.1/Datastreams('SDS011-82312-P1')/Observations?$filter=result%20gt%201")
+    assert status == 400 and "Unsupported $filter" in out["message"]
+    status, _ = _get(api, "/v1.1/Datastreams('SDS011-82312-P1')/Observations?$top=many")
+    assert status == 400
+
+
+def test_time_filter_with_literal_plus_offset(api):
+    status, out = _get(api, "/v1.1/Datastreams('SDS011-82312-P1')/Observations"
+                            "?$filter=phenomenonTime%20ge%202025-06-01T03:30:00+03:00&$count=true")
+    assert status == 200
+    assert out["@iot.count"] == 2 and [o["result"] for o in out["value"]] == [20.0, 30.0]
+
+
+def test_datastreams_count_only_sensors_with_data(api, tmp_path):
+    # Папка датчика без индекса (обновление хранилища прервалось) — его ряды не отдаются и не считаются
+    (tmp_path / "tsstore" / "SDS011" / "99999").mkdir(parents=True)
+    _, out = _get(api, "/v1.1/Datastreams?$count=true&$top=1000")
+    assert out["@iot.count"] == len(out["value"]) > 0
+    assert {d["properties"]["sensorId"] for d in out["value"]} == {"82312"}
+
+
+def test_datastreams_filtered_by_properties(api):
+    _, out = _get(api, "/v1.1/Datastreams?$filter=properties/column%20eq%20'P2'%20and%20properties/rollup%20eq%20''"
+                       "&$count=true")
+    assert out["@iot.count"] == 1
+    assert out["value"][0]["@iot.id"] == "SDS011-82312-P2"
+    assert out["value"][0]["phenomenonTime"] == "2025-06-01T00:00:00Z/2025-06-01T01:00:00Z"
+
+
+def test_responses_are_cached_per_store_version(api):
+    path = "/v1.1/Datastreams('SDS011-82312-P1')"
+    first = api.get(path, BASE)
+    assert api.get(path, BASE) == first
+    assert api.cache.hits == 1
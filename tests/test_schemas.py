@@ -0,0 +1,75 @@
+import json
+import logging
+
+import pytest
+
+import schemas
+
+SDS_COLUMNS = {"timestamp": "str", "lat": "float64", "lon": "float64", "P1": "float64", "P2": "float64"}
+PM10 = {"datastream": "PM10_{inv}", "description": "PM10", "unit": "µg/m³", "symbol": "µg/m³",
+        "observed_property": "PM10"}
+
+
+def _registry(tmp_path, sensor_types, observed_properties=None):
+    path = tmp_path / "schemas.json"
+    path.write_text(json.dumps({"observed_properties": observed_properties or {"PM10": {"definition": "pm10"}},
+                                "sensor_types": sensor_types}), encoding="utf-8")
+    return str(path)
+
+
+def test_load_custom_registry(tmp_path):
+    registry = schemas.load(_registry(tmp_path, {
+        "SDS011": {"config_key": "sds", "columns": SDS_COLUMNS, "measurements": {"P1": PM10}},
+        "HPM": {"columns": SDS_COLUMNS, "measurements": {"P1": PM10}, "description_column": "Honeywell"},
+    }))
+    assert schemas.registry() is registry
+    assert schemas.sensor_types() == ["SDS011", "HPM"]
+    assert schemas.config_keys() == {"sds": "SDS011", "hpm": "HPM"}
+    hpm = schemas.get_schema("HPM")
+    assert hpm.description_column == "Honeywell"
+    assert hpm.filename("82312", "2025-06-01") == "2025-06-01_hpm_sensor_82312.csv"
+    # Без description_column номер датчика ищется в колонке с именем типа
+    assert schemas.get_schema("SDS011").description_column == "SDS011"
+    with pytest.raises(ValueError, match="Unknown sensor type BME280"):
+        schemas.get_schema("BME280")
+
+
+def test_registry_rejects_undeclared_columns_and_properties(tmp_path):
+    columns = {k: v for k, v in SDS_COLUMNS.items() if k != "P1"}
+    with pytest.raises(ValueError, match=r"columns \['P1'\] are not declared"):
+        schemas.load(_registry(tmp_path, {"SDS011": {"columns": columns, "measurements": {"P1": PM10}}}))
+    with pytest.raises(ValueError, match="unknown ObservedProperty"):
+        schemas.load(_registry(tmp_path, {"SDS011": {"columns": SDS_COLUMNS,
+                                                     "measurements": {"P1": {**PM10, "observed_property": "PM42"}}}}))
+
+
+def test_check_config_warns_about_unknown_types(caplog):
+    config = {"sensors": {"sds": {"82312": {}}, "bme": {}, "hpm": {"1": {}}}}
+    with caplog.at_level(logging.WARNING):
+        schemas.check_config(config)
+    assert "['hpm']" in caplog.text
+    # Неизвестная секция и пустая секция известного типа не становятся активными
+    assert [s.name for s in schemas.active_types(config)] == ["SDS011"]
+
+
+def test_read_csv_reads_only_declared_columns_with_their_types(tmp_path):
+    path = tmp_path / "2025-06-01_sds011_sensor_82312.csv"
+    path.write_text("sensor_id;sensor_type;location;lat;lon;timestamp;P1;durP1;ratioP1;P2;durP2;ratioP2\n"
+                    "82312;SDS011;1;55.75;37.61;2025-06-01T00:00:00;10.5;;;5;;\n"
+                    "82312;SDS011;1;55.75;37.61;2025-06-01T00:05:00;;;;6.25;;\n", encoding="utf-8")
+    df = schemas.get_schema("SDS011").read_csv(str(path))
+    assert sorted(df.columns) == ["P1", "P2", "lat", "lon", "timestamp"]
+    assert {c: str(df[c].dtype) for c in ("lat", "lon", "P1", "P2")} == dict.fromkeys(("lat", "lon", "P1", "P2"),
+                                                                        "float64")
+    assert df["timestamp"].tolist() == ["2025-06-01T00:00:00", "2025-06-01T00:05:00"]
+    assert df["P1"].isna().tolist() == [False, True] and df["P2"].tolist() == [5.0, 6.25]
+
+
+def test_read_csv_falls_back_on_decimal_commas(tmp_path):
+    path = tmp_path / "2025-06-01_sds011_sensor_82312.csv"
+    path.write_text("sensor_id;lat;lon;timestamp;P1;P2\n"
+                    "82312;55,75;37,61;2025-06-01T00:00:00;10,5;oops\n", encoding="utf-8")
+    df = schemas.get_schema("SDS011").read_csv(str(path), columns=["timestamp", "lat", "P1", "P2"])
+    assert sorted(df.columns) == ["P1", "P2", "lat", "timestamp"]
+    assert df.loc[0, "lat"] == 55.75 and df.loc[0, "P1"] == 10.5 and df["P2"].isna().all()
+    assert str(df["P1"].dtype) == "float64"
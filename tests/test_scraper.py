@@ -0,0 +1,50 @@
+import pytest
+
+import scraper
+from main import _needs_download
+from statestore import STAGE_DOWNLOAD, STATUS_DONE, STATUS_MISSING, StateStore
+
+
+class _Response:
+    def __init__(self, status_code, text=""):
+        self.status_code = status_code
+        self.text = text
+        self.content = text.encode("utf-8")
+
+
+@pytest.fixture
+def archive(monkeypatch):
+    """Архив sensor.community: {имя файла: (код, текст)}; запросы запоминаются."""
+    files, requested = {}, []
+
+    def get(url, timeout=None):
+        name = url.rsplit("/", 1)[-1]
+        requested.append(name)
+        return _Response(*files.get(name, (404, "")))
+
+    monkeypatch.setattr(scraper.requests, "get", get)
+    return files, requested
+
+
+def test_day_statuses(tmp_path, archive):
+    files, requested = archive
+    files["2025-06-01_sds011_sensor_82312.csv"] = (200, "sensor_id;timestamp\n82312;2025-06-01T00:00:00\n")
+    files["2025-06-02_sds011_sensor_82312.csv"] = (200, "")
+    config = {"data_dir": str(tmp_path),
+              "sensors": {"sds": {"82312": {"days": ["2025-06-01", "2025-06-02", "2025-06-03"]}}}}
+
+    scraper.scrape_data(config)
+
+    with StateStore(str(tmp_path)) as store:
+        assert store.statuses(STAGE_DOWNLOAD, "SDS011", "82312") == {
+            "2025-06-01": STATUS_DONE, "2025-06-02": STATUS_MISSING, "2025-06-03": STATUS_MISSING}
+        detail = store.conn.execute("SELECT detail FROM day_state WHERE day = '2025-06-02'").fetchone()[0]
+        assert detail == "empty"
+    assert len(requested) == 3
+
+
+def test_empty_day_is_rechecked_only_in_recent_window():
+    # Пустой файл отмечен как missing: старые дни больше не скачиваются, свежие — перепроверяются
+    assert not _needs_download(STATUS_MISSING, "2025-06-02", recheck_from="2025-06-10")
+    assert _needs_download(STATUS_MISSING, "2025-06-12", recheck_from="2025-06-10")
+    assert not _needs_download(STATUS_DONE, "2025-06-12", recheck_from="2025-06-10")
@@ -0,0 +1,116 @@
+import os
+import time
+
+import pytest
+
+from sharding import Shard, apply_shard, file_lease, get_shard, normalize_sensor_id, owner_of
+
+SENSORS = [str(82000 + i) for i in range(2000)]
+
+
+def test_normalize_excel_ids():
+    assert normalize_sensor_id(82312) == normalize_sensor_id("82312") == normalize_sensor_id(82312.0) == "82312"
+    assert normalize_sensor_id(" 82312 ") == "82312"
+
+
+def test_every_sensor_has_exactly_one_owner():
+    shards = [Shard(i, 4) for i in range(4)]
+    for sensor_id in SENSORS[:200]:
+        assert sum(s.owns(sensor_id) for s in shards) == 1
+    counts = [sum(owner_of(s, 4) == i for s in SENSORS) for i in range(4)]
+    assert min(counts) > len(SENSORS) / 4 * 0.8
+
+
+def test_adding_a_worker_moves_only_its_share():
+    before = {s: owner_of(s, 4) for s in SENSORS}
+    after = {s: owner_of(s, 5) for s in SENSORS}
+    moved = [s for s in SENSORS if before[s] != after[s]]
+    # Переезжают только датчики нового шарда, около 1/5
+    assert all(after[s] == 4 for s in moved)
+    assert len(moved) < len(SENSORS) * 0.3
+
+
+def test_ownership_of_empty_ids_and_single_worker():
+    assert not Shard(0, 2).owns(None)
+    assert not Shard(0, 2).owns("nan")
+    assert Shard().owns("82312")
+    assert Shard().suffix == ""
+    assert Shard(1, 3).suffix == ".shard-1-of-3"
+    with pytest.raises(ValueError):
+        Shard(2, 2)
+
+
+def test_env_overrides_config(monkeypatch):
+    monkeypatch.setenv("ETL_SHARD_INDEX", "1")
+    monkeypatch.setenv("ETL_SHARD_COUNT", "3")
+    shard = get_shard({"shard": {"index": 0, "count": 2}})
+    assert (shard.index, shard.count) == (1, 3)
+
+
+def test_apply_shard_keeps_own_sensors(monkeypatch):
+    monkeypatch.delenv("ETL_SHARD_INDEX", raising=False)
+    monkeypatch.delenv("ETL_SHARD_COUNT", raising=False)
+    ids = SENSORS[:50]
+    parts = []
+    for index in range(2):
+        config = {"shard": {"index": index, "count": 2}, "sensors": {"sds": {s: {} for s in ids}}}
+        apply_shard(config)
+        parts.append(set(config["sensors"]["sds"]))
+    assert parts[0] | parts[1] == set(ids)
+    assert not parts[0] & parts[1]
+
+
+def test_file_lease_is_exclusive(tmp_path):
+    with file_lease(str(tmp_path), "thing-РСУНДПл000001"):
+        with pytest.raises(TimeoutError):
+            with file_lease(str(tmp_path), "thing-РСУНДПл000001", wait=0):
+                pass
+    with file_lease(str(tmp_path), "thing-РСУНДПл000001", wait=0):
+        pass
+    assert os.listdir(tmp_path / "leases") == []
+
+
+def test_stale_lease_is_taken_over(tmp_path):
+    lease = tmp_path / "leases" / "all_stats.lease"
+    lease.parent.mkdir()
+    lease.write_text("dead-host:1")
+    old = time.time() - 3600
+    os.utime(lease, (old, old))
+    with file_lease(str(tmp_path), "all_stats", ttl=60, wait=0):
+        assert lease.read_text() != "dead-host:1"
+
+
+def test_group_metadata_synced_only_by_its_owner(tmp_path, monkeypatch):
+    import pandas as pd
+
+    import uploader
+    from statestore import StateStore
+
+    group = pd.DataFrame({
+        "Инвентарный номер изделия": ["РСУНДПл000001"] * 2, "Марка": ["ДПС"] * 2,
+        "Номер процессора": ["esp8266-1"] * 2, "Тип": ["Москвадыш"] * 2,
+        "sensor_type": ["SDS011", "BME280"], "sensor_id": [82312, 82313],
+        "address": ["Красная площадь, 1"] * 2, "lon": [37.61] * 2, "lat": [55.75] * 2,
+        "first_seen": ["2025-06-01T00:00:00"] * 2,
+    })
+    created = []
+
+    def fake_process_group(desired, obs_prop_ids, dry_run=False, known=None):
+        created.append(desired["inv"])
+        return {"thing_id": "1", "sensors": {}, "foi_id": "7", "complete": True}
+
+    store = StateStore(str(tmp_path))
+    monkeypatch.setattr(uploader, "STATE", store)
+    monkeypatch.setattr(uploader, "BASE_URL", "http://frost.test/v1.1")
+    monkeypatch.setattr(uploader, "process_group", fake_process_group)
+    try:
+        # Воркер с датчиком группы, но не владелец инвентарного номера, ничего не создает
+        assert uploader.sync_group(group, {}, owner=False) is None
+        assert created == []
+        res = uploader.sync_group(group, {}, owner=True)
+        assert created == ["РСУНДПл000001"]
+        # После синхронизации владельцем остальные берут готовые ID из state.sqlite
+        assert uploader.sync_group(group, {}, owner=False) == res
+        assert created == ["РСУНДПл000001"]
+    finally:
+        store.close()
@@ -0,0 +1,89 @@
+import json
+import multiprocessing
+
+from catalog import FileCatalog
+from statestore import (STAGE_DOWNLOAD, STAGE_PROCESS, STAGE_UPLOAD, STATUS_DONE, STATUS_FAILED,
+                        STATUS_MISSING, StateStore)
+
+
+def _mark_days(path, stage, days):
+    with StateStore(path) as store, store.batch():
+        for day in days:
+            store.mark(stage, "SDS011", 82312, day, STATUS_DONE)
+
+
+def test_mark_counts_attempts_until_done(tmp_path):
+    with StateStore(str(tmp_path)) as store:
+        store.mark(STAGE_DOWNLOAD, "SDS011", 82312, "2025-06-01", STATUS_FAILED, detail="timeout")
+        store.mark(STAGE_DOWNLOAD, "SDS011", 82312, "2025-06-01", STATUS_DONE)
+        store.mark(STAGE_DOWNLOAD, "SDS011", 82312, "2025-06-01", STATUS_DONE)
+        row = store.conn.execute("SELECT status, attempts, detail FROM day_state").fetchone()
+        assert tuple(row) == (STATUS_DONE, 2, None)
+
+
+def test_batch_is_written_on_exit(tmp_path):
+    with StateStore(str(tmp_path)) as store:
+        with store.batch():
+            store.mark(STAGE_DOWNLOAD, "SDS011", 82312, "2025-06-01", STATUS_DONE)
+            with store.batch():
+                store.mark(STAGE_DOWNLOAD, "SDS011", 82312, "2025-06-02", STATUS_DONE)
+            assert store.statuses(STAGE_DOWNLOAD, "SDS011", 82312) == {}
+        assert len(store.statuses(STAGE_DOWNLOAD, "SDS011", 82312)) == 2
+
+
+def test_pending_days_between_stages(tmp_path):
+    with StateStore(str(tmp_path)) as store:
+        for day in ("2025-06-01", "2025-06-02", "2025-06-03"):
+            store.mark(STAGE_PROCESS, "SDS011", 82312, day, STATUS_DONE)
+        store.mark(STAGE_UPLOAD, "SDS011", 82312, "2025-06-01", STATUS_DONE)
+        store.mark(STAGE_UPLOAD, "SDS011", 82312, "2025-06-02", STATUS_FAILED)
+        assert store.pending(STAGE_UPLOAD, STAGE_PROCESS, "SDS011", 82312) == ["2025-06-02", "2025-06-03"]
+        assert store.pending(STAGE_UPLOAD, STAGE_PROCESS, "SDS011", 82312, start="2025-06-03") == ["2025-06-03"]
+
+
+def test_concurrent_writers(tmp_path):
+    days = [[f"2025-06-{d:02d}" for d in range(start, start + 10)] for start in (1, 11, 21)]
+    ctx = multiprocessing.get_context("spawn")
+    procs = [ctx.Process(target=_mark_days, args=(str(tmp_path), STAGE_DOWNLOAD, part)) for part in days]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join(60)
+        assert p.exitcode == 0
+    with StateStore(str(tmp_path)) as store:
+        assert len(store.statuses(STAGE_DOWNLOAD, "SDS011", 82312)) == 30
+
+
+def test_migrate_legacy_state_json(tmp_path, write_sds_day):
+    write_sds_day(tmp_path, 82312, "2025-06-01", [("00:00:00", 1.0, 1.0)])
+    write_sds_day(tmp_path, 82312, "2025-06-03", [("00:00:00", 1.0, 1.0)])
+    legacy = tmp_path / "state.json"
+    legacy.write_text(json.dumps({
+        "sds": {"82312": {"initial_start": "2025-06-01", "last_downloaded": "2025-06-03"},
+                "82313": {"initial_start": "broken"}},
+        "unknown": {"1": {"initial_start": "2025-06-01", "last_downloaded": "2025-06-01"}},
+    }))
+
+    with FileCatalog(str(tmp_path)) as catalog, StateStore(str(tmp_path)) as store:
+        assert store.migrate_from_json(str(legacy), {"sds": "SDS011"}, catalog)
+        assert store.statuses(STAGE_DOWNLOAD, "SDS011", 82312) == {
+            "2025-06-01": STATUS_DONE, "2025-06-02": STATUS_MISSING, "2025-06-03": STATUS_DONE}
+        assert store.statuses(STAGE_DOWNLOAD, "SDS011", 82313) == {}
+        row = store.conn.execute("SELECT initial_start FROM sensors WHERE sensor_id = '82312'").fetchone()
+        assert row["initial_start"] == "2025-06-01"
+
+        assert not legacy.exists()
+        assert (tmp_path / "state.json.migrated").exists()
+        # Повторная миграция не выполняется, даже если state.json вернули
+        legacy.write_text("{}")
+        assert not store.migrate_from_json(str(legacy), {"sds": "SDS011"}, catalog)
+
+
+def test_sync_records_per_server(tmp_path):
+    with StateStore(str(tmp_path)) as store:
+        store.set_sync("http://a", "РСУНДПл000001", "fp", {"thing_id": "1"})
+        store.set_sync("http://b", "РСУНДПл000001", None, {"thing_id": "9"})
+        assert store.get_sync("http://a", "РСУНДПл000001") == ("fp", {"thing_id": "1"})
+        assert store.synced_groups("http://b") == {"РСУНДПл000001": {"thing_id": "9"}}
+        assert store.clear_sync("http://a") == 1
+        assert store.get_sync("http://a", "РСУНДПл000001") is None
@@ -0,0 +1,69 @@
+import os
+
+import pytest
+
+import schemas
+import transform
+from catalog import FileCatalog
+from transform import FRAMES, file_summaries
+
+READINGS = [("00:00:00", 10.0, 5.0), ("00:05:00", 12.0, None)]
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    """Пути файлов, которые file_summaries действительно разобрал."""
+    paths = []
+
+    def read_frame(schema, path):
+        paths.append(os.path.basename(path))
+        return original(schema, path)
+
+    original = transform.read_frame
+    monkeypatch.setattr(transform, "read_frame", read_frame)
+    FRAMES.clear()
+    yield paths
+    FRAMES.clear()
+
+
+def _summaries(catalog):
+    schema = schemas.get_schema("SDS011")
+    return {e["day"]: s for e, s in file_summaries(catalog, schema, catalog.files("SDS011"))}
+
+
+def test_unchanged_files_are_not_read_again(tmp_path, write_sds_day, reads):
+    write_sds_day(tmp_path, 82312, "2025-06-01", READINGS)
+    write_sds_day(tmp_path, 82312, "2025-06-02", READINGS[:1])
+    with FileCatalog(str(tmp_path)) as catalog:
+        first = _summaries(catalog)
+        assert sorted(reads) == ["2025-06-01_sds011_sensor_82312.csv", "2025-06-02_sds011_sensor_82312.csv"]
+        assert first["2025-06-01"]["counts"] == {"P1": 2, "P2": 1, "rows": 2}
+        assert first["2025-06-01"]["bounds"] == [[55.75, 37.61, "2025-06-01T00:00:00", "2025-06-01T00:05:00"]]
+
+    reads.clear()
+    FRAMES.clear()
+    with FileCatalog(str(tmp_path)) as catalog:
+        assert _summaries(catalog) == first
+    assert reads == []
+
+
+def test_changed_size_or_mtime_is_read_again(tmp_path, write_sds_day, reads):
+    write_sds_day(tmp_path, 82312, "2025-06-01", READINGS)
+    touched = write_sds_day(tmp_path, 82312, "2025-06-02", READINGS)
+    with FileCatalog(str(tmp_path)) as catalog:
+        _summaries(catalog)
+
+        # Дописан день: другой размер
+        reads.clear()
+        write_sds_day(tmp_path, 82312, "2025-06-01", READINGS + [("00:10:00", 1.0, 1.0)])
+        catalog.reconcile()
+        assert _summaries(catalog)["2025-06-01"]["counts"] == {"P1": 3, "P2": 2, "rows": 3}
+        assert reads == ["2025-06-01_sds011_sensor_82312.csv"]
+
+        # Тот же размер, другой mtime
+        reads.clear()
+        st = os.stat(touched)
+        os.utime(touched, (st.st_atime, st.st_mtime - 3600))
+        catalog.reconcile()
+        _summaries(catalog)
+        assert reads == ["2025-06-02_sds011_sensor_82312.csv"]
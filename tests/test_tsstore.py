@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+import pytest
+
+from catalog import FileCatalog
+from tsstore import TimeSeriesStore, _rollup
+
+T0 = 1748736000  # 2025-06-01T00:00:00Z
+
+
+def test_rollup_mean_min_max_count_skip_nan():
+    times = np.array([T0, T0 + 60, T0 + 120, T0 + 3600], dtype=np.int64)
+    values = {"P1": np.array([1.0, np.nan, 5.0, 7.0])}
+    out = _rollup(times, values, 3600)
+    assert out["time"].tolist() == [T0, T0 + 3600]
+    assert out["P1__mean"].tolist() == [3.0, 7.0]
+    assert out["P1__min"].tolist() == [1.0, 7.0]
+    assert out["P1__max"].tolist() == [5.0, 7.0]
+    assert out["P1__count"].tolist() == [2, 1]
+
+
+def test_rollup_of_empty_month():
+    out = _rollup(np.empty(0, dtype=np.int64), {"P1": np.empty(0)}, 3600)
+    assert out["time"].size == 0 and out["P1__count"].size == 0
+
+
+@pytest.fixture
+def archive(tmp_path, write_sds_day):
+    write_sds_day(tmp_path, 82312, "2025-06-01", [("00:00:00", 10.0, 1.0), ("00:30:00", 20.0, 2.0),
+                                                 ("01:00:00", 30.0, "")])
+    write_sds_day(tmp_path, 82312, "2025-07-01", [("12:00:00", 40.0, 4.0)])
+    return tmp_path
+
+
+def test_update_builds_only_changed_months(archive, write_sds_day):
+    store = TimeSeriesStore(str(archive))
+    with FileCatalog(str(archive)) as catalog:
+        assert store.update(catalog, ["SDS011"]) == {"built": 2, "removed": 0, "unchanged": 0}
+        assert store.update(catalog, ["SDS011"]) == {"built": 0, "removed": 0, "unchanged": 2}
+
+        path = write_sds_day(archive, 82312, "2025-07-01", [("12:00:00", 40.0, 4.0), ("13:00:00", 50.0, 5.0)])
+        os.utime(path, (T0, T0))
+        catalog.reconcile()
+        assert store.update(catalog, ["SDS011"]) == {"built": 1, "removed": 0, "unchanged": 1}
+    assert store.index("SDS011", "82312")["2025-07"]["rows"] == 2
+    assert store.sensors() == [("SDS011", "82312")]
+
+
+def test_query_raw_and_rollups(archive):
+    store = TimeSeriesStore(str(archive))
+    with FileCatalog(str(archive)) as catalog:
+        store.update(catalog, ["SDS011"])
+
+    raw = store.query("SDS011", "82312", "P2")
+    assert raw["time"].tolist() == [T0, T0 + 1800, T0 + 30 * 86400 + 43200]
+    assert raw["value"].tolist() == [1.0, 2.0, 4.0]
+
+    window = store.query("SDS011", "82312", "P1", start=T0 + 1800, end=T0 + 3600)
+    assert window["value"].tolist() == [20.0, 30.0]
+
+    hourly = store.query("SDS011", "82312", "P1", end=T0 + 86400, rollup="1h")
+    assert hourly["time"].tolist() == [T0, T0 + 3600]
+    assert hourly["mean"].tolist() == [15.0, 30.0]
+    assert hourly["count"].tolist() == [2, 1]
+
+    daily = store.query("SDS011", "82312", "P1", rollup="1d")
+    assert daily["max"].tolist() == [30.0, 40.0]
+
+
+def test_sensor_dir_stays_under_root(tmp_path):
+    store = TimeSeriesStore(str(tmp_path))
+    assert store.sensor_dir("SDS011", "82312").startswith(store.root)
+    for sensor_type, sensor_id in [("SDS011", "../../etc"), ("..", ".."), ("SDS011", "/tmp"), ("", "")]:
+        with pytest.raises(ValueError):
+            store.sensor_dir(sensor_type, sensor_id)
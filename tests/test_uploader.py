@@ -0,0 +1,183 @@
+import pandas as pd
+import pytest
+
+import flowcontrol
+import schemas
+import uploader
+from catalog import FileCatalog
+from flowcontrol import AimdController, Overloaded, pump
+from main import plan_uploads
+from statestore import STAGE_DOWNLOAD, STAGE_UPLOAD, STATUS_DONE, STATUS_FAILED, StateStore
+
+SDS_CONFIG = {"sensors": {"sds": {"82312": {"start": "2025-06-01", "end": "auto", "window_start": "2025-06-01"}}}}
+
+
+@pytest.fixture
+def session(tmp_path, monkeypatch):
+    """Модуль загрузчика, настроенный на временные state.sqlite и каталог (без сервера)."""
+    store = StateStore(str(tmp_path))
+    catalog = FileCatalog(str(tmp_path))
+    monkeypatch.setattr(uploader, "STATE", store)
+    monkeypatch.setattr(uploader, "CATALOG", catalog)
+    monkeypatch.setattr(uploader, "FLOW", AimdController())
+    monkeypatch.setattr(uploader, "MULTIDATASTREAM", False)
+    yield store, catalog
+    catalog.close()
+    store.close()
+
+
+def test_downloaded_day_without_file_is_downloaded_again(session, monkeypatch):
+    store, _ = session
+    monkeypatch.setattr(uploader, "get_last_datastream_time", lambda *a, **k: None)
+    monkeypatch.setattr(uploader, "post_observations", lambda *a, **k: pytest.fail("nothing to send"))
+    store.mark(STAGE_DOWNLOAD, "SDS011", "82312", "2025-06-01", STATUS_DONE)
+    assert plan_uploads(SDS_CONFIG, store) == 1
+
+    uploader.upload_observations_safe("82312", {"P1": "13", "P2": "14"}, "SDS011", None, None, "7",
+                                      days=["2025-06-01"])
+    assert store.statuses(STAGE_DOWNLOAD, "SDS011", "82312") == {"2025-06-01": STATUS_FAILED}
+    assert store.statuses(STAGE_UPLOAD, "SDS011", "82312") == {"2025-06-01": STATUS_FAILED}
+    # Загрузка больше не запускается ради этого дня — его сначала скачает скрапер
+    assert plan_uploads(SDS_CONFIG, store) == 0
+
+
+def test_flow_settings_are_kept_per_shard(tmp_path, monkeypatch):
+    config = {"frost_url": "http://frost.test/v1.1", "data_dir": str(tmp_path), "upload": {"initial_batch": 100}}
+    learned = {}
+    for index in (0, 1):
+        monkeypatch.setenv("ETL_SHARD_INDEX", str(index))
+        monkeypatch.setenv("ETL_SHARD_COUNT", "2")
+        uploader.open_session(config)
+        uploader.FLOW._batch = learned[index] = 100 + 50 * (index + 1)
+        uploader.close_session()
+
+    monkeypatch.setenv("ETL_SHARD_INDEX", "0")
+    uploader.open_session(config)
+    try:
+        # Шард 1 закрылся последним, но шард 0 продолжает со своих настроек
+        assert uploader.FLOW.batch_size == learned[0]
+    finally:
+        uploader.close_session()
+
+
+def _group(*locations):
+    """Строки all_stats.xlsx одной группы: SDS011 и BME280 на каждой локации (address, lat, lon, first_seen)."""
+    rows = []
+    for address, lat, lon, first_seen in locations:
+        for sensor_type, sensor_id in (("SDS011", 82312), ("BME280", 82313)):
+            rows.append({"sensor_type": sensor_type, "sensor_id": sensor_id, "address": address,
+                         "lat": lat, "lon": lon, "first_seen": first_seen,
+                         "Инвентарный номер изделия": "РСУНДПл000001", "Тип": "Стационарный",
+                         "Марка": "AirRohr", "Номер процессора": "3349511"})
+    return pd.DataFrame(rows)
+
+
+HOME = ("Москва, Тверская 1", 55.75, 37.61, "2025-06-01 00:00:00")
+
+
+@pytest.fixture
+def frost_session(session, fake_frost, monkeypatch):
+    frost, url = fake_frost
+    monkeypatch.setattr(uploader, "BASE_URL", url)
+    return frost, uploader._ObservedProperties(["SDS011", "BME280"])
+
+
+def test_group_sync_is_skipped_when_fingerprint_is_unchanged(frost_session):
+    frost, obs_props = frost_session
+    first = uploader.sync_group(_group(HOME), obs_props)
+    assert first["complete"]
+    assert frost.created() == {"Things": 1, "Sensors": 2, "Locations": 1, "HistoricalLocations": 1,
+                               "FeaturesOfInterest": 1, "ObservedProperties": 5, "Datastreams": 5}
+    # Описание Thing прежнее: существующие Things не переписываются
+    assert frost.db["Things"][first["thing_id"]]["description"] == "SDS011+BME280"
+
+    frost.requests.clear()
+    assert uploader.sync_group(_group(HOME), obs_props) == first
+    assert frost.requests == []
+
+
+def test_new_location_creates_only_its_entities(frost_session):
+    frost, obs_props = frost_session
+    first = uploader.sync_group(_group(HOME), obs_props)
+
+    frost.requests.clear()
+    moved = uploader.sync_group(_group(HOME, ("Москва, Арбат 2", 55.76, 37.59, "2025-06-10 00:00:00")), obs_props)
+    assert frost.created() == {"Locations": 1, "HistoricalLocations": 1, "FeaturesOfInterest": 1}
+    assert not any(method == "PATCH" for method, _ in frost.requests)
+    assert moved["thing_id"] == first["thing_id"] and moved["sensors"] == first["sensors"]
+    assert moved["foi_id"] != first["foi_id"]
+
+
+def test_resync_drops_stored_ids_and_finds_entities_by_name(frost_session):
+    frost, obs_props = frost_session
+    store = uploader.STATE
+    first = uploader.sync_group(_group(HOME), obs_props)
+
+    assert store.clear_sync(uploader.BASE_URL) == 1
+    assert store.get_sync(uploader.BASE_URL, "РСУНДПл000001") is None
+    frost.requests.clear()
+    again = uploader.sync_group(_group(HOME), obs_props)
+    # Сущности проверены на сервере заново, но дубликаты не созданы
+    assert frost.requests and frost.created() == {}
+    assert again["thing_id"] == first["thing_id"] and again["sensors"] == first["sensors"]
+    assert again["foi_id"] == first["foi_id"]
+
+
+def test_multidatastream_result_follows_schema_measurement_order(frost_session, monkeypatch):
+    frost, obs_props = frost_session
+    monkeypatch.setattr(uploader, "MULTIDATASTREAM", True)
+    monkeypatch.setattr(uploader, "CREATE_OBSERVATIONS", True)
+    schema = schemas.get_schema("BME280")
+    res = uploader.sync_group(_group(HOME), obs_props)
+
+    # ID MultiDatastream сохраняются в frost_sync вместе с группой
+    stored = uploader.STATE.get_sync(uploader.BASE_URL, "РСУНДПл000001")[1]
+    mds_id = res["sensors"]["BME280"]["mds_id"]
+    assert mds_id and stored["sensors"]["BME280"]["mds_id"] == mds_id
+    assert stored["sensors"]["SDS011"]["mds_id"] == res["sensors"]["SDS011"]["mds_id"]
+    mds = frost.db["MultiDatastreams"][mds_id]
+    assert [frost.db["ObservedProperties"][p["@iot.id"]]["name"] for p in mds["ObservedProperties"]] == \
+        [m["observed_property"] for m in schema.measurements.values()]
+
+    # Колонки файла в другом порядке: компоненты результата все равно идут по измерениям схемы
+    df = pd.DataFrame({"humidity": [40.0], "pressure": [99000.0], "temperature": [21.5],
+                       "timestamp": [pd.Timestamp("2025-06-01T00:00:00Z")]})
+    chunk = uploader.build_observations(df, list(schema.measurements), {}, mds_id)
+    assert uploader.post_observations(chunk, res["foi_id"], "BME280", "MultiDatastream") == 0
+    (observation,) = frost.observations("MultiDatastream", mds_id)
+    assert observation["result"] == [21.5, 40.0, 99000.0]
+    assert observation["FeatureOfInterest"] == {"@iot.id": res["foi_id"]}
+
+
+def test_unreadable_create_observations_response_is_reconciled(frost_session, monkeypatch):
+    frost, _ = frost_session
+    monkeypatch.setattr(uploader, "CREATE_OBSERVATIONS", True)
+    monkeypatch.setattr(uploader, "FLOW", AimdController(initial_batch=10))
+    monkeypatch.setattr(flowcontrol.time, "sleep", lambda s: None)
+    real_post = uploader.requests.post
+
+    class Garbled:
+        status_code, text, headers = 201, "<html>proxy error</html>", {}
+
+        def json(self):
+            raise ValueError("not json")
+
+    def post(url, **kwargs):
+        resp = real_post(url, **kwargs)
+        # Сервер записал пачку, но ответ до клиента дошел испорченным
+        return Garbled() if url.endswith("/CreateObservations") and len(kwargs["json"][0]["dataArray"]) > 2 else resp
+
+    monkeypatch.setattr(uploader.requests, "post", post)
+    chunk = [("13", f"2025-06-01T00:{m:02d}:00+00:00", float(m)) for m in range(0, 25, 5)]
+    with pytest.raises(Overloaded) as e:
+        uploader.post_observations(chunk[:3], None, "SDS011")
+    assert e.value.maybe_applied
+
+    frost.db.pop("Observations")
+    frost.requests.clear()
+    results = pump([("2025-06-01", chunk)], lambda part: uploader.post_observations(part, None, "SDS011"),
+                   uploader.FLOW, reconcile=uploader.missing_observations)
+    # Ничего не потеряно и не задвоено: повторяется только то, чего на сервере нет
+    assert results == {"2025-06-01": {"sent": 5, "failed": 0}}
+    assert sorted(o["result"] for o in frost.observations("Datastream", "13")) == [0.0, 5.0, 10.0, 15.0, 20.0]
+    assert frost.requests.count(("POST", "/CreateObservations")) == 1